@@ -0,0 +1,126 @@
+import asyncio
+import contextlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Final
+
+from app.container import Container
+from app.rdb_writer import RdbWriter
+
+APPENDFSYNC_POLICIES: Final[tuple[str, ...]] = ("always", "everysec", "no")
+DEFAULT_APPENDFILENAME: Final[str] = "appendonly.aof"
+
+logger = logging.getLogger(__name__)
+
+
+class AppendOnlyFile:
+    """
+    Log of the write commands in the RESP encoding they are propagated with.
+
+    feed() only appends to a buffer. flush() hands the buffer to a single
+    writer thread, so writes reach the file in order and neither write() nor
+    fsync() runs on the event loop. The fsync depends on appendfsync:
+    "always" syncs in flush() and returns only once the data is on disk,
+    "everysec" leaves it to fsync_loop(), "no" leaves it to the kernel.
+
+    A rewrite starts the file over from a snapshot of the keyspace, stored
+    as an RDB preamble like Redis's aof-use-rdb-preamble, followed by the
+    commands fed while the snapshot was being written.
+    """
+
+    def __init__(self, path: Path, appendfsync: str = "everysec") -> None:
+        self.path = path
+        self.appendfsync = appendfsync
+        self.file = open(path, "ab")
+        self.buffer = bytearray()
+        # Commands fed since the rewrite snapshot was taken, or None.
+        self.rewrite_buffer: bytearray | None = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aof")
+        self.unsynced = False  # written since the last fsync
+        self.last_write_ok = True
+
+    def feed(self, data: bytes) -> None:
+        self.buffer += data
+        if self.rewrite_buffer is not None:
+            self.rewrite_buffer += data
+
+    async def flush(self) -> None:
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, self._write, data, self.appendfsync == "always"
+        )
+        if self.appendfsync == "always":
+            await future
+
+    async def fsync_loop(self, interval: float = 1.0) -> None:
+        """appendfsync everysec: sync what was written once per interval."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            if self.unsynced:
+                self.unsynced = False
+                await loop.run_in_executor(self.executor, self._fsync)
+
+    def rewrite(self, container: Container) -> asyncio.Future:
+        """
+        BGREWRITEAOF. The snapshot is forked now, so every command fed from
+        here on goes to the rewrite buffer, which is appended to the new file
+        once the child is done. The old file stays in use until then.
+        """
+        tmp = self.path.with_name(f"temp-rewriteaof-bg-{self.path.name}")
+        self.rewrite_buffer = bytearray()
+        return asyncio.ensure_future(
+            self._finish_rewrite(RdbWriter.bgsave(container, tmp), tmp)
+        )
+
+    async def _finish_rewrite(self, snapshot: asyncio.Future, tmp: Path) -> None:
+        try:
+            await snapshot
+        except BaseException:
+            self.rewrite_buffer = None
+            with contextlib.suppress(FileNotFoundError):
+                tmp.unlink()
+            raise
+        # Commands fed so far go to the old file first, the writer thread
+        # keeps the order.
+        await self.flush()
+        tail = bytes(self.rewrite_buffer)
+        self.rewrite_buffer = None
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._switch, tmp, tail
+        )
+
+    def _write(self, data: bytes, fsync: bool) -> None:
+        try:
+            self.file.write(data)
+            self.file.flush()
+            if fsync:
+                os.fsync(self.file.fileno())
+            else:
+                self.unsynced = True
+            self.last_write_ok = True
+        except OSError as err:
+            self.last_write_ok = False
+            logger.warning("Error writing to the AOF: %s", err)
+
+    def _fsync(self) -> None:
+        try:
+            os.fsync(self.file.fileno())
+        except OSError as err:
+            self.last_write_ok = False
+            logger.warning("Error syncing the AOF: %s", err)
+
+    def _switch(self, tmp: Path, tail: bytes) -> None:
+        with open(tmp, "ab") as file:
+            file.write(tail)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.path)
+        self.file.close()
+        self.file = open(self.path, "ab")
+        self.unsynced = False
@@ -0,0 +1,38 @@
+import asyncio
+import time
+
+_cached_ms: int | None = None
+
+
+def now_ms() -> int:
+    """
+    Monotonic time in integer milliseconds, used for key expiry deadlines.
+
+    Inside an event loop the value is read once and cached until the next loop
+    iteration, so all commands handled in the same tick see the same time.
+    """
+    global _cached_ms
+    if _cached_ms is None:
+        now = time.monotonic_ns() // 1_000_000
+        try:
+            asyncio.get_running_loop().call_soon(_invalidate)
+        except RuntimeError:
+            return now  # no running loop to refresh the cache
+        _cached_ms = now
+    return _cached_ms
+
+
+def _invalidate() -> None:
+    global _cached_ms
+    _cached_ms = None
+
+
+def deadline_from_unix_ms(unix_ms: int) -> int:
+    """Convert an absolute unix time in ms (e.g. from an RDB file) to a deadline."""
+    # Both clocks read fresh: the cached now_ms() can lag during a long load.
+    return time.monotonic_ns() // 1_000_000 + unix_ms - time.time_ns() // 1_000_000
+
+
+def unix_ms_from_deadline(deadline: int) -> int:
+    """Inverse of deadline_from_unix_ms(), e.g. to write expiries to an RDB file."""
+    return deadline - time.monotonic_ns() // 1_000_000 + time.time_ns() // 1_000_000
@@ -1,177 +1,1217 @@
+import asyncio
 import bisect
+import gc
+import heapq
+import itertools
+import logging
+import math
+import random
+import sys
+import time
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Any, Literal, Tuple
+from decimal import Decimal, InvalidOperation, localcontext
+from typing import Any, Callable, Final, Iterable, Iterator, Tuple
 
+from app.clock import now_ms
+from app.datatypes import (
+    HashSet,
+    HashTable,
+    Listpack,
+    ListpackHash,
+    ListpackList,
+    ListpackSet,
+    ListpackZSet,
+    Quicklist,
+    ScoreBound,
+    SortedSet,
+)
 
-@dataclass
+logger = logging.getLogger(__name__)
+
+# Element.type values, indexes into TYPE_NAMES.
+STRING: Final[int] = 0
+STREAM: Final[int] = 1
+LIST: Final[int] = 2
+SET: Final[int] = 3
+ZSET: Final[int] = 4
+HASH: Final[int] = 5
+TYPE_NAMES: Final[tuple[str, ...]] = ("string", "stream", "list", "set", "zset", "hash")
+WRONGTYPE: Final[str] = (
+    "WRONGTYPE Operation against a key holding the wrong kind of value"
+)
+NOT_AN_INTEGER: Final[str] = "ERR value is not an integer or out of range"
+NOT_A_FLOAT: Final[str] = "ERR value is not a valid float"
+INT64_MIN: Final[int] = -(2**63)
+INT64_MAX: Final[int] = 2**63 - 1
+MAX_STRING_SIZE: Final[int] = 512 * 1024 * 1024  # proto-max-bulk-len
+MAX_DOUBLE: Final[Decimal] = Decimal(sys.float_info.max)
+
+MAXMEMORY_POLICIES: Final[tuple[str, ...]] = (
+    "noeviction",
+    "allkeys-lru",
+    "volatile-lru",
+    "allkeys-lfu",
+    "volatile-lfu",
+    "volatile-ttl",
+)
+# Estimated bytes used by a key besides its key and value bytes
+# (dict slot and Element, see benchmarks/memory.py), and by its TTL.
+KEY_OVERHEAD: Final[int] = 90
+TTL_OVERHEAD: Final[int] = 100
+# Redis's LFU counter parameters: 8-bit logarithmic counter that starts at
+# LFU_INIT_VAL and decays by one every LFU_DECAY_MINUTES without access.
+LFU_INIT_VAL: Final[int] = 5
+LFU_LOG_FACTOR: Final[int] = 10
+LFU_DECAY_MINUTES: Final[int] = 1
+
+
+@dataclass(slots=True)
 class Element:
+    """
+    Per-key record. Kept as small as possible since there is one per key:
+    the type is a small int and TTLs live in Container.expires.
+    """
+
     value: Any
-    expire_at: datetime = datetime.max
-    created_at: datetime = datetime.now()
-    type: Literal["string", "stream"] = "string"
+    type: int = STRING
+    # Container.lru_clock at the last access for LRU policies, or
+    # (access minute << 8 | counter) for LFU policies. Unused otherwise.
+    lru: int = 0
 
 
-@dataclass
-class StreamEntry:
-    id: str
-    data: dict
+def string_to_int(value: bytes) -> int:
+    """
+    Parse an integer like Redis does: only the canonical decimal form of an
+    int64, so no sign, spaces, underscores or leading zeros Python accepts.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(NOT_AN_INTEGER)
+    if not INT64_MIN <= number <= INT64_MAX or b"%d" % number != value:
+        raise ValueError(NOT_AN_INTEGER)
+    return number
 
-    @staticmethod
-    def validate_input_id_format(id: str) -> bool:
-        if id == "$":
-            return True
-        comp = id.split("-")
-        if (
-            len(comp) != 2
-            or len(comp[0]) > 13
-            or not comp[0].isdigit()
-            or not comp[1].isdigit()
-        ):
-            return False
-        return True
+
+def string_to_decimal(value: bytes) -> Decimal:
+    """
+    Parse a float for INCRBYFLOAT. Decimal arithmetic gives the results
+    Redis's long doubles print as, e.g. 3.3 rather than 3.3000000000000003
+    for 1.1 + 2.2.
+    """
+    try:
+        number = Decimal(value.decode())
+    except (InvalidOperation, UnicodeDecodeError):
+        raise ValueError(NOT_A_FLOAT)
+    if number.is_nan() or b"_" in value or value.strip() != value:
+        raise ValueError(NOT_A_FLOAT)
+    return number
+
+
+def string_to_float(value: bytes) -> float:
+    """
+    Parse a score like Redis's strtod(): inf is fine, NaN is not, and
+    neither are the spaces and underscores Python accepts.
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(NOT_A_FLOAT)
+    if math.isnan(number) or b"_" in value or value.strip() != value:
+        raise ValueError(NOT_A_FLOAT)
+    return number
+
+
+def format_float(value: float) -> bytes:
+    """Shortest form of a score that reads back the same, 3 rather than 3.0."""
+    text = repr(value)
+    if text.endswith(".0"):
+        text = text[:-2]
+    return text.encode()
+
+
+def format_decimal(value: Decimal) -> bytes:
+    """value without an exponent or trailing zeros, like Redis prints floats."""
+    text = format(value, "f")
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    return text.encode()
+
+
+def index_span(start: int, end: int, length: int) -> Tuple[int, int]:
+    """
+    Slice bounds of the items start to end included of LRANGE and ZRANGE,
+    negative indexes counting from the end; empty when start >= stop.
+    """
+    if start < 0:
+        start = max(start + length, 0)
+    start = min(start, length)
+    if end < 0:
+        end += length
+    return start, max(min(end, length - 1) + 1, start)
+
+
+StreamID = Tuple[int, int]  # (milliseconds, sequence number)
+MAX_STREAM_ID: Final[StreamID] = (2**64 - 1, 2**64 - 1)
+INVALID_STREAM_ID: Final[str] = (
+    "ERR Invalid stream ID specified as stream command argument"
+)
+
+
+def parse_stream_id(id: str, default_seq: int = 0) -> StreamID:
+    """
+    Parse "<ms>-<seq>", "<ms>" (sequence defaults to default_seq), "-" or "+".
+    """
+    if id == "-":
+        return (0, 0)
+    elif id == "+":
+        return MAX_STREAM_ID
+    ms, sep, seq = id.partition("-")
+    return (parse_stream_id_part(ms), parse_stream_id_part(seq) if sep else default_seq)
+
+
+def parse_stream_id_part(part: str) -> int:
+    """The ms or seq of a stream ID: an unsigned 64-bit integer."""
+    try:
+        number = int(part)
+    except ValueError:
+        raise ValueError(INVALID_STREAM_ID)
+    if not 0 <= number <= MAX_STREAM_ID[0]:
+        raise ValueError(INVALID_STREAM_ID)
+    return number
+
+
+def format_stream_id(id: StreamID) -> bytes:
+    return b"%d-%d" % id
+
+
+@dataclass(slots=True)
+class StreamEntry:
+    id: StreamID
+    data: list  # field1, value1, field2, value2, ...
 
 
-@dataclass
 class StreamEntries:
-    entries: list[StreamEntry]
+    """
+    Append-only stream index. Entries are stored in chunks of CHUNK_SIZE with
+    parallel lists of integer IDs and fields, plus the first ID of every chunk,
+    so XADD is an O(1) append and range reads are two bisects on int tuples.
+    """
 
-    @staticmethod
-    def key_func(item: StreamEntry) -> float:
-        if item.id == "-":
-            return 0
-        elif item.id == "+":
-            return float("inf")
-        comp = item.id.split("-")
-        x = 0.0
-        x += float(comp[0])
-        if len(comp) == 2:
-            x += 0.1 * float(comp[1])
-        return x
+    CHUNK_SIZE: Final[int] = 1024
 
+    __slots__ = ("firsts", "ids", "fields", "length", "last_id")
 
-class Container:
     def __init__(self) -> None:
+        self.firsts: list[StreamID] = []
+        self.ids: list[list[StreamID]] = []
+        self.fields: list[list[list]] = []
+        self.length = 0
+        self.last_id: StreamID = (0, 0)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[StreamEntry]:
+        for ids, fields in zip(self.ids, self.fields):
+            for id, data in zip(ids, fields):
+                yield StreamEntry(id, data)
+
+    def append(self, id: StreamID, data: list) -> None:
+        if not self.ids or len(self.ids[-1]) >= self.CHUNK_SIZE:
+            self.firsts.append(id)
+            self.ids.append([])
+            self.fields.append([])
+        self.ids[-1].append(id)
+        self.fields[-1].append(data)
+        self.length += 1
+        self.last_id = id
+
+    def snapshot(self) -> "StreamEntries":
+        """Copy that later appends do not change. Full chunks are shared."""
+        snapshot = StreamEntries()
+        snapshot.firsts = self.firsts.copy()
+        snapshot.ids = self.ids.copy()
+        snapshot.fields = self.fields.copy()
+        if snapshot.ids:
+            snapshot.ids[-1] = snapshot.ids[-1].copy()
+            snapshot.fields[-1] = snapshot.fields[-1].copy()
+        snapshot.length = self.length
+        snapshot.last_id = self.last_id
+        return snapshot
+
+    def range(
+        self, start: StreamID, end: StreamID, count: int | None = None
+    ) -> list[StreamEntry]:
+        """Entries with start <= id <= end, at most count of them."""
+        res = []
+        chunk = max(bisect.bisect_right(self.firsts, start) - 1, 0)
+        pos = bisect.bisect_left(self.ids[chunk], start) if self.ids else 0
+        while chunk < len(self.ids):
+            ids = self.ids[chunk]
+            fields = self.fields[chunk]
+            stop = bisect.bisect_right(ids, end, pos)
+            if count is not None:
+                stop = min(stop, pos + count - len(res))
+            res.extend(StreamEntry(ids[i], fields[i]) for i in range(pos, stop))
+            if stop < len(ids) or (count is not None and len(res) >= count):
+                break
+            chunk += 1
+            pos = 0
+        return res
+
+    def after(self, start: StreamID, count: int | None = None) -> list[StreamEntry]:
+        """Entries with id > start."""
+        ms, seq = start
+        next_id = (ms, seq + 1) if seq < MAX_STREAM_ID[1] else (ms + 1, 0)
+        return self.range(next_id, MAX_STREAM_ID, count)
+
+    def next_id(self, id: str) -> StreamID:
+        """
+        Resolve the ID given to XADD ("*", "<ms>-*" or "<ms>-<seq>") and check
+        it is greater than the last entry.
+        """
+        last_ms, last_seq = self.last_id
+        if id == "*":
+            ms = max(time.time_ns() // 1_000_000, last_ms)
+            if ms > last_ms or not self.length:
+                return (ms, 0)
+            # Past the last sequence number of a millisecond, like Redis's
+            # streamIncrID().
+            if last_seq < MAX_STREAM_ID[1]:
+                return (ms, last_seq + 1)
+            if ms < MAX_STREAM_ID[0]:
+                return (ms + 1, 0)
+            raise ValueError(
+                "ERR The stream has exhausted the last possible ID, "
+                "unable to add more items"
+            )
+        ms_str, _, seq_str = id.partition("-")
+        if seq_str == "*":
+            ms = parse_stream_id_part(ms_str)
+            if self.length and ms == last_ms:
+                # The last sequence number fails the check below.
+                new_id = (ms, min(last_seq + 1, MAX_STREAM_ID[1]))
+            else:
+                new_id = (ms, 1 if ms == 0 else 0)
+        else:
+            new_id = parse_stream_id(id)
+            if new_id == (0, 0):
+                raise ValueError(
+                    "ERR The ID specified in XADD must be greater than 0-0"
+                )
+        if self.length and new_id <= self.last_id:
+            raise ValueError(
+                "ERR The ID specified in XADD is equal or smaller than the target stream top item"
+            )
+        return new_id
+
+
+# Python type of a value -> Element.type. Strings are bytes, bytearray or
+# int, and every collection has the two encodings of app.datatypes.
+VALUE_TYPES: Final[dict[type, int]] = {
+    StreamEntries: STREAM,
+    ListpackList: LIST,
+    Quicklist: LIST,
+    ListpackSet: SET,
+    HashSet: SET,
+    ListpackZSet: ZSET,
+    SortedSet: ZSET,
+    ListpackHash: HASH,
+    HashTable: HASH,
+}
+# Encoding new collections start with.
+NEW_COLLECTIONS: Final[dict[int, type]] = {
+    LIST: ListpackList,
+    SET: ListpackSet,
+    ZSET: ListpackZSet,
+    HASH: ListpackHash,
+}
+
+
+def type_of_value(value) -> int:
+    return VALUE_TYPES.get(type(value), STRING)
+
+
+class Container:
+    def __init__(
+        self,
+        maxmemory: int = 0,
+        maxmemory_policy: str = "noeviction",
+        maxmemory_samples: int = 5,
+    ) -> None:
+        if maxmemory_policy not in MAXMEMORY_POLICIES:
+            raise ValueError(f"Unknown maxmemory policy {maxmemory_policy}")
         self.kv: dict[Any, Element] = {}
+        # Monotonic deadline in ms (see app.clock), only for keys with a TTL.
+        self.expires: dict[Any, int] = {}
+        # Min-heap of (expire_at, key) for keys with a TTL. Entries of keys that
+        # were overwritten or deleted are left in place and skipped when popped.
+        self.ttl_index: list[Tuple[int, Any]] = []
+        self.expired_keys = 0
+        self.expire_cycle_cpu_ms = 0.0
+        self.expire_cycle_last_us = 0
+        self.maxmemory = maxmemory
+        self.maxmemory_policy = maxmemory_policy
+        self.maxmemory_samples = maxmemory_samples
+        self.track_lru = maxmemory_policy.endswith("-lru")
+        self.track_lfu = maxmemory_policy.endswith("-lfu")
+        self.lru_clock = 0  # logical clock, ticks on every access
+        self.used_memory = 0  # estimate, see _sizeof()
+        self.evicted_keys = 0
+        # Snapshot of the eviction pool's keys that evictions sample from, see
+        # _sample_keys().
+        self.eviction_keys: list = []
+        self.evictions_since_snapshot = 0
+        # Called with every evicted key, before the write that needed the
+        # memory goes on, so that the deletion can be propagated first.
+        self.on_evict: Callable[[Any], None] | None = None
+        # Futures of blocked XREAD calls per stream key, resolved by XADD.
+        self.stream_waiters: dict[Any, set[asyncio.Future]] = {}
 
     def get(self, key):
-        if key not in self.kv.keys():
+        element = self.kv.get(key)
+        if element is None:
             return None
-        elif datetime.now() > self.kv[key].expire_at:
-            self.kv.pop(key)
+        elif self.expires and self._is_expired(key):
+            self._expire(key)
             return None
         else:
-            return self.kv[key].value
+            if self.track_lru:
+                self.lru_clock += 1
+                element.lru = self.lru_clock
+            elif self.track_lfu:
+                element.lru = Container._lfu_touch(element.lru)
+            return element.value
 
-    def set(
-        self, key, value, expire_at: datetime = datetime.max
-    ):  # expiry input is in ms
-        print(f"Set {key} = {value}, with expiry = {expire_at}")
-        if isinstance(value, StreamEntry):
-            if not Container._auto_populate(value.id) and not Container._less_than(
-                "0-0", value.id
+    def get_string(self, key) -> bytes | bytearray | None:
+        """
+        Like get(), but only for string keys. Strings are stored as bytes,
+        as an int once INCR and friends made them a counter, or as a
+        bytearray once APPEND or SETRANGE modified them in place.
+        """
+        value = self.get(key)
+        if value is None:
+            return None
+        if self.kv[key].type != STRING:
+            raise ValueError(WRONGTYPE)
+        if type(value) is int:
+            return b"%d" % value
+        return value
+
+    def mget(self, keys: list) -> list:
+        """MGET: None for missing keys and for keys that are not strings."""
+        values = []
+        for key in keys:
+            value = self.get(key)
+            if value is not None and self.kv[key].type != STRING:
+                value = None
+            elif type(value) is int:
+                value = b"%d" % value
+            values.append(value)
+        return values
+
+    def exists(self, key) -> bool:
+        return self.get(key) is not None
+
+    def strlen(self, key) -> int:
+        value = self.get_string(key)
+        return 0 if value is None else len(value)
+
+    def incr_by(self, key, delta: int) -> int:
+        """
+        INCRBY. The result is stored as an int, so a hot counter is parsed
+        once, when it was last set as a string, not on every increment.
+        """
+        element = self._typed_element(key, STRING)
+        value = 0
+        if element is not None:
+            value = element.value
+            if type(value) is not int:
+                value = string_to_int(value)
+        value += delta
+        if not INT64_MIN <= value <= INT64_MAX:
+            raise ValueError("ERR increment or decrement would overflow")
+        if element is None:
+            self.set(key, value)
+        else:
+            self._replace_value(element, value)
+        return value
+
+    def incr_by_float(self, key, delta: Decimal) -> bytes:
+        """INCRBYFLOAT. The result is stored as its string, like in Redis."""
+        element = self._typed_element(key, STRING)
+        current = Decimal(0)
+        if element is not None:
+            value = element.value
+            current = Decimal(value) if type(value) is int else string_to_decimal(value)
+        with localcontext() as context:
+            context.prec = 17  # significant digits Redis prints
+            value = current + delta
+        if not value.is_finite() or abs(value) > MAX_DOUBLE:
+            raise ValueError("ERR increment would produce NaN or Infinity")
+        result = format_decimal(value)
+        if element is None:
+            self.set(key, result)
+        else:
+            self._replace_value(element, result)
+        return result
+
+    def append(self, key, data: bytes) -> int:
+        """
+        APPEND. The value becomes a bytearray, so repeated appends extend it
+        in place instead of copying the whole string every time.
+        """
+        element = self._typed_element(key, STRING)
+        if self.maxmemory:
+            new_key = KEY_OVERHEAD + len(key) if element is None else 0
+            self._ensure_memory(len(data) + new_key)
+            element = self._typed_element(key, STRING)  # may have been evicted
+        if element is None:
+            self._insert(key, self._new_element(bytearray(data)))
+            return len(data)
+        value = self._mutable_value(element)
+        value += data
+        self.used_memory += len(data)
+        return len(value)
+
+    def set_range(self, key, offset: int, data: bytes) -> int:
+        """
+        SETRANGE: overwrite the value from offset in place, padding it with
+        zero bytes if it is shorter.
+        """
+        if offset + len(data) > MAX_STRING_SIZE:
+            raise ValueError(
+                "ERR string exceeds maximum allowed size (proto-max-bulk-len)"
+            )
+        if not data:
+            return self.strlen(key)
+        element = self._typed_element(key, STRING)
+        if self.maxmemory:
+            if element is None:
+                incoming = KEY_OVERHEAD + len(key) + offset + len(data)
+            else:
+                incoming = offset + len(data) - self.strlen(key)
+            self._ensure_memory(max(incoming, 0))
+            element = self._typed_element(key, STRING)  # may have been evicted
+        if element is None:
+            self._insert(key, self._new_element(bytearray(offset) + data))
+            return offset + len(data)
+        value = self._mutable_value(element)
+        growth = max(offset + len(data) - len(value), 0)
+        if growth:
+            value += bytes(growth)
+            self.used_memory += growth
+        value[offset : offset + len(data)] = data
+        return len(value)
+
+    def get_range(self, key, start: int, end: int) -> bytes:
+        """GETRANGE: bytes start to end included, negative from the end."""
+        value = self.get_string(key)
+        if value is None:
+            return b""
+        length = len(value)
+        if start < 0 and end < 0 and start > end:
+            return b""
+        start = max(start + length if start < 0 else start, 0)
+        end = min(max(end + length if end < 0 else end, 0), length - 1)
+        if start > end:
+            return b""
+        return bytes(value[start : end + 1])
+
+    def _typed_element(self, key, type: int) -> Element | None:
+        """Element of a live key of type, None if there is none."""
+        if self.get(key) is None:
+            return None
+        element = self.kv[key]
+        if element.type != type:
+            raise ValueError(WRONGTYPE)
+        return element
+
+    def _replace_value(self, element: Element, value) -> None:
+        """Swap the value of a key in place, keeping its TTL and LRU data."""
+        old_size = Container._sizeof(element.value)
+        self.used_memory += Container._sizeof(value) - old_size
+        element.value = value
+
+    def _mutable_value(self, element: Element) -> bytearray:
+        value = element.value
+        if type(value) is not bytearray:
+            if type(value) is int:
+                value = b"%d" % value
+            self._replace_value(element, bytearray(value))
+        return element.value
+
+    def _collection(self, key, type: int):
+        """Value of a live key of type, None if there is none."""
+        element = self._typed_element(key, type)
+        return None if element is None else element.value
+
+    def _writable_collection(self, key, type: int, strings: list) -> Element:
+        """
+        Element of the collection at key to add strings to, created empty if
+        there is none and converted first if they are too long for its
+        compact encoding. Callers add the size of what they store to
+        used_memory, call _fit() for the entry count and delete the key if
+        it ends up empty.
+        """
+        element = self._typed_element(key, type)
+        if self.maxmemory:
+            incoming = sum(map(len, strings)) + 16 * len(strings)
+            if element is None:
+                incoming += KEY_OVERHEAD + len(key)
+            self._ensure_memory(incoming)
+            element = self._typed_element(key, type)  # may have been evicted
+        if element is None:
+            element = self._new_element(NEW_COLLECTIONS[type](), type)
+            self._insert(key, element)
+        self._fit(element, strings)
+        return element
+
+    def _fit(self, element: Element, strings: Iterable = ()) -> None:
+        """Convert a compact collection that outgrew its encoding."""
+        value = element.value
+        if isinstance(value, Listpack) and not value.fits(strings):
+            self._replace_value(element, value.expand())
+
+    def _drop_if_empty(self, key, element: Element) -> None:
+        # Like Redis, a collection only exists while it has entries.
+        if not element.value:
+            self._delete(key)
+
+    def list_push(self, key, items: list, left: bool) -> int:
+        """LPUSH or RPUSH. Returns the new length."""
+        element = self._writable_collection(key, LIST, items)
+        element.value.push(items, left)
+        self.used_memory += element.value.ITEM_OVERHEAD * len(items) + sum(
+            map(len, items)
+        )
+        self._fit(element)
+        return len(element.value)
+
+    def list_pop(self, key, count: int, left: bool) -> list | None:
+        """LPOP or RPOP of up to count items, None if there is no list."""
+        element = self._typed_element(key, LIST)
+        if element is None:
+            return None
+        items = element.value.pop_items(count, left)
+        self.used_memory -= element.value.ITEM_OVERHEAD * len(items) + sum(
+            map(len, items)
+        )
+        self._drop_if_empty(key, element)
+        return items
+
+    def llen(self, key) -> int:
+        items = self._collection(key, LIST)
+        return 0 if items is None else len(items)
+
+    def lrange(self, key, start: int, end: int) -> list:
+        items = self._collection(key, LIST)
+        if items is None:
+            return []
+        return items.range(*index_span(start, end, len(items)))
+
+    def lindex(self, key, index: int) -> bytes | None:
+        items = self._collection(key, LIST)
+        if items is None or not -len(items) <= index < len(items):
+            return None
+        return items[index]
+
+    def sadd(self, key, members: list) -> int:
+        """SADD. Returns the number of members that were not in the set."""
+        element = self._writable_collection(key, SET, members)
+        members_set = element.value
+        added = 0
+        for member in members:
+            if members_set.add_member(member):
+                added += 1
+                self.used_memory += members_set.ITEM_OVERHEAD + len(member)
+        self._fit(element)
+        return added
+
+    def srem(self, key, members: list) -> int:
+        element = self._typed_element(key, SET)
+        if element is None:
+            return 0
+        members_set = element.value
+        removed = 0
+        for member in members:
+            if members_set.remove_member(member):
+                removed += 1
+                self.used_memory -= members_set.ITEM_OVERHEAD + len(member)
+        self._drop_if_empty(key, element)
+        return removed
+
+    def sismember(self, key, member) -> bool:
+        members = self._collection(key, SET)
+        return members is not None and member in members
+
+    def smembers(self, key) -> list:
+        members = self._collection(key, SET)
+        return [] if members is None else list(members)
+
+    def scard(self, key) -> int:
+        members = self._collection(key, SET)
+        return 0 if members is None else len(members)
+
+    def hset(self, key, items: list, nx: bool = False) -> int:
+        """
+        HSET of field, value, field, value, ..., or HSETNX with nx. Returns
+        the number of fields that were new.
+        """
+        element = self._writable_collection(key, HASH, items)
+        hash = element.value
+        added = 0
+        for i in range(0, len(items), 2):
+            field, value = items[i], items[i + 1]
+            if nx and hash.get(field) is not None:
+                continue
+            old = hash.put(field, value)
+            if old is None:
+                added += 1
+                self.used_memory += hash.ITEM_OVERHEAD + len(field) + len(value)
+            else:
+                self.used_memory += len(value) - len(old)
+        self._fit(element)
+        return added
+
+    def hget(self, key, field) -> bytes | None:
+        hash = self._collection(key, HASH)
+        return None if hash is None else hash.get(field)
+
+    def hmget(self, key, fields: list) -> list:
+        hash = self._collection(key, HASH)
+        if hash is None:
+            return [None] * len(fields)
+        return [hash.get(field) for field in fields]
+
+    def hdel(self, key, fields: list) -> int:
+        element = self._typed_element(key, HASH)
+        if element is None:
+            return 0
+        hash = element.value
+        removed = 0
+        for field in fields:
+            old = hash.delete(field)
+            if old is not None:
+                removed += 1
+                self.used_memory -= hash.ITEM_OVERHEAD + len(field) + len(old)
+        self._drop_if_empty(key, element)
+        return removed
+
+    def hlen(self, key) -> int:
+        hash = self._collection(key, HASH)
+        return 0 if hash is None else len(hash)
+
+    def hgetall(self, key) -> list:
+        """Fields and values, interleaved."""
+        hash = self._collection(key, HASH)
+        if hash is None:
+            return []
+        return list(itertools.chain.from_iterable(hash.items()))
+
+    def hkeys(self, key) -> list:
+        hash = self._collection(key, HASH)
+        return [] if hash is None else list(hash.keys())
+
+    def hvals(self, key) -> list:
+        hash = self._collection(key, HASH)
+        return [] if hash is None else list(hash.values())
+
+    def hincr_by(self, key, field, delta: int) -> int:
+        hash = self._collection(key, HASH)
+        old = None if hash is None else hash.get(field)
+        value = delta
+        if old is not None:
+            try:
+                value += string_to_int(old)
+            except ValueError:
+                raise ValueError("ERR hash value is not an integer")
+        if not INT64_MIN <= value <= INT64_MAX:
+            raise ValueError("ERR increment or decrement would overflow")
+        self.hset(key, [field, b"%d" % value])
+        return value
+
+    def zadd(
+        self,
+        key,
+        items: list[Tuple[float, Any]],
+        condition: bytes | None = None,
+        comparison: bytes | None = None,
+    ) -> Tuple[int, int]:
+        """
+        ZADD of (score, member) items, with condition b"NX" or b"XX" and
+        comparison b"GT" or b"LT". Returns the numbers of members added and
+        of members whose score changed.
+        """
+        element = self._writable_collection(key, ZSET, [item[1] for item in items])
+        zset = element.value
+        added = changed = 0
+        for score, member in items:
+            old = zset.get(member)
+            if old is None:
+                if condition == b"XX":
+                    continue
+                added += 1
+                self.used_memory += zset.ITEM_OVERHEAD + len(member)
+            elif (
+                condition == b"NX"
+                or old == score
+                or (comparison == b"GT" and score <= old)
+                or (comparison == b"LT" and score >= old)
             ):
-                raise ValueError(
-                    f"ERR The ID specified in XADD must be greater than 0-0"
-                )
-            if key in self.kv.keys():
-                id_of_last_entry = (
-                    self.kv[key].value.entries[len(self.kv[key].value.entries) - 1].id
-                )
-                value.id = Container._get_next_if_auto(value.id, id_of_last_entry)
-                print(f"New value.id", value.id)
-                if not Container._less_than(id_of_last_entry, value.id):
-                    raise ValueError(
-                        f"ERR The ID specified in XADD is equal or smaller than the target stream top item"
-                    )
-                self.kv[key].value.entries.append(value)
+                continue
             else:
-                value.id = Container._get_next_if_auto(value.id)
-                print(f"New value.id", value.id)
-                self.kv[key] = Element(
-                    value=StreamEntries(entries=[value]),
-                    created_at=datetime.now(),
-                    expire_at=expire_at,
-                    type="stream",
+                changed += 1
+            zset.put(member, score)
+        self._fit(element)
+        self._drop_if_empty(key, element)
+        return added, changed
+
+    def zincr_by(
+        self,
+        key,
+        delta: float,
+        member,
+        condition: bytes | None = None,
+        comparison: bytes | None = None,
+    ) -> float | None:
+        """ZINCRBY, or ZADD INCR with its options: None if they skip it."""
+        zset = self._collection(key, ZSET)
+        old = None if zset is None else zset.get(member)
+        if condition == (b"NX" if old is not None else b"XX"):
+            return None
+        score = delta if old is None else old + delta
+        if math.isnan(score):
+            raise ValueError("ERR resulting score is not a number (NaN)")
+        if old is not None and (
+            (comparison == b"GT" and score <= old)
+            or (comparison == b"LT" and score >= old)
+        ):
+            return None
+        self.zadd(key, [(score, member)])
+        return score
+
+    def zrem(self, key, members: list) -> int:
+        element = self._typed_element(key, ZSET)
+        if element is None:
+            return 0
+        zset = element.value
+        removed = 0
+        for member in members:
+            if zset.delete(member) is not None:
+                removed += 1
+                self.used_memory -= zset.ITEM_OVERHEAD + len(member)
+        self._drop_if_empty(key, element)
+        return removed
+
+    def zscore(self, key, member) -> float | None:
+        zset = self._collection(key, ZSET)
+        return None if zset is None else zset.get(member)
+
+    def zrank(self, key, member) -> int | None:
+        zset = self._collection(key, ZSET)
+        return None if zset is None else zset.rank(member)
+
+    def zcard(self, key) -> int:
+        zset = self._collection(key, ZSET)
+        return 0 if zset is None else len(zset)
+
+    def zrange(self, key, start: int, end: int, reverse: bool = False) -> list:
+        """(member, score) pairs ranked start to end included."""
+        zset = self._collection(key, ZSET)
+        if zset is None:
+            return []
+        start, stop = index_span(start, end, len(zset))
+        if reverse:
+            pairs = zset.range_by_rank(len(zset) - stop, len(zset) - start)
+            return pairs[::-1]
+        return zset.range_by_rank(start, stop)
+
+    def zrange_by_score(
+        self,
+        key,
+        low: ScoreBound,
+        high: ScoreBound,
+        reverse: bool = False,
+        offset: int = 0,
+        count: int = -1,
+    ) -> list:
+        """
+        (member, score) pairs scored low to high, highest first if reverse,
+        skipping offset of them and returning at most count if it is not
+        negative, like ZRANGE BYSCORE ... LIMIT.
+        """
+        zset = self._collection(key, ZSET)
+        if zset is None or offset < 0:
+            return []
+        start, stop = zset.score_span(low, high)
+        if reverse:
+            stop = max(stop - offset, start)
+            if count >= 0:
+                start = max(start, stop - count)
+            return zset.range_by_rank(start, stop)[::-1]
+        start = min(start + offset, stop)
+        if count >= 0:
+            stop = min(stop, start + count)
+        return zset.range_by_rank(start, stop)
+
+    def zcount(self, key, low: ScoreBound, high: ScoreBound) -> int:
+        zset = self._collection(key, ZSET)
+        if zset is None:
+            return 0
+        start, stop = zset.score_span(low, high)
+        return stop - start
+
+    def encoding_of(self, key) -> str | None:
+        """OBJECT ENCODING."""
+        value = self.get(key)
+        if value is None:
+            return None
+        element_type = self.kv[key].type
+        if element_type == STREAM:
+            return "stream"
+        elif element_type != STRING:
+            return value.ENCODING
+        elif type(value) is int:
+            return "int"
+        # Redis embeds strings of up to 44 bytes in their object.
+        return "embstr" if type(value) is bytes and len(value) <= 44 else "raw"
+
+    def type_of(self, key) -> str:
+        if self.get(key) is None:
+            return "none"
+        return TYPE_NAMES[self.kv[key].type]
+
+    def _is_expired(self, key, now: int | None = None) -> bool:
+        expire_at = self.expires.get(key)
+        if expire_at is None:
+            return False
+        return (now_ms() if now is None else now) > expire_at
+
+    def _expire(self, key) -> None:
+        self._delete(key)
+        self.expired_keys += 1
+
+    def _delete(self, key) -> None:
+        element = self.kv.pop(key)
+        self.used_memory -= KEY_OVERHEAD + len(key) + Container._sizeof(element.value)
+        if self.expires.pop(key, None) is not None:
+            self.used_memory -= TTL_OVERHEAD
+
+    @staticmethod
+    def _sizeof(value) -> int:
+        if isinstance(value, (bytes, bytearray, str)):
+            return len(value)
+        elif isinstance(value, int):
+            return 8
+        elif isinstance(value, StreamEntry):
+            return 64 + sum(len(item) for item in value.data)
+        elif isinstance(value, StreamEntries):
+            return sum(Container._sizeof(entry) for entry in value)
+        elif isinstance(value, (ListpackHash, HashTable)):
+            return sum(
+                value.ITEM_OVERHEAD + len(field) + len(item)
+                for field, item in value.items()
+            )
+        elif isinstance(value, (ListpackZSet, SortedSet)):
+            return sum(value.ITEM_OVERHEAD + len(member) for member, _ in value.items())
+        elif isinstance(value, (Listpack, Quicklist, HashSet)):
+            return sum(value.ITEM_OVERHEAD + len(item) for item in value)
+        return sys.getsizeof(value)
+
+    def _ensure_memory(self, incoming: int) -> None:
+        """
+        Evict keys according to maxmemory_policy until incoming bytes fit.
+        Raises the OOM error when nothing can be evicted.
+        """
+        while self.used_memory + incoming > self.maxmemory:
+            if self.maxmemory_policy == "noeviction" or not self._evict_one():
+                raise ValueError(
+                    "OOM command not allowed when used memory > 'maxmemory'."
                 )
+
+    def _evict_one(self) -> bool:
+        """
+        Approximated LRU/LFU/TTL eviction: look at maxmemory_samples random
+        keys and evict the best candidate among them.
+        """
+        volatile = self.maxmemory_policy.startswith("volatile-")
+        pool = self.expires if volatile else self.kv
+        if not pool:
+            return False
+        samples = self._sample_keys(pool)
+        if self.maxmemory_policy == "volatile-ttl":
+            victim = min(samples, key=self.expires.__getitem__)
+        elif self.track_lfu:
+            victim = min(
+                samples, key=lambda k: Container._lfu_decayed(self.kv[k].lru) & 0xFF
+            )
         else:
-            self.kv[key] = Element(
-                value=value, created_at=datetime.now(), expire_at=expire_at
+            victim = min(samples, key=lambda k: self.kv[k].lru)
+        self._delete(victim)
+        self.evicted_keys += 1
+        self.evictions_since_snapshot += 1
+        if self.on_evict is not None:
+            self.on_evict(victim)
+        return True
+
+    def _sample_keys(self, pool: dict) -> list:
+        """
+        Up to maxmemory_samples random keys of the non-empty pool.
+
+        Dicts cannot be indexed, so the keys are drawn with random.sample from
+        a snapshot list of the pool's keys, skipping the ones deleted since.
+        The snapshot is retaken once a quarter of it was evicted or the pool
+        size drifted by half, which keeps a draw O(samples) amortized.
+        """
+        keys = self.eviction_keys
+        drifted = not len(keys) // 2 <= len(pool) <= 2 * len(keys)
+        if drifted or self.evictions_since_snapshot * 4 >= len(keys):
+            keys = self._snapshot_eviction_keys(pool)
+        samples = random.sample(keys, min(self.maxmemory_samples, len(keys)))
+        samples = [key for key in samples if key in pool]
+        if not samples:
+            keys = self._snapshot_eviction_keys(pool)
+            samples = random.sample(keys, min(self.maxmemory_samples, len(keys)))
+        return samples
+
+    def _snapshot_eviction_keys(self, pool: dict) -> list:
+        self.eviction_keys = list(pool)
+        self.evictions_since_snapshot = 0
+        return self.eviction_keys
+
+    @staticmethod
+    def _lfu_decayed(lfu: int) -> int:
+        minutes = (now_ms() // 60000) & 0xFFFF
+        elapsed = (minutes - (lfu >> 8)) & 0xFFFF
+        counter = max((lfu & 0xFF) - elapsed // LFU_DECAY_MINUTES, 0)
+        return (minutes << 8) | counter
+
+    @staticmethod
+    def _lfu_touch(lfu: int) -> int:
+        lfu = Container._lfu_decayed(lfu)
+        counter = lfu & 0xFF
+        if counter < 255:
+            base = max(counter - LFU_INIT_VAL, 0)
+            if random.random() < 1.0 / (base * LFU_LOG_FACTOR + 1):
+                counter += 1
+        return (lfu & ~0xFF) | counter
+
+    def _new_element(self, value, type: int = STRING) -> Element:
+        if self.track_lru:
+            self.lru_clock += 1
+            return Element(value=value, type=type, lru=self.lru_clock)
+        elif self.track_lfu:
+            return Element(
+                value=value,
+                type=type,
+                lru=(((now_ms() // 60000) & 0xFFFF) << 8) | LFU_INIT_VAL,
             )
+        return Element(value=value, type=type)
+
+    def active_expire_cycle(self, time_limit_ms: float) -> int:
+        """
+        Evict keys whose TTL passed, earliest deadline first, for at most
+        time_limit_ms. Returns the number of evicted keys.
+        """
+        start = time.perf_counter()
+        deadline = start + time_limit_ms / 1000
+        now = now_ms()
+        expired = 0
+        checked = 0
+        while self.ttl_index and now > self.ttl_index[0][0]:
+            expire_at, key = heapq.heappop(self.ttl_index)
+            if self.expires.get(key) == expire_at:
+                self._expire(key)
+                expired += 1
+            checked += 1
+            if checked % 64 == 0 and time.perf_counter() > deadline:
+                break
+        if len(self.ttl_index) > 2 * len(self.expires) + 1024:
+            # Mostly stale entries, rebuild from the live deadlines.
+            self.ttl_index = [
+                (expire_at, key) for key, expire_at in self.expires.items()
+            ]
+            heapq.heapify(self.ttl_index)
+        elapsed = time.perf_counter() - start
+        self.expire_cycle_cpu_ms += elapsed * 1000
+        self.expire_cycle_last_us = int(elapsed * 1_000_000)
+        return expired
+
+    async def active_expire(self, hz: int = 10) -> None:
+        """
+        Run active_expire_cycle hz times per second, each bounded to 25% of the
+        period like Redis's slow expire cycle.
+        """
+        period = 1 / hz
+        while True:
+            await asyncio.sleep(period)
+            self.active_expire_cycle(period * 1000 * 0.25)
+
+    def set(
+        self, key, value, expire_at: int | None = None, keep_ttl: bool = False
+    ):  # expiry is a deadline from app.clock.now_ms()
+        logger.debug("Set %r, with expiry %s", key, expire_at)
+        if self.maxmemory:
+            incoming = Container._sizeof(value)
+            if key not in self.kv:
+                incoming += KEY_OVERHEAD + len(key)
+            if expire_at is not None and key not in self.expires:
+                incoming += TTL_OVERHEAD
+            self._ensure_memory(incoming)
+        self._insert(key, self._new_element(value, type_of_value(value)))
+        if not keep_ttl:
+            self._set_expiry(key, expire_at)
+
+    def bulk_load(
+        self, records: Iterable[Tuple[Any, Any, int | None]], expire_offset: int = 0
+    ) -> int:
+        """
+        Insert (key, value, expiry) records from a trusted source such as an
+        RDB file into an empty keyspace; expiry + expire_offset is the
+        deadline. There is no maxmemory check or logging per key, the TTL
+        heap is built once at the end and the cyclic GC is paused, since the
+        millions of new objects would otherwise trigger it over and over.
+        Keys that already expired are skipped. Returns the number loaded.
+        """
+        kv = self.kv
+        expires = self.expires
+        tracked = self.track_lru or self.track_lfu
+        new_element = self._new_element
+        now = now_ms()
+        used = 0
+        loaded = 0
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for key, value, expiry in records:
+                if expiry is not None:
+                    expire_at = expiry + expire_offset
+                    if expire_at < now:
+                        continue
+                    expires[key] = expire_at
+                    used += TTL_OVERHEAD
+                if type(value) is bytes:
+                    kv[key] = new_element(value) if tracked else Element(value)
+                    used += KEY_OVERHEAD + len(key) + len(value)
+                else:
+                    kv[key] = new_element(value, type_of_value(value))
+                    used += KEY_OVERHEAD + len(key) + Container._sizeof(value)
+                loaded += 1
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.used_memory += used
+        self.ttl_index = [(expire_at, key) for key, expire_at in expires.items()]
+        heapq.heapify(self.ttl_index)
+        return loaded
+
+    def flushall(self) -> None:
+        self.kv = {}
+        self.expires = {}
+        self.ttl_index = []
+        self.used_memory = 0
+
+    def xadd(self, key, id: str, data: list) -> StreamID:
+        """Append an entry to the stream at key, creating it if needed."""
+        stream = self.get(key)
+        if stream is not None and not isinstance(stream, StreamEntries):
+            raise ValueError(WRONGTYPE)
+        new_id = (stream or StreamEntries()).next_id(id)
+        entry_size = 64 + sum(len(item) for item in data)
+        if self.maxmemory:
+            self._ensure_memory(
+                entry_size + (KEY_OVERHEAD + len(key) if stream is None else 0)
+            )
+            stream = self.get(key)  # may have been evicted
+        if stream is None:
+            stream = StreamEntries()
+            self._insert(key, self._new_element(stream, STREAM))
+        stream.append(new_id, data)
+        self.used_memory += entry_size
+        waiters = self.stream_waiters.pop(key, None)
+        if waiters is not None:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+        return new_id
+
+    def add_stream_waiter(self, keys: list) -> asyncio.Future:
+        """Future resolved by the next XADD to any of keys."""
+        waiter = asyncio.get_running_loop().create_future()
+        for key in keys:
+            self.stream_waiters.setdefault(key, set()).add(waiter)
+        return waiter
+
+    def remove_stream_waiter(self, keys: list, waiter: asyncio.Future) -> None:
+        for key in keys:
+            waiters = self.stream_waiters.get(key)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self.stream_waiters[key]
+
+    def _insert(self, key, element: Element) -> None:
+        old = self.kv.get(key)
+        if old is None:
+            self.used_memory += KEY_OVERHEAD + len(key)
+        else:
+            self.used_memory -= Container._sizeof(old.value)
+        self.kv[key] = element
+        self.used_memory += Container._sizeof(element.value)
+
+    def _set_expiry(self, key, expire_at: int | None) -> None:
+        if expire_at is None:
+            if self.expires and self.expires.pop(key, None) is not None:
+                self.used_memory -= TTL_OVERHEAD
+        else:
+            if key not in self.expires:
+                self.used_memory += TTL_OVERHEAD
+            self.expires[key] = expire_at
+            heapq.heappush(self.ttl_index, (expire_at, key))
 
     def keys(self) -> list:
         res = []
-        for k in self.kv.keys():
-            if datetime.now() > self.kv[k].expire_at:
-                self.kv.pop(k)
+        now = now_ms()
+        for k in list(self.kv.keys()):
+            if self._is_expired(k, now):
+                self._expire(k)
             else:
                 res.append(k)
         return res
 
+    def delete(self, keys: list) -> int:
+        """DEL: remove the keys, returning how many existed."""
+        deleted = 0
+        for key in keys:
+            if self.exists(key):
+                self._delete(key)
+                deleted += 1
+        return deleted
+
     def get_after_excl(
-        self, stream_keys: list, starts: list[StreamEntry]
+        self, stream_keys: list, starts: list[StreamID | None]
     ) -> Tuple[list, int]:
+        """
+        Entries after starts[i] for every stream key. A start of None ("$")
+        is replaced in place by the stream's current last ID.
+        """
         entry_length = 0
         res = []
         for idx, stream_key in enumerate(stream_keys):
-            if stream_key in self.keys():
-                entries = self.get(stream_key).entries
-                if starts[idx].id == "$":
-                    # then set it to max so far
-                    if len(entries) == 0:
-                        starts[idx].id = "0-0"
-                    else:
-                        starts[idx] = entries[len(entries) - 1]
-                start_excl = bisect.bisect_right(
-                    entries,
-                    StreamEntries.key_func(starts[idx]),
-                    key=StreamEntries.key_func,
-                )
-                entry_length += len(entries) - start_excl
-                res.append([stream_key, entries[start_excl:]])
+            stream = self.get(stream_key)
+            if stream is None:
+                if starts[idx] is None:
+                    starts[idx] = (0, 0)
+                continue
+            if not isinstance(stream, StreamEntries):
+                raise ValueError(WRONGTYPE)
+            if starts[idx] is None:
+                starts[idx] = stream.last_id
+            entries = stream.after(starts[idx])
+            if entries:
+                entry_length += len(entries)
+                res.append([stream_key, entries])
 
         return res, entry_length
-
-    @staticmethod
-    def _auto_populate(id: str) -> bool:
-        components = id.split("-")
-        if components[0] == "*" or components[1] == "*":
-            return True
-        return False
-
-    @staticmethod
-    def _get_next_if_auto(id: str, id_of_last_entry: str | None = None) -> str:
-        components = id.split("-")
-        if components[0] == "*":
-            import time
-
-            components[0] = str(int(time.time() * 1000.0))
-            components.append("*")
-
-        if components[1] == "*":
-            if (
-                id_of_last_entry is not None
-                and id_of_last_entry.split("-")[0] == components[0]
-            ):
-                last_seq = int(id_of_last_entry.split("-")[1])
-            elif components[0] == "0":
-                last_seq = 0
-            else:
-                last_seq = -1
-            components[1] = str(last_seq + 1)
-            return "-".join(components)
-        else:
-            return id
-
-    @staticmethod
-    def _less_than(a: str, b: str) -> bool:  # True if a < b
-        ac = a.split("-")
-        bc = b.split("-")
-        for i in range(2):
-            ac[i] = int(ac[i])
-            bc[i] = int(bc[i])
-        if ac[0] < bc[0]:
-            return True
-        elif ac[0] == bc[0] and ac[1] < bc[1]:
-            return True
-        return False
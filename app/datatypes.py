@@ -0,0 +1,452 @@
+"""
+Encodings of the collection types. Like in Redis, a small list, set, sorted
+set or hash is kept in a compact encoding, a flat Python list standing in for
+Redis's listpack, and converted to its full structure once it outgrows the
+*_MAX_LISTPACK_* limits below. A list costs 56 bytes plus a pointer per item
+where a dict or set starts at about 200 bytes, so millions of tiny
+collections stay cheap, and scanning up to 128 entries is as fast as hashing.
+
+Both encodings of a type have the same methods, so Container does not care
+which one a key uses. Conversion only goes from compact to full, as in Redis.
+"""
+
+import bisect
+import itertools
+from collections import deque
+from operator import itemgetter
+from typing import Final, Iterable, Iterator, Tuple
+
+# Redis's defaults for the *-max-listpack-entries and -value settings. Lists
+# have no per-item limit in Redis, items over its 8 kB listpack nodes get a
+# node of their own, so that is used as the limit for lists.
+LIST_MAX_LISTPACK_ENTRIES: Final[int] = 128
+LIST_MAX_LISTPACK_VALUE: Final[int] = 8192
+SET_MAX_LISTPACK_ENTRIES: Final[int] = 128
+SET_MAX_LISTPACK_VALUE: Final[int] = 64
+ZSET_MAX_LISTPACK_ENTRIES: Final[int] = 128
+ZSET_MAX_LISTPACK_VALUE: Final[int] = 64
+HASH_MAX_LISTPACK_ENTRIES: Final[int] = 128
+HASH_MAX_LISTPACK_VALUE: Final[int] = 64
+
+# (score, exclusive) end of a score range, e.g. (1.5, True) for "(1.5".
+ScoreBound = Tuple[float, bool]
+
+
+class Listpack(list):
+    """Base of the compact encodings."""
+
+    __slots__ = ()
+    ENCODING: Final[str] = "listpack"
+    MAX_ENTRIES: int
+    MAX_VALUE: int
+    # Estimated bytes per entry besides its strings, see Container._sizeof().
+    ITEM_OVERHEAD: int
+
+    def fits(self, items: Iterable = ()) -> bool:
+        """Whether the compact encoding can also take the strings in items."""
+        return len(self) <= self.MAX_ENTRIES and all(
+            len(item) <= self.MAX_VALUE for item in items
+        )
+
+    def expand(self):
+        """The full encoding of the same collection."""
+        raise NotImplementedError
+
+
+class ListpackList(Listpack):
+    """Small list."""
+
+    __slots__ = ()
+    MAX_ENTRIES: Final[int] = LIST_MAX_LISTPACK_ENTRIES
+    MAX_VALUE: Final[int] = LIST_MAX_LISTPACK_VALUE
+    ITEM_OVERHEAD: Final[int] = 8
+
+    def expand(self) -> "Quicklist":
+        return Quicklist(self)
+
+    def push(self, items: list, left: bool) -> None:
+        if left:  # LPUSH a b c leaves c b a in front
+            self[:0] = items[::-1]
+        else:
+            self.extend(items)
+
+    def pop_items(self, count: int, left: bool) -> list:
+        if left:
+            items = self[:count]
+            del self[:count]
+        else:
+            items = self[: -count - 1 : -1] if count else []
+            del self[len(self) - len(items) :]
+        return items
+
+    def range(self, start: int, stop: int) -> list:
+        return self[start:stop]
+
+
+class Quicklist(deque):
+    """
+    Large list. CPython's deque is a doubly linked list of 64-item blocks,
+    the layout of Redis's quicklist of listpacks, so pushes and pops at
+    either end are O(1) without moving any other item.
+    """
+
+    __slots__ = ()
+    ENCODING: Final[str] = "quicklist"
+    ITEM_OVERHEAD: Final[int] = 16
+
+    def push(self, items: list, left: bool) -> None:
+        if left:
+            self.extendleft(items)
+        else:
+            self.extend(items)
+
+    def pop_items(self, count: int, left: bool) -> list:
+        pop = self.popleft if left else self.pop
+        return [pop() for _ in range(min(count, len(self)))]
+
+    def range(self, start: int, stop: int) -> list:
+        # Walk from the nearer end, so the tail of a long list is cheap too.
+        length = len(self)
+        if start > length - stop:
+            tail = itertools.islice(reversed(self), length - stop, length - start)
+            return list(tail)[::-1]
+        return list(itertools.islice(self, start, stop))
+
+
+class ListpackSet(Listpack):
+    """Small set as the list of its members, in insertion order."""
+
+    __slots__ = ()
+    MAX_ENTRIES: Final[int] = SET_MAX_LISTPACK_ENTRIES
+    MAX_VALUE: Final[int] = SET_MAX_LISTPACK_VALUE
+    ITEM_OVERHEAD: Final[int] = 8
+
+    def expand(self) -> "HashSet":
+        return HashSet(self)
+
+    def add_member(self, member) -> bool:
+        if member in self:
+            return False
+        self.append(member)
+        return True
+
+    def remove_member(self, member) -> bool:
+        try:
+            self.remove(member)
+        except ValueError:
+            return False
+        return True
+
+
+class HashSet(set):
+    """Large set."""
+
+    __slots__ = ()
+    ENCODING: Final[str] = "hashtable"
+    ITEM_OVERHEAD: Final[int] = 16
+
+    def add_member(self, member) -> bool:
+        if member in self:
+            return False
+        self.add(member)
+        return True
+
+    def remove_member(self, member) -> bool:
+        if member not in self:
+            return False
+        self.remove(member)
+        return True
+
+
+class ListpackHash(Listpack):
+    """
+    Small hash as [field1, value1, field2, value2, ...]. len() counts the
+    fields, like for a dict.
+    """
+
+    __slots__ = ()
+    MAX_ENTRIES: Final[int] = HASH_MAX_LISTPACK_ENTRIES
+    MAX_VALUE: Final[int] = HASH_MAX_LISTPACK_VALUE
+    ITEM_OVERHEAD: Final[int] = 16
+
+    def __len__(self) -> int:
+        return list.__len__(self) // 2
+
+    def expand(self) -> "HashTable":
+        return HashTable(self.items())
+
+    def _find(self, field) -> int:
+        """Position of field, -1 if absent. A value may equal it too."""
+        i = 0
+        try:
+            while True:
+                i = self.index(field, i)
+                if not i & 1:
+                    return i
+                i += 1
+        except ValueError:
+            return -1
+
+    def get(self, field, default=None):
+        i = self._find(field)
+        return default if i < 0 else self[i + 1]
+
+    def put(self, field, value):
+        """Set field, returning its previous value or None."""
+        i = self._find(field)
+        if i < 0:
+            self.extend((field, value))
+            return None
+        old = self[i + 1]
+        self[i + 1] = value
+        return old
+
+    def delete(self, field):
+        """Remove field, returning its value or None."""
+        i = self._find(field)
+        if i < 0:
+            return None
+        old = self[i + 1]
+        del self[i : i + 2]
+        return old
+
+    def keys(self) -> list:
+        return self[0::2]
+
+    def values(self) -> list:
+        return self[1::2]
+
+    def items(self) -> Iterator[tuple]:
+        return zip(self[0::2], self[1::2])
+
+
+class HashTable(dict):
+    """Large hash as field -> value."""
+
+    __slots__ = ()
+    ENCODING: Final[str] = "hashtable"
+    ITEM_OVERHEAD: Final[int] = 32
+
+    def put(self, field, value):
+        old = self.get(field)
+        self[field] = value
+        return old
+
+    def delete(self, field):
+        return self.pop(field, None)
+
+
+class ListpackZSet(Listpack):
+    """
+    Small sorted set as [member1, score1, member2, score2, ...] ordered by
+    (score, member). Members are bytes and scores floats, which never compare
+    equal, so list.index() finds a member directly. len() counts the members.
+    """
+
+    __slots__ = ()
+    MAX_ENTRIES: Final[int] = ZSET_MAX_LISTPACK_ENTRIES
+    MAX_VALUE: Final[int] = ZSET_MAX_LISTPACK_VALUE
+    ITEM_OVERHEAD: Final[int] = 40  # two pointers and the float
+
+    def __len__(self) -> int:
+        return list.__len__(self) // 2
+
+    def expand(self) -> "SortedSet":
+        return SortedSet(self.items())
+
+    def get(self, member, default=None):
+        try:
+            return self[self.index(member) + 1]
+        except ValueError:
+            return default
+
+    def put(self, member, score: float) -> float | None:
+        """Set the score of member, returning its previous one or None."""
+        old = self.delete(member)
+        scores = self[1::2]
+        lo = bisect.bisect_left(scores, score)
+        hi = bisect.bisect_right(scores, score, lo)
+        i = lo + bisect.bisect_left(self[2 * lo : 2 * hi : 2], member)
+        self[2 * i : 2 * i] = (member, score)
+        return old
+
+    def delete(self, member) -> float | None:
+        try:
+            i = self.index(member)
+        except ValueError:
+            return None
+        score = self[i + 1]
+        del self[i : i + 2]
+        return score
+
+    def rank(self, member) -> int | None:
+        try:
+            return self.index(member) // 2
+        except ValueError:
+            return None
+
+    def range_by_rank(self, start: int, stop: int) -> list[tuple]:
+        """(member, score) pairs with start <= rank < stop."""
+        items = self[2 * start : 2 * stop]
+        return list(zip(items[0::2], items[1::2]))
+
+    def score_span(self, low: ScoreBound, high: ScoreBound) -> Tuple[int, int]:
+        """Ranks start to stop (excluded) of the members scored low to high."""
+        scores = self[1::2]
+        start = (bisect.bisect_right if low[1] else bisect.bisect_left)(scores, low[0])
+        stop = (bisect.bisect_left if high[1] else bisect.bisect_right)(scores, high[0])
+        return start, max(start, stop)
+
+    def items(self) -> Iterator[tuple]:
+        return zip(self[0::2], self[1::2])
+
+
+class ScoreIndex:
+    """
+    The (score, member) pairs of a SortedSet in order. Like StreamEntries,
+    they are kept in chunks of at most CHUNK_SIZE along with the last pair of
+    every chunk, so an insert or delete is two bisects and a memmove within
+    one chunk, and a rank adds up the lengths of the chunks before it.
+    """
+
+    CHUNK_SIZE: Final[int] = 512
+
+    __slots__ = ("chunks", "lasts")
+
+    def __init__(self, pairs: list) -> None:
+        """pairs must be sorted. Chunks start half full, to leave room."""
+        half = self.CHUNK_SIZE // 2
+        self.chunks = [pairs[i : i + half] for i in range(0, len(pairs), half)]
+        self.lasts = [chunk[-1] for chunk in self.chunks]
+
+    def add(self, pair: tuple) -> None:
+        i = bisect.bisect_left(self.lasts, pair)
+        if i == len(self.chunks):  # after the last pair
+            if not self.chunks:
+                self.chunks.append([])
+                self.lasts.append(pair)
+            i -= 1
+            self.lasts[i] = pair
+        chunk = self.chunks[i]
+        bisect.insort(chunk, pair)
+        if len(chunk) > self.CHUNK_SIZE:
+            half = len(chunk) // 2
+            self.chunks[i : i + 1] = [chunk[:half], chunk[half:]]
+            self.lasts[i : i + 1] = [chunk[half - 1], chunk[-1]]
+
+    def remove(self, pair: tuple) -> None:
+        i = bisect.bisect_left(self.lasts, pair)
+        chunk = self.chunks[i]
+        del chunk[bisect.bisect_left(chunk, pair)]
+        if chunk:
+            self.lasts[i] = chunk[-1]
+        else:
+            del self.chunks[i]
+            del self.lasts[i]
+
+    def rank(self, pair: tuple) -> int:
+        i = bisect.bisect_left(self.lasts, pair)
+        return sum(map(len, self.chunks[:i])) + bisect.bisect_left(self.chunks[i], pair)
+
+    def rank_of_score(self, score: float, after: bool) -> int:
+        """Rank of the first pair scored at least score, or over it if after."""
+        find = bisect.bisect_right if after else bisect.bisect_left
+        score_of = itemgetter(0)
+        i = find(self.lasts, score, key=score_of)
+        if i == len(self.chunks):
+            return sum(map(len, self.chunks))
+        return sum(map(len, self.chunks[:i])) + find(
+            self.chunks[i], score, key=score_of
+        )
+
+    def slice(self, start: int, stop: int) -> list[tuple]:
+        """Pairs with start <= rank < stop."""
+        res = []
+        offset = 0
+        for chunk in self.chunks:
+            if offset + len(chunk) > start:
+                res += chunk[max(start - offset, 0) : stop - offset]
+                if offset + len(chunk) >= stop:
+                    break
+            offset += len(chunk)
+        return res
+
+
+class SortedSet(dict):
+    """
+    Large sorted set as member -> score, plus its ScoreIndex for ranks and
+    ranges, the pair Redis keeps as a dict and a skiplist.
+    """
+
+    __slots__ = ("index",)
+    ENCODING: Final[str] = "skiplist"
+    ITEM_OVERHEAD: Final[int] = 120  # dict entry, float and index tuple
+
+    def __init__(self, items: Iterable[tuple] = ()) -> None:
+        super().__init__(items)
+        self.index = ScoreIndex(
+            sorted((score, member) for member, score in self.items())
+        )
+
+    def put(self, member, score: float) -> float | None:
+        old = self.get(member)
+        if old is not None:
+            self.index.remove((old, member))
+        self[member] = score
+        self.index.add((score, member))
+        return old
+
+    def delete(self, member) -> float | None:
+        score = self.pop(member, None)
+        if score is not None:
+            self.index.remove((score, member))
+        return score
+
+    def rank(self, member) -> int | None:
+        score = self.get(member)
+        return None if score is None else self.index.rank((score, member))
+
+    def range_by_rank(self, start: int, stop: int) -> list[tuple]:
+        return [(member, score) for score, member in self.index.slice(start, stop)]
+
+    def score_span(self, low: ScoreBound, high: ScoreBound) -> Tuple[int, int]:
+        start = self.index.rank_of_score(low[0], after=low[1])
+        stop = self.index.rank_of_score(high[0], after=not high[1])
+        return start, max(start, stop)
+
+
+def _compact(value: Listpack):
+    """value, or its full encoding if it is too large to stay compact."""
+    strings = value[0::2] if type(value) is ListpackZSet else value
+    return value if value.fits(strings) else value.expand()
+
+
+def make_list(items: Iterable) -> ListpackList | Quicklist:
+    return _compact(ListpackList(items))
+
+
+def make_set(members: Iterable) -> ListpackSet | HashSet:
+    members = HashSet(members)
+    if len(members) > SET_MAX_LISTPACK_ENTRIES:
+        return members
+    return _compact(ListpackSet(members))
+
+
+def make_hash(items: Iterable[tuple]) -> ListpackHash | HashTable:
+    hash = HashTable(items)
+    if len(hash) > HASH_MAX_LISTPACK_ENTRIES:
+        return hash
+    return _compact(ListpackHash(itertools.chain.from_iterable(hash.items())))
+
+
+def make_zset(items: Iterable[tuple]) -> ListpackZSet | SortedSet:
+    """Sorted set of (member, score) items."""
+    scores = dict(items)
+    if len(scores) > ZSET_MAX_LISTPACK_ENTRIES:
+        return SortedSet(scores.items())
+    pairs = sorted((score, member) for member, score in scores.items())
+    return _compact(
+        ListpackZSet(
+            itertools.chain.from_iterable((member, score) for score, member in pairs)
+        )
+    )
@@ -0,0 +1,46 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+from typing import Final, TextIO
+
+# Redis's log levels. verbose sits between debug and notice.
+VERBOSE: Final[int] = 15
+LOG_LEVELS: Final[dict[str, int]] = {
+    "debug": logging.DEBUG,
+    "verbose": VERBOSE,
+    "notice": logging.INFO,
+    "warning": logging.WARNING,
+}
+DEFAULT_LOG_LEVEL: Final[str] = "notice"
+
+logging.addLevelName(VERBOSE, "VERBOSE")
+
+
+def setup_logging(
+    level: str = DEFAULT_LOG_LEVEL, stream: TextIO | None = None
+) -> logging.handlers.QueueListener:
+    """
+    Send the records of the "app" loggers through a queue to a thread that
+    writes them, so the event loop never blocks on stdout. Records below
+    level are dropped by the isEnabledFor() check before any formatting,
+    so use lazy %-style arguments: logger.debug("Received %s", frame).
+    """
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(
+        logging.Formatter(
+            "%(process)d:%(asctime)s.%(msecs)03d %(levelname)s %(message)s",
+            "%d %b %Y %H:%M:%S",
+        )
+    )
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)  # flush what is still queued
+
+    logger = logging.getLogger("app")
+    logger.handlers = [logging.handlers.QueueHandler(records)]
+    logger.setLevel(LOG_LEVELS[level])
+    logger.propagate = False
+    return listener
@@ -3,13 +3,44 @@ import argparse
 import asyncio
 from pathlib import Path
 
+from app.aof import APPENDFSYNC_POLICIES, DEFAULT_APPENDFILENAME
+from app.container import MAXMEMORY_POLICIES
+from app.log import DEFAULT_LOG_LEVEL, LOG_LEVELS, setup_logging
+from app.output_buffer import DEFAULT_HIGH_WATER
+from app.replication import (
+    DEFAULT_BACKLOG_SIZE,
+    DEFAULT_REPL_PING_REPLICA_PERIOD,
+    DEFAULT_REPLICA_OUTPUT_LIMIT,
+    OutputBufferLimit,
+)
 from app.server import Server
 
 
-async def main():
-    # You can use print statements as follows for debugging, they'll be visible when running tests.
-    print("Logs from your program will appear here!")
+def parse_memory(value: str) -> int:
+    """Parse a Redis-style memory size such as 1024, 100kb, 64mb or 1gb."""
+    units = {"b": 1, "kb": 1024, "mb": 1024**2, "gb": 1024**3}
+    value = value.strip().lower()
+    for unit in ("kb", "mb", "gb", "b"):
+        if value.endswith(unit):
+            return int(value[: -len(unit)]) * units[unit]
+    return int(value)
+
+
+def parse_output_buffer_limit(value: str) -> OutputBufferLimit:
+    """Parse a client-output-buffer-limit such as "replica 256mb 64mb 60"."""
+    parts = value.split()
+    if len(parts) != 4 or parts[0] not in ("replica", "slave"):
+        raise argparse.ArgumentTypeError(
+            "expected 'replica <hard limit> <soft limit> <soft seconds>'"
+        )
+    return OutputBufferLimit(
+        hard=parse_memory(parts[1]),
+        soft=parse_memory(parts[2]),
+        soft_seconds=int(parts[3]),
+    )
+
 
+async def main():
     parser = argparse.ArgumentParser(
         description="Simple server that uses a specified port."
     )
@@ -35,7 +66,88 @@ async def main():
         help="Name of db file",
     )
 
+    parser.add_argument(
+        "--output-high-water",
+        type=int,
+        default=DEFAULT_HIGH_WATER,
+        help="Bytes of pending replies per connection before flushing early",
+    )
+
+    parser.add_argument(
+        "--repl-backlog-size",
+        type=parse_memory,
+        default=DEFAULT_BACKLOG_SIZE,
+        help="Size of the replication backlog used for partial resync",
+    )
+    parser.add_argument(
+        "--repl-ping-replica-period",
+        type=int,
+        default=DEFAULT_REPL_PING_REPLICA_PERIOD,
+        help="Seconds between the PINGs a master sends its replicas",
+    )
+    parser.add_argument(
+        "--replica-max-lag-ms",
+        type=int,
+        default=0,
+        help="Refuse reads on a replica lagging more than this behind its "
+        "master; keep it above the master's --repl-ping-replica-period. "
+        "0 means no limit",
+    )
+    parser.add_argument(
+        "--client-output-buffer-limit",
+        type=parse_output_buffer_limit,
+        default=DEFAULT_REPLICA_OUTPUT_LIMIT,
+        help="Disconnect replicas whose output buffer grows past the limits. "
+        'Usage: "replica <hard limit> <soft limit> <soft seconds>", 0 disables '
+        "a limit",
+    )
+    parser.add_argument(
+        "--maxmemory",
+        type=parse_memory,
+        default=0,
+        help="Memory limit for the keyspace, e.g. 100mb. 0 means no limit",
+    )
+    parser.add_argument(
+        "--maxmemory-policy",
+        type=str,
+        choices=MAXMEMORY_POLICIES,
+        default="noeviction",
+        help="How keys are evicted when maxmemory is reached",
+    )
+
+    parser.add_argument(
+        "--appendonly",
+        type=str,
+        choices=("yes", "no"),
+        default="no",
+        help="Log every write command to the append-only file",
+    )
+    parser.add_argument(
+        "--appendfsync",
+        type=str,
+        choices=APPENDFSYNC_POLICIES,
+        default="everysec",
+        help="When the append-only file is synced to disk",
+    )
+    parser.add_argument(
+        "--appendfilename",
+        type=str,
+        default=DEFAULT_APPENDFILENAME,
+        help="Name of the append-only file, in --dir",
+    )
+
+    parser.add_argument(
+        "--loglevel",
+        type=str,
+        choices=tuple(LOG_LEVELS),
+        default=DEFAULT_LOG_LEVEL,
+        help="Least severe messages that are logged",
+    )
+
     args = parser.parse_args()
+    if args.repl_ping_replica_period < 1:
+        parser.error("--repl-ping-replica-period must be at least 1")
+    setup_logging(args.loglevel)
 
     role = "master"
     master_host = None
@@ -51,6 +163,16 @@ async def main():
         master_port=master_port,
         dir=args.dir,
         rdbfilename=args.dbfilename,
+        output_high_water=args.output_high_water,
+        repl_backlog_size=args.repl_backlog_size,
+        maxmemory=args.maxmemory,
+        maxmemory_policy=args.maxmemory_policy,
+        appendonly=args.appendonly == "yes",
+        appendfsync=args.appendfsync,
+        appendfilename=args.appendfilename,
+        repl_ping_replica_period=args.repl_ping_replica_period,
+        replica_max_lag_ms=args.replica_max_lag_ms,
+        replica_output_limit=args.client_output_buffer_limit,
     )
 
     await server.start()
@@ -0,0 +1,39 @@
+import asyncio
+from typing import Final
+
+DEFAULT_HIGH_WATER: Final[int] = 64 * 1024  # bytes
+
+
+class OutputBuffer:
+    """
+    Per-connection reply buffer.
+
+    Replies produced while processing one read chunk are accumulated and sent
+    with a single writelines()/drain() instead of one write and one drain per
+    command. Once more than high_water bytes are pending the caller is expected
+    to flush early, which applies backpressure from slow readers.
+    """
+
+    def __init__(
+        self, writer: asyncio.StreamWriter, high_water: int = DEFAULT_HIGH_WATER
+    ) -> None:
+        self.writer = writer
+        self.high_water = high_water
+        self.chunks: list[bytes] = []
+        self.size = 0
+        writer.transport.set_write_buffer_limits(high=high_water)
+
+    def write(self, data: bytes) -> None:
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+
+    def over_high_water(self) -> bool:
+        return self.size >= self.high_water
+
+    async def flush(self) -> None:
+        if self.chunks:
+            self.writer.writelines(self.chunks)
+            self.chunks = []
+            self.size = 0
+        await self.writer.drain()
@@ -1,135 +1,493 @@
+import math
+import mmap
+import struct
 from pathlib import Path
-from typing import Any, Tuple
+from typing import Any, Iterator, Tuple
+
+from app.container import StreamEntries
+from app.datatypes import (
+    HashSet,
+    HashTable,
+    ListpackHash,
+    ListpackList,
+    ListpackSet,
+    ListpackZSet,
+    Quicklist,
+    SortedSet,
+    make_hash,
+    make_list,
+    make_set,
+    make_zset,
+)
+
+# Opcodes, see RdbWriter.
+OPCODE_SLOT_INFO = 0xF4
+OPCODE_FUNCTION2 = 0xF5
+OPCODE_IDLE = 0xF8
+OPCODE_FREQ = 0xF9
+OPCODE_AUX = 0xFA
+OPCODE_RESIZEDB = 0xFB
+OPCODE_EXPIRETIME_MS = 0xFC
+OPCODE_EXPIRETIME = 0xFD
+OPCODE_SELECTDB = 0xFE
+OPCODE_EOF = 0xFF
+
+# Value types.
+TYPE_STRING = 0
+TYPE_LIST = 1
+TYPE_SET = 2
+TYPE_ZSET = 3
+TYPE_HASH = 4
+TYPE_ZSET_2 = 5
+TYPE_MODULE = 6
+TYPE_MODULE_2 = 7
+TYPE_HASH_ZIPMAP = 9
+TYPE_LIST_ZIPLIST = 10
+TYPE_SET_INTSET = 11
+TYPE_ZSET_ZIPLIST = 12
+TYPE_HASH_ZIPLIST = 13
+TYPE_LIST_QUICKLIST = 14
+TYPE_STREAM_LISTPACKS = 15
+TYPE_HASH_LISTPACK = 16
+TYPE_ZSET_LISTPACK = 17
+TYPE_LIST_QUICKLIST_2 = 18
+TYPE_STREAM_LISTPACKS_2 = 19
+TYPE_SET_LISTPACK = 20
+TYPE_STREAM_LISTPACKS_3 = 21
+
+QUICKLIST_NODE_PLAIN = 1
+
+
+class RdbParseError(ValueError):
+    """A malformed or unsupported RDB file, with the offset it was found at."""
+
+    def __init__(self, message: str, offset: int) -> None:
+        super().__init__(f"{message} at offset {offset}")
+        self.offset = offset
 
 
 class RdbParser:
     """
-    Class to parse the redis db
+    Streaming RDB reader. The file is memory-mapped and read through a
+    memoryview, and records() yields one key at a time, so loading never
+    holds more than the current value besides the mapping itself.
     """
 
     def __init__(self, file_loc: Path):
         self.index = 0
-        if not file_loc.is_file():
-            self.data = b""
-        else:
-            file = open(file_loc, "rb")
-            self.data = file.read()
-            file.close()
-        self.length = len(self.data)
-        self.kv = {}
-
-    def inc(self) -> None:
-        self.index += 1
+        self.version: int | None = None
+        self.aux: dict[bytes, bytes] = {}
+        self._mmap: mmap.mmap | None = None
+        self.data = memoryview(b"")
+        if file_loc.is_file() and file_loc.stat().st_size:
+            with open(file_loc, "rb") as file:
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = memoryview(self._mmap)
 
-    def curr(self) -> bytes | None:
-        return self.data[self.index : self.index + 1]
+    def __enter__(self) -> "RdbParser":
+        return self
 
-    def get(self, i) -> bytes:
-        return self.data[i : i + 1]
+    def __exit__(self, *exc) -> None:
+        self.close()
 
-    def substring(self, i, j) -> bytes:
-        return self.data[i:j]
+    def close(self) -> None:
+        self.data.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
 
-    def next(self, l: int) -> bytes:
-        return self.substring(self.index, self.index + l)
+    def records(self) -> Iterator[Tuple[bytes, Any, int | None]]:
+        """Yield (key, value, expiry as unix time in ms or None) per key."""
+        data = self.data
+        if not len(data):
+            return
+        if data[:5] != b"REDIS":
+            raise RdbParseError("Not an RDB file", 0)
+        end = len(data)
+        expiry = None
+        start = 5
+        try:
+            self.version = int(data[5:9].tobytes())
+            self.index = 9
+            while self.index < end:
+                start = self.index
+                opcode = data[self.index]
+                self.index += 1
+                if opcode == TYPE_STRING:  # the common case, without parse_value()
+                    key = self.parse_string()
+                    yield key, self.parse_string(), expiry
+                    expiry = None
+                elif opcode == OPCODE_AUX:
+                    key = self.parse_string()
+                    self.aux[key] = self.parse_string()
+                elif opcode == OPCODE_SELECTDB:
+                    self.parse_length()
+                elif opcode == OPCODE_RESIZEDB:
+                    self.parse_length()
+                    self.parse_length()
+                elif opcode == OPCODE_EXPIRETIME_MS:
+                    expiry = int.from_bytes(self.read(8), byteorder="little")
+                elif opcode == OPCODE_EXPIRETIME:
+                    expiry = int.from_bytes(self.read(4), byteorder="little") * 1000
+                elif opcode == OPCODE_IDLE:
+                    self.parse_length()
+                elif opcode == OPCODE_FREQ:
+                    self.index += 1
+                elif opcode == OPCODE_SLOT_INFO:
+                    for _ in range(3):  # slot id, keys and expires in the slot
+                        self.parse_length()
+                elif opcode == OPCODE_FUNCTION2:
+                    self.parse_string()  # function libraries are not supported
+                elif opcode == OPCODE_EOF:
+                    break
+                else:
+                    key = self.parse_string()
+                    yield key, self.parse_value(opcode), expiry
+                    expiry = None
+            else:
+                raise RdbParseError("Unexpected end of file", end)
+        except RdbParseError:
+            raise
+        except (IndexError, ValueError, struct.error) as err:
+            # Truncated or corrupt data inside the record starting at start.
+            raise RdbParseError(f"Bad record ({err})", start) from err
+
+    def parse(self) -> dict:
+        """All records as {key: {"value": ..., "expiry": ...}}."""
+        return {
+            key: {"value": value, "expiry": expiry}
+            for key, value, expiry in self.records()
+        }
 
-    def read(self, l: int) -> bytes:
-        value = self.substring(self.index, self.index + l)
+    def read(self, l: int) -> memoryview:
+        value = self.data[self.index : self.index + l]
         self.index += l
         return value
 
-    def parse(self) -> dict:
-        if not self.data:
-            return self.kv
-        self.parse_redis()
-        version = self.parse_version()
-        print(f"RDB Version: {version}")
-        while self.has_next():
-            # print(self.data[self.index:])
-            print(self.data[self.index :])
-            if self.curr()[0] == 0xFA:
-                self.inc()
-                length, key = self.parse_string()
-                length, value = self.parse_string()
-                print(f"{key}: {value}")
-            elif self.curr()[0] == 0xFE:
-                self.inc()
-                database_number = self.parse_length()
-                print(f"Database Number: {database_number}")
-            elif self.curr()[0] == 0xFB:
-                self.inc()
-                db_ht_size = self.parse_length()
-                print(f"Database hash table size: {db_ht_size}")
-                exp_ht_size = self.parse_length()
-                print(f"Expiry hash table size: {exp_ht_size}")
-            elif self.curr()[0] == 0xFC:
-                self.inc()
-                expiry = int.from_bytes(self.read(8), byteorder="little")
-                value_type = self.read(1)[0]
-                length, key = self.parse_string()
-                length, value = self.parse_value(value_type)
-                print(f"Key:{key}, Value:{value}")
-                self.kv[key] = {"value": value, "expiry": expiry}
-            elif self.curr()[0] == 0xFF:
-                self.inc()
-                checksum = self.read(8)
-                break
+    def parse_string(self) -> bytes:
+        # 6 and 14 bit lengths are inlined, they cover nearly all keys.
+        i = self.index
+        b = self.data[i]
+        if b < 0x40:
+            self.index = i + 1 + b
+            return self.data[i + 1 : self.index].tobytes()
+        elif b < 0x80:
+            self.index = i + 2 + (((b & 0x3F) << 8) | self.data[i + 1])
+            return self.data[i + 2 : self.index].tobytes()
+        elif b >> 6 != 0b11:
+            length = self.parse_length()
+            self.index += length
+            return self.data[self.index - length : self.index].tobytes()
+        self.index += 1
+        # Integer encoded strings are still strings to clients.
+        if b == 0xC0:
+            return b"%d" % struct.unpack("<b", self.read(1))[0]
+        elif b == 0xC1:
+            return b"%d" % struct.unpack("<h", self.read(2))[0]
+        elif b == 0xC2:
+            return b"%d" % struct.unpack("<i", self.read(4))[0]
+        elif b == 0xC3:
+            compressed_len = self.parse_length()
+            length = self.parse_length()
+            return RdbParser.lzf_decompress(self.read(compressed_len), length)
+        raise RdbParseError(f"Unknown string encoding {b:#x}", i)
+
+    def parse_value(self, value_type: int) -> Any:
+        if value_type == TYPE_STRING:
+            return self.parse_string()
+        elif value_type == TYPE_LIST:
+            return make_list(self.parse_string() for _ in range(self.parse_length()))
+        elif value_type == TYPE_SET:
+            return make_set(self.parse_string() for _ in range(self.parse_length()))
+        elif value_type in (TYPE_ZSET, TYPE_ZSET_2):
+            items = []
+            for _ in range(self.parse_length()):
+                member = self.parse_string()
+                if value_type == TYPE_ZSET_2:
+                    items.append((member, struct.unpack("<d", self.read(8))[0]))
+                else:
+                    items.append((member, self.parse_double()))
+            return make_zset(items)
+        elif value_type == TYPE_HASH:
+            return make_hash(
+                (self.parse_string(), self.parse_string())
+                for _ in range(self.parse_length())
+            )
+        elif value_type == TYPE_LIST_QUICKLIST_2:
+            items = []
+            for _ in range(self.parse_length()):
+                container = self.parse_length()
+                node = self.parse_string()
+                if container == QUICKLIST_NODE_PLAIN:
+                    items.append(node)
+                else:
+                    items += map(RdbParser.as_bytes, RdbParser.parse_listpack(node))
+            return make_list(items)
+        elif value_type == TYPE_LIST_QUICKLIST:
+            items = []
+            for _ in range(self.parse_length()):
+                ziplist = RdbParser.parse_ziplist(self.parse_string())
+                items += map(RdbParser.as_bytes, ziplist)
+            return make_list(items)
+        elif value_type in COMPACT_TYPES:
+            # A single string holding a ziplist, listpack, intset or zipmap.
+            decode, build = COMPACT_TYPES[value_type]
+            return build(decode(self.parse_string()))
+        elif value_type in (
+            TYPE_STREAM_LISTPACKS,
+            TYPE_STREAM_LISTPACKS_2,
+            TYPE_STREAM_LISTPACKS_3,
+        ):
+            return self.parse_stream(value_type)
+        elif value_type in (TYPE_MODULE, TYPE_MODULE_2):
+            raise RdbParseError("Module values are not supported", self.index)
+        raise RdbParseError(f"Unknown value type {value_type}", self.index)
+
+    def parse_double(self) -> float:
+        """Score of a TYPE_ZSET: length-prefixed ASCII or a special value."""
+        length = self.data[self.index]
+        self.index += 1
+        if length == 253:
+            return math.nan
+        elif length == 254:
+            return math.inf
+        elif length == 255:
+            return -math.inf
+        return float(self.read(length).tobytes())
+
+    def parse_stream(self, value_type: int = TYPE_STREAM_LISTPACKS) -> StreamEntries:
+        """
+        Streams in any of the listpack layouts. Consumer groups are read
+        and dropped since they are not supported.
+        """
+        stream = StreamEntries()
+        for _ in range(self.parse_length()):
+            master_ms, master_seq = struct.unpack(">QQ", self.parse_string())
+            items = iter(RdbParser.parse_listpack(self.parse_string()))
+            count, deleted, num_master_fields = next(items), next(items), next(items)
+            master_fields = [
+                RdbParser.as_bytes(next(items)) for _ in range(num_master_fields)
+            ]
+            next(items)  # master entry terminator
+            for _ in range(count + deleted):
+                flags = next(items)
+                id = (master_ms + next(items), master_seq + next(items))
+                data = []
+                if flags & 2:  # same fields as the master entry
+                    for field in master_fields:
+                        data += (field, RdbParser.as_bytes(next(items)))
+                else:
+                    for _ in range(2 * next(items)):
+                        data.append(RdbParser.as_bytes(next(items)))
+                next(items)  # lp-count
+                if not flags & 1:  # deleted
+                    stream.append(id, data)
+        stream.length = self.parse_length()
+        stream.last_id = (self.parse_length(), self.parse_length())
+        if value_type != TYPE_STREAM_LISTPACKS:
+            # First ID, max deleted entry ID and entries added.
+            for _ in range(5):
+                self.parse_length()
+        for _ in range(self.parse_length()):
+            self.parse_string()  # group name
+            self.parse_length()  # last delivered ID
+            self.parse_length()
+            if value_type != TYPE_STREAM_LISTPACKS:
+                self.parse_length()  # entries read
+            for _ in range(self.parse_length()):  # pending entries
+                self.index += 16 + 8  # ID and delivery time
+                self.parse_length()  # delivery count
+            for _ in range(self.parse_length()):  # consumers
+                self.parse_string()  # name
+                self.index += 8  # seen time
+                if value_type == TYPE_STREAM_LISTPACKS_3:
+                    self.index += 8  # active time
+                pending = self.parse_length()  # consumer PEL: IDs only
+                self.index += pending * 16
+        return stream
+
+    @staticmethod
+    def as_bytes(item: bytes | int) -> bytes:
+        return item if isinstance(item, bytes) else b"%d" % item
+
+    # Collections get the encoding their size calls for, see app.datatypes.
+    @staticmethod
+    def as_list(items: list[bytes | int]) -> ListpackList | Quicklist:
+        return make_list(map(RdbParser.as_bytes, items))
+
+    @staticmethod
+    def as_set(items: list[bytes | int]) -> ListpackSet | HashSet:
+        return make_set(map(RdbParser.as_bytes, items))
+
+    @staticmethod
+    def pairs_to_dict(items: list[bytes | int]) -> ListpackHash | HashTable:
+        return make_hash(
+            (RdbParser.as_bytes(items[i]), RdbParser.as_bytes(items[i + 1]))
+            for i in range(0, len(items), 2)
+        )
+
+    @staticmethod
+    def pairs_to_zset(items: list[bytes | int]) -> ListpackZSet | SortedSet:
+        return make_zset(
+            (RdbParser.as_bytes(items[i]), float(items[i + 1]))
+            for i in range(0, len(items), 2)
+        )
+
+    @staticmethod
+    def parse_ziplist(data: bytes) -> list[bytes | int]:
+        items: list[bytes | int] = []
+        i = 10  # total bytes, tail offset and number of entries
+        while data[i] != 0xFF:
+            i += 1 if data[i] < 254 else 5  # previous entry length
+            b = data[i]
+            if b < 0x40:  # 6 bit string length
+                i += 1 + b
+                items.append(data[i - b : i])
+            elif b < 0x80:  # 14 bit string length
+                length = ((b & 0x3F) << 8) | data[i + 1]
+                i += 2 + length
+                items.append(data[i - length : i])
+            elif b < 0xC0:  # 32 bit string length
+                length = struct.unpack_from(">I", data, i + 1)[0]
+                i += 5 + length
+                items.append(data[i - length : i])
+            elif 0xF1 <= b <= 0xFD:  # 4 bit immediate int
+                items.append((b & 0x0F) - 1)
+                i += 1
             else:
-                value_type = self.read(1)[0]
-                length, key = self.parse_string()
-                length, value = self.parse_value(value_type)
-                print(f"Key:{key}, Value:{value}")
-                self.kv[key] = {"value": value, "expiry": None}
-        return self.kv
-
-    def parse_redis(self):
-        if self.next(5) == b"REDIS":
-            self.index += 5
-
-    def parse_version(self):
-        value = int(self.read(4))
-        return value
+                size = {0xC0: 2, 0xD0: 4, 0xE0: 8, 0xF0: 3, 0xFE: 1}[b]
+                items.append(
+                    int.from_bytes(data[i + 1 : i + 1 + size], "little", signed=True)
+                )
+                i += 1 + size
+        return items
+
+    @staticmethod
+    def parse_zipmap(data: bytes) -> list[bytes]:
+        items: list[bytes] = []
+        i = 1  # number of entries, only valid below 254
+        while data[i] != 0xFF:
+            for is_value in (False, True):
+                length = data[i]
+                if length == 254:
+                    length = struct.unpack_from("<I", data, i + 1)[0]
+                    i += 4
+                i += 1
+                free = 0
+                if is_value:
+                    free = data[i]
+                    i += 1
+                items.append(data[i : i + length])
+                i += length + free
+        return items
 
-    def parse_string(self) -> Tuple[int, Any]:
-        length = self.parse_length()
-        if length != -1:
-            string = self.read(length)
-            return 0, string.decode()
-        else:
-            self.index -= 1
-            b = ord(self.curr()) & 0b00111111
-            self.inc()
-            if b == 0b00:
-                val = int.from_bytes(self.read(1), byteorder="little")
-            elif b == 0b01:
-                val = int.from_bytes(self.read(2), byteorder="little")
-            elif b == 0b10:
-                val = int.from_bytes(self.read(4), byteorder="little")
+    @staticmethod
+    def parse_intset(data: bytes) -> list[int]:
+        encoding, length = struct.unpack_from("<II", data)
+        fmt = {2: "h", 4: "i", 8: "q"}[encoding]
+        return list(struct.unpack_from(f"<{length}{fmt}", data, 8))
+
+    @staticmethod
+    def lzf_decompress(data: memoryview, length: int) -> bytes:
+        """
+        LZF as used by Redis for compressed strings. Literal runs and
+        non-overlapping back references are copied as slices; overlapping
+        references repeat the period they point back to.
+        """
+        out = bytearray()
+        i = 0
+        end = len(data)
+        while i < end:
+            ctrl = data[i]
+            i += 1
+            if ctrl < 32:  # literal run of ctrl + 1 bytes
+                out += data[i : i + ctrl + 1]
+                i += ctrl + 1
+                continue
+            ref_len = ctrl >> 5
+            if ref_len == 7:
+                ref_len += data[i]
+                i += 1
+            ref_len += 2
+            start = len(out) - ((ctrl & 0x1F) << 8) - data[i] - 1
+            i += 1
+            if start < 0:
+                raise ValueError("Invalid LZF back reference")
+            if start + ref_len <= len(out):
+                out += out[start : start + ref_len]
             else:
-                raise NotImplementedError
-            return 0, val
+                period = out[start:]
+                out += (period * (ref_len // len(period) + 1))[:ref_len]
+        if len(out) != length:
+            raise ValueError("Invalid LZF string length")
+        return bytes(out)
 
-    def parse_value(self, value_type):
-        if value_type == 0x00:
-            return self.parse_string()
-        else:
-            raise NotImplementedError
+    @staticmethod
+    def parse_listpack(data: bytes) -> list[bytes | int]:
+        items: list[bytes | int] = []
+        i = 6  # total bytes and number of elements
+        while data[i] != 0xFF:
+            start = i
+            b = data[i]
+            if b < 0x80:  # 7 bit uint
+                items.append(b)
+                i += 1
+            elif b < 0xC0:  # 6 bit string length
+                i += 1 + (b & 0x3F)
+                items.append(data[start + 1 : i])
+            elif b < 0xE0:  # 13 bit int
+                val = ((b & 0x1F) << 8) | data[i + 1]
+                items.append(val - (1 << 13) if val >= 1 << 12 else val)
+                i += 2
+            elif b < 0xF0:  # 12 bit string length
+                length = ((b & 0x0F) << 8) | data[i + 1]
+                i += 2 + length
+                items.append(data[i - length : i])
+            elif b == 0xF0:  # 32 bit string length
+                length = struct.unpack_from("<I", data, i + 1)[0]
+                i += 5 + length
+                items.append(data[i - length : i])
+            else:  # 16, 24, 32 or 64 bit int
+                size = {0xF1: 2, 0xF2: 3, 0xF3: 4, 0xF4: 8}[b]
+                items.append(
+                    int.from_bytes(data[i + 1 : i + 1 + size], "little", signed=True)
+                )
+                i += 1 + size
+            i += RdbParser.backlen_size(i - start)
+        return items
+
+    @staticmethod
+    def backlen_size(entry_len: int) -> int:
+        """Bytes taken by a listpack entry's backlen, as in lpEncodeBacklen()."""
+        for size, limit in enumerate((127, 16382, 2097150, 268435454), start=1):
+            if entry_len <= limit:
+                return size
+        return 5
 
     def parse_length(self) -> int:
-        b = ord(self.curr())
-        self.inc()
+        b = self.data[self.index]
+        self.index += 1
         val = b >> 6
-        length = 0b00
         if val == 0b00:
-            length = (b & 0b00111111).to_bytes(1, byteorder="little")
+            return b & 0b00111111
         elif val == 0b01:
-            length = (b & 0b00111111).to_bytes(1, byteorder="little") + self.curr()
-            self.inc()
-        elif val == 0b10:
-            length = self.read(4)
-        else:
-            return -1
-        return int.from_bytes(length, byteorder="little")
-
-    def has_next(self) -> bool:
-        return self.index < self.length
+            self.index += 1
+            return ((b & 0b00111111) << 8) | self.data[self.index - 1]
+        elif b == 0x80:
+            return int.from_bytes(self.read(4), byteorder="big")
+        elif b == 0x81:
+            return int.from_bytes(self.read(8), byteorder="big")
+        raise ValueError(f"Invalid length encoding {b:#x}")
+
+
+# Value type -> (decoder of the single string value, constructor).
+COMPACT_TYPES = {
+    TYPE_HASH_ZIPMAP: (RdbParser.parse_zipmap, RdbParser.pairs_to_dict),
+    TYPE_LIST_ZIPLIST: (RdbParser.parse_ziplist, RdbParser.as_list),
+    TYPE_SET_INTSET: (RdbParser.parse_intset, RdbParser.as_set),
+    TYPE_ZSET_ZIPLIST: (RdbParser.parse_ziplist, RdbParser.pairs_to_zset),
+    TYPE_HASH_ZIPLIST: (RdbParser.parse_ziplist, RdbParser.pairs_to_dict),
+    TYPE_HASH_LISTPACK: (RdbParser.parse_listpack, RdbParser.pairs_to_dict),
+    TYPE_ZSET_LISTPACK: (RdbParser.parse_listpack, RdbParser.pairs_to_zset),
+    TYPE_SET_LISTPACK: (RdbParser.parse_listpack, RdbParser.as_set),
+}
@@ -0,0 +1,418 @@
+import asyncio
+import copy
+import os
+import struct
+import tempfile
+import time
+import traceback
+from collections import deque
+from pathlib import Path
+from typing import Any, Final, Iterable, Iterator, Tuple
+
+from app.clock import unix_ms_from_deadline
+from app.container import Container, Element, StreamEntries
+from app.datatypes import (
+    HashSet,
+    HashTable,
+    ListpackHash,
+    ListpackList,
+    ListpackSet,
+    ListpackZSet,
+    Quicklist,
+    SortedSet,
+)
+
+RDB_VERSION: Final[bytes] = b"0011"
+CHUNK_SIZE: Final[int] = 64 * 1024
+STREAM_NODE_MAX_ENTRIES: Final[int] = 100  # like Redis's stream-node-max-entries
+
+# Opcodes and value types, see RdbParser.
+OPCODE_AUX: Final[int] = 0xFA
+OPCODE_RESIZEDB: Final[int] = 0xFB
+OPCODE_EXPIRETIME_MS: Final[int] = 0xFC
+OPCODE_SELECTDB: Final[int] = 0xFE
+OPCODE_EOF: Final[int] = 0xFF
+TYPE_STRING: Final[int] = 0
+TYPE_LIST: Final[int] = 1
+TYPE_SET: Final[int] = 2
+TYPE_HASH: Final[int] = 4
+TYPE_ZSET_2: Final[int] = 5
+TYPE_STREAM_LISTPACKS: Final[int] = 15
+TYPE_HASH_LISTPACK: Final[int] = 16
+TYPE_ZSET_LISTPACK: Final[int] = 17
+TYPE_LIST_QUICKLIST_2: Final[int] = 18
+TYPE_SET_LISTPACK: Final[int] = 20
+QUICKLIST_NODE_PACKED: Final[int] = 2
+# Python type of a value -> RDB value type, strings being the rest. Like in
+# Redis, compact collections are written as listpacks and the others in the
+# plain encodings.
+RDB_TYPES: Final[dict[type, int]] = {
+    StreamEntries: TYPE_STREAM_LISTPACKS,
+    ListpackList: TYPE_LIST_QUICKLIST_2,
+    Quicklist: TYPE_LIST,
+    ListpackSet: TYPE_SET_LISTPACK,
+    HashSet: TYPE_SET,
+    ListpackZSet: TYPE_ZSET_LISTPACK,
+    SortedSet: TYPE_ZSET_2,
+    ListpackHash: TYPE_HASH_LISTPACK,
+    HashTable: TYPE_HASH,
+}
+
+STREAM_ITEM_FLAG_SAMEFIELDS: Final[int] = 2
+
+
+class RdbWriter:
+    """
+    Serializes a Container to the RDB format read by RdbParser: expiries,
+    strings, streams (as listpacks) and lists, sets, sorted sets and hashes,
+    as listpacks while compact and in their plain encodings otherwise.
+    dump() yields the file in chunks so a snapshot
+    never has to be materialized in memory.
+    """
+
+    @staticmethod
+    def dump(container: Container) -> Iterator[bytes]:
+        unix_delta = unix_ms_from_deadline(0)
+        expires = container.expires
+        return RdbWriter.dump_records(
+            (
+                (
+                    (key, element.value, expires[key] + unix_delta)
+                    if key in expires
+                    else (key, element.value, None)
+                )
+                for key, element in container.kv.items()
+            ),
+            len(container.kv),
+            len(expires),
+        )
+
+    @staticmethod
+    def dump_records(
+        records: Iterable[Tuple[bytes, Any, int | None]],
+        num_keys: int,
+        num_expires: int,
+    ) -> Iterator[bytes]:
+        """
+        RDB file holding (key, value, expiry as unix time in ms or None)
+        records, the inverse of RdbParser.records().
+        """
+        buf = bytearray(b"REDIS" + RDB_VERSION)
+        RdbWriter._aux(buf, b"redis-ver", b"7.2.0")
+        RdbWriter._aux(buf, b"redis-bits", b"64")
+        RdbWriter._aux(buf, b"ctime", b"%d" % int(time.time()))
+        buf.append(OPCODE_SELECTDB)
+        RdbWriter._length(buf, 0)
+        buf.append(OPCODE_RESIZEDB)
+        RdbWriter._length(buf, num_keys)
+        RdbWriter._length(buf, num_expires)
+        for key, value, expiry in records:
+            if expiry is not None:
+                buf.append(OPCODE_EXPIRETIME_MS)
+                buf += struct.pack("<Q", max(expiry, 0))
+            value_type = RDB_TYPES.get(type(value), TYPE_STRING)
+            buf.append(value_type)
+            RdbWriter._string(buf, key)
+            RdbWriter._value(buf, value_type, value)
+            if len(buf) >= CHUNK_SIZE:
+                yield bytes(buf)
+                buf.clear()
+        buf.append(OPCODE_EOF)
+        buf += b"\x00" * 8  # checksum disabled
+        yield bytes(buf)
+
+    @staticmethod
+    def save(container: Container, path: Path) -> None:
+        """Write the snapshot to a temporary file and rename it over path."""
+        RdbWriter.save_chunks(RdbWriter.dump(container), path)
+
+    @staticmethod
+    def save_chunks(chunks: Iterable[bytes], path: Path) -> None:
+        tmp = path.with_name(f"temp-{os.getpid()}-{path.name}")
+        with open(tmp, "wb") as file:
+            for chunk in chunks:
+                file.write(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path)
+
+    @staticmethod
+    def bgsave(container: Container, path: Path) -> asyncio.Future:
+        """
+        Save without stalling the event loop. With fork() the child writes
+        the copy-on-write image of the keyspace as it is at this call, and
+        the returned future completes when the child exits. Without fork()
+        the keyspace is copied and written from a thread.
+        """
+        loop = asyncio.get_running_loop()
+        if not hasattr(os, "fork"):
+            snapshot = Container()
+            snapshot.kv = {
+                key: Element(RdbWriter._frozen(element.value), element.type)
+                for key, element in container.kv.items()
+            }
+            snapshot.expires = dict(container.expires)
+            return loop.run_in_executor(None, RdbWriter.save, snapshot, path)
+        pid = os.fork()
+        if pid == 0:
+            # Only this thread exists in the child, and the logging thread
+            # may have held a lock at the fork, so nothing is logged: errors
+            # go straight to fd 2 and the child never runs the exit handlers.
+            status = 0
+            try:
+                RdbWriter.save(container, path)
+            except BaseException:
+                os.write(2, traceback.format_exc().encode())
+                status = 1
+            os._exit(status)
+        return asyncio.ensure_future(RdbWriter._wait_child(pid, path))
+
+    @staticmethod
+    def _frozen(value: Any) -> Any:
+        """
+        Copy of value that the in-place commands (APPEND, INCR, LPUSH, HSET,
+        XADD...) cannot change while a thread writes it.
+        """
+        if isinstance(value, bytearray):
+            return bytes(value)
+        if isinstance(value, StreamEntries):
+            return value.snapshot()
+        if isinstance(value, (list, set, dict, deque)):
+            return copy.copy(value)  # keeps the encoding's class
+        return value
+
+    @staticmethod
+    async def _wait_child(pid: int, path: Path, interval: float = 0.01) -> None:
+        # Polled like Redis's serverCron checks on its children, so no thread
+        # is blocked in waitpid() while the event loop keeps forking.
+        while True:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                break
+            await asyncio.sleep(interval)
+        if os.waitstatus_to_exitcode(status) != 0:
+            raise OSError(f"Background save to {path} failed")
+
+    @staticmethod
+    def _aux(buf: bytearray, key: bytes, value: bytes) -> None:
+        buf.append(OPCODE_AUX)
+        RdbWriter._string(buf, key)
+        RdbWriter._string(buf, value)
+
+    @staticmethod
+    def _length(buf: bytearray, length: int) -> None:
+        if length < 1 << 6:
+            buf.append(length)
+        elif length < 1 << 14:
+            buf += struct.pack(">H", 0x4000 | length)
+        elif length < 1 << 32:
+            buf.append(0x80)
+            buf += struct.pack(">I", length)
+        else:
+            buf.append(0x81)
+            buf += struct.pack(">Q", length)
+
+    @staticmethod
+    def _string(buf: bytearray, value: bytes | bytearray | str | int) -> None:
+        if isinstance(value, int):
+            # Counters use the integer encodings, like in Redis.
+            if -(1 << 7) <= value < 1 << 7:
+                buf.append(0xC0)
+                buf += struct.pack("<b", value)
+                return
+            elif -(1 << 15) <= value < 1 << 15:
+                buf.append(0xC1)
+                buf += struct.pack("<h", value)
+                return
+            elif -(1 << 31) <= value < 1 << 31:
+                buf.append(0xC2)
+                buf += struct.pack("<i", value)
+                return
+            value = b"%d" % value
+        elif isinstance(value, str):
+            value = value.encode()
+        RdbWriter._length(buf, len(value))
+        buf += value
+
+    @staticmethod
+    def _value(buf: bytearray, value_type: int, value: Any) -> None:
+        if value_type == TYPE_STRING:
+            RdbWriter._string(buf, value)
+        elif value_type == TYPE_STREAM_LISTPACKS:
+            RdbWriter._stream(buf, value)
+        elif value_type in (TYPE_LIST, TYPE_SET):
+            RdbWriter._length(buf, len(value))
+            for item in value:
+                RdbWriter._string(buf, item)
+        elif value_type == TYPE_ZSET_2:
+            RdbWriter._length(buf, len(value))
+            for member, score in value.items():
+                RdbWriter._string(buf, member)
+                buf += struct.pack("<d", score)
+        elif value_type == TYPE_HASH:
+            RdbWriter._length(buf, len(value))
+            for field, item in value.items():
+                RdbWriter._string(buf, field)
+                RdbWriter._string(buf, item)
+        elif value_type == TYPE_LIST_QUICKLIST_2:
+            RdbWriter._length(buf, 1)  # a single node
+            RdbWriter._length(buf, QUICKLIST_NODE_PACKED)
+            RdbWriter._string(buf, Listpack.encode(list(value)))
+        elif value_type == TYPE_ZSET_LISTPACK:
+            items: list[bytes | int] = []
+            for member, score in value.items():
+                items.append(member)
+                # Integral scores are stored as integers, like Redis does.
+                if score.is_integer() and abs(score) < 1 << 63:
+                    items.append(int(score))
+                else:
+                    items.append(repr(score).encode())
+            RdbWriter._string(buf, Listpack.encode(items))
+        else:  # listpack of a set's members or a hash's fields and values
+            RdbWriter._string(buf, Listpack.encode(list(value)))
+
+    @staticmethod
+    def _stream(buf: bytearray, stream: StreamEntries) -> None:
+        # RDB_TYPE_STREAM_LISTPACKS: nodes of up to STREAM_NODE_MAX_ENTRIES
+        # entries keyed by their 128-bit big-endian master ID.
+        entries = list(stream)
+        nodes = [
+            entries[i : i + STREAM_NODE_MAX_ENTRIES]
+            for i in range(0, len(entries), STREAM_NODE_MAX_ENTRIES)
+        ]
+        RdbWriter._length(buf, len(nodes))
+        for node in nodes:
+            RdbWriter._string(buf, struct.pack(">QQ", *node[0].id))
+            RdbWriter._string(buf, RdbWriter._stream_listpack(node))
+        RdbWriter._length(buf, len(stream))
+        RdbWriter._length(buf, stream.last_id[0])
+        RdbWriter._length(buf, stream.last_id[1])
+        RdbWriter._length(buf, 0)  # consumer groups
+
+    @staticmethod
+    def _stream_listpack(node: list) -> bytes:
+        master_ms, master_seq = node[0].id
+        master_fields = node[0].data[0::2]
+        items: list[bytes | int] = [len(node), 0, len(master_fields)]
+        items += master_fields
+        items.append(0)  # master entry terminator
+        for entry in node:
+            fields = entry.data[0::2]
+            same = fields == master_fields
+            items.append(STREAM_ITEM_FLAG_SAMEFIELDS if same else 0)
+            items.append(entry.id[0] - master_ms)
+            items.append(entry.id[1] - master_seq)
+            if same:
+                items += entry.data[1::2]
+                items.append(len(fields) + 3)
+            else:
+                items.append(len(fields))
+                items += entry.data
+                items.append(2 * len(fields) + 4)
+        return Listpack.encode(items)
+
+
+class RdbSnapshot:
+    """
+    RDB taken in the background for a FULLRESYNC. The file is sent as
+    "$<size>\r\n<payload>" (no trailing CRLF) once the save completes,
+    straight from the file so it is never held in memory.
+    """
+
+    def __init__(self, container: Container) -> None:
+        fd, name = tempfile.mkstemp(prefix="temp-repl-", suffix=".rdb")
+        os.close(fd)
+        self.path = Path(name)
+        self.done = RdbWriter.bgsave(container, self.path)
+
+    async def stream_to(self, writer: asyncio.StreamWriter) -> None:
+        try:
+            await self.done
+            with open(self.path, "rb") as file:
+                writer.write(b"$%d\r\n" % os.fstat(file.fileno()).st_size)
+                await writer.drain()
+                await asyncio.get_running_loop().sendfile(writer.transport, file)
+        finally:
+            self.path.unlink(missing_ok=True)
+
+
+class Listpack:
+    """Encoder for the listpack format used inside RDB values."""
+
+    @staticmethod
+    def encode(items: list[bytes | int]) -> bytes:
+        body = bytearray()
+        for item in items:
+            start = len(body)
+            if isinstance(item, int):
+                Listpack._int(body, item)
+            else:
+                Listpack._str(body, item)
+            Listpack._backlen(body, len(body) - start)
+        body.append(0xFF)
+        header = struct.pack("<IH", 6 + len(body), min(len(items), 65535))
+        return header + bytes(body)
+
+    @staticmethod
+    def _int(body: bytearray, value: int) -> None:
+        if 0 <= value <= 127:
+            body.append(value)
+        elif -4096 <= value <= 4095:
+            value &= 0x1FFF
+            body += bytes((0xC0 | (value >> 8), value & 0xFF))
+        elif -(1 << 15) <= value < 1 << 15:
+            body.append(0xF1)
+            body += struct.pack("<h", value)
+        elif -(1 << 23) <= value < 1 << 23:
+            body.append(0xF2)
+            body += (value & 0xFFFFFF).to_bytes(3, "little")
+        elif -(1 << 31) <= value < 1 << 31:
+            body.append(0xF3)
+            body += struct.pack("<i", value)
+        else:
+            body.append(0xF4)
+            body += struct.pack("<q", value)
+
+    @staticmethod
+    def _str(body: bytearray, value: bytes | str) -> None:
+        if isinstance(value, str):
+            value = value.encode()
+        if len(value) < 64:
+            body.append(0x80 | len(value))
+        elif len(value) < 4096:
+            body += bytes((0xE0 | (len(value) >> 8), len(value) & 0xFF))
+        else:
+            body.append(0xF0)
+            body += struct.pack("<I", len(value))
+        body += value
+
+    @staticmethod
+    def _backlen(body: bytearray, length: int) -> None:
+        # Variable length, written so it can be read backwards.
+        if length <= 127:
+            body.append(length)
+        elif length < 16383:
+            body += bytes((length >> 7, (length & 127) | 128))
+        elif length < 2097151:
+            body += bytes(
+                (length >> 14, ((length >> 7) & 127) | 128, (length & 127) | 128)
+            )
+        elif length < 268435455:
+            body += bytes(
+                (
+                    length >> 21,
+                    ((length >> 14) & 127) | 128,
+                    ((length >> 7) & 127) | 128,
+                    (length & 127) | 128,
+                )
+            )
+        else:
+            body += bytes(
+                (
+                    length >> 28,
+                    ((length >> 21) & 127) | 128,
+                    ((length >> 14) & 127) | 128,
+                    ((length >> 7) & 127) | 128,
+                    (length & 127) | 128,
+                )
+            )
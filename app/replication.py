@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Final
+
+from app.clock import now_ms
+from app.output_buffer import DEFAULT_HIGH_WATER, OutputBuffer
+
+DEFAULT_BACKLOG_SIZE: Final[int] = 1024 * 1024  # bytes
+DEFAULT_REPL_PING_REPLICA_PERIOD: Final[int] = 10  # seconds
+REPLICA_ACK_PERIOD: Final[float] = 1.0  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class OutputBufferLimit:
+    """
+    client-output-buffer-limit of a class of clients, as in Redis: past hard
+    bytes, or past soft bytes for soft_seconds in a row, the client is
+    disconnected. 0 disables a limit.
+    """
+
+    hard: int
+    soft: int
+    soft_seconds: int
+
+
+DEFAULT_REPLICA_OUTPUT_LIMIT: Final[OutputBufferLimit] = OutputBufferLimit(
+    hard=256 * 1024 * 1024, soft=64 * 1024 * 1024, soft_seconds=60
+)
+
+
+class ReplicationBacklog:
+    """
+    Fixed-size circular buffer holding the tail of the replication stream.
+
+    Offsets are positions in the whole stream since the master started, the
+    same space as master_repl_offset. A replica that reconnects having
+    processed `offset` bytes can continue from the backlog as long as that
+    offset is still inside it.
+    """
+
+    def __init__(self, size: int = DEFAULT_BACKLOG_SIZE) -> None:
+        self.size = size
+        self.buffer = bytearray(size)
+        self.offset = 0  # offset right after the last byte fed
+        self.histlen = 0  # number of valid bytes in the buffer
+
+    @property
+    def start_offset(self) -> int:
+        return self.offset - self.histlen
+
+    def feed(self, data: bytes) -> None:
+        self.offset += len(data)
+        if len(data) >= self.size:
+            data = data[-self.size :]
+        idx = (self.offset - len(data)) % self.size
+        first = min(len(data), self.size - idx)
+        self.buffer[idx : idx + first] = data[:first]
+        self.buffer[: len(data) - first] = data[first:]
+        self.histlen = min(self.histlen + len(data), self.size)
+
+    def contains(self, offset: int) -> bool:
+        return self.start_offset <= offset <= self.offset
+
+    def get_from(self, offset: int) -> bytes:
+        """Stream bytes from offset up to the current offset."""
+        if not self.contains(offset):
+            raise ValueError(f"Offset {offset} is not in the backlog")
+        length = self.offset - offset
+        idx = offset % self.size
+        first = min(length, self.size - idx)
+        return bytes(self.buffer[idx : idx + first] + self.buffer[: length - first])
+
+
+class ReplicaOutput:
+    """
+    Output buffer of a replica connection, drained by a task of its own, so
+    a slow replica never holds up the clients whose writes reach it. The
+    propagated commands are queued as the bytes objects they were encoded
+    to once for all replicas, and everything queued in one loop iteration
+    goes out with a single write.
+
+    The usage counted against the limit is what is queued plus what the
+    transport has not sent yet, like a Redis client's output buffer.
+    """
+
+    def __init__(
+        self,
+        writer: asyncio.StreamWriter,
+        limit: OutputBufferLimit = DEFAULT_REPLICA_OUTPUT_LIMIT,
+        high_water: int = DEFAULT_HIGH_WATER,
+    ) -> None:
+        self.writer = writer
+        self.limit = limit
+        self.buffer = OutputBuffer(writer, high_water)
+        self.ready = asyncio.Event()
+        self.soft_since: int | None = None  # now_ms() the soft limit was passed
+        self.task = asyncio.create_task(self._drain())
+
+    def write(self, data: bytes) -> bool:
+        """Queue data. Returns False if the replica is over its limit."""
+        self.buffer.write(data)
+        self.ready.set()
+        return not self.over_limit()
+
+    def usage(self) -> int:
+        return self.buffer.size + self.writer.transport.get_write_buffer_size()
+
+    def over_limit(self) -> bool:
+        usage = self.usage()
+        if self.limit.hard and usage > self.limit.hard:
+            return True
+        if self.limit.soft and usage > self.limit.soft:
+            if self.soft_since is None:
+                self.soft_since = now_ms()
+            return now_ms() - self.soft_since > self.limit.soft_seconds * 1000
+        self.soft_since = None
+        return False
+
+    def close(self) -> None:
+        self.task.cancel()
+
+    async def _drain(self) -> None:
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                await self.buffer.flush()
+        except ConnectionError as err:
+            # The connection's reader notices too and detaches the replica.
+            logger.debug("Replica connection lost while writing: %s", err)
@@ -1,16 +1,51 @@
 from __future__ import annotations
 
 import asyncio
-import bisect
-from collections import defaultdict
-from dataclasses import dataclass
-from datetime import datetime, timedelta
+import fnmatch
+import inspect
+import logging
+import os
+import time
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Literal, Tuple
+from typing import Any, Awaitable, Callable, Literal, Tuple
 
-from app.rdb_parser import RdbParser
-from app.resp_parser import RespParser
-from app.container import Container, StreamEntries, StreamEntry
+from app.aof import DEFAULT_APPENDFILENAME, AppendOnlyFile
+from app.clock import deadline_from_unix_ms, now_ms, unix_ms_from_deadline
+from app.output_buffer import DEFAULT_HIGH_WATER
+from app.rdb_parser import RdbParseError, RdbParser
+from app.rdb_writer import RdbSnapshot, RdbWriter
+from app.replication import (
+    DEFAULT_BACKLOG_SIZE,
+    DEFAULT_REPL_PING_REPLICA_PERIOD,
+    DEFAULT_REPLICA_OUTPUT_LIMIT,
+    OutputBufferLimit,
+    ReplicaOutput,
+    ReplicationBacklog,
+)
+from app.resp_parser import RespDecoder, RespParser, RespParserError
+from app.container import (
+    INT64_MAX,
+    INT64_MIN,
+    MAX_STREAM_ID,
+    Container,
+    StreamEntries,
+    StreamID,
+    format_float,
+    format_stream_id,
+    parse_stream_id,
+    string_to_decimal,
+    string_to_float,
+    string_to_int,
+)
+from app.datatypes import ScoreBound
+
+logger = logging.getLogger(__name__)
+
+
+def decode_id(arg: bytes) -> str:
+    """Stream IDs are ASCII; keys and values stay bytes."""
+    return arg.decode("ascii", errors="replace")
 
 
 @dataclass
@@ -19,6 +54,93 @@ class Response:
         200, 201, 202, 203, 400
     ]  # 200 response to client, 201 response to master, 202 response to replica,203 replica connection establish, 400 error
     data: bytes | list[bytes]
+    repl_offset: int | None = None  # 203: offset the replica continues from
+
+
+def parse_int(arg: bytes) -> int:
+    return string_to_int(arg)
+
+
+def parse_timeout(arg: bytes) -> float:
+    """A timeout argument in milliseconds, in seconds. 0 means no timeout."""
+    timeout = parse_int(arg)
+    if timeout < 0:
+        raise ValueError("ERR timeout is negative")
+    return timeout / 1000
+
+
+def parse_score_bound(arg: bytes) -> ScoreBound:
+    """End of a score range: a score, excluded if prefixed by "("."""
+    exclusive = arg[:1] == b"("
+    try:
+        return string_to_float(arg[1:] if exclusive else arg), exclusive
+    except ValueError:
+        raise ValueError("ERR min or max is not a float")
+
+
+def zset_reply(pairs: list, with_scores: bool) -> bytes:
+    """Members of (member, score) pairs, each followed by its score if asked."""
+    if with_scores:
+        return RespParser.encode(
+            [item for member, score in pairs for item in (member, format_float(score))]
+        )
+    return RespParser.encode([member for member, _ in pairs])
+
+
+def error_reply(err: ValueError) -> bytes:
+    """Error reply for err, prefixed with ERR unless it names its own code."""
+    message = str(err)
+    if not message.split(" ", 1)[0].isupper():
+        message = f"ERR {message}"
+    return RespParser.encode(message, type="err")
+
+
+@dataclass(slots=True)
+class Command:
+    """
+    Entry of the command table. arity counts the command name itself, and a
+    negative arity means at least -arity arguments, like in Redis. flags are
+    informational ("write", "readonly", "blocking", "admin", "fast") except
+    "write", which replicas refuse from their clients, and "readonly", which
+    they refuse while lagging more than replica-max-lag-ms behind the master.
+    """
+
+    name: str
+    handler: Callable[..., Response | Awaitable[Response]]
+    arity: int
+    flags: frozenset[str]
+    is_async: bool
+    write: bool
+    readonly: bool
+    calls: int = 0
+    duration_ns: int = 0  # includes the time blocking commands were parked
+    rejected_calls: int = 0  # refused before running, e.g. wrong arity
+    failed_calls: int = 0  # ran and replied with an error
+
+    def accepts(self, argc: int) -> bool:
+        return argc == self.arity if self.arity > 0 else argc >= -self.arity
+
+
+# Upper case command name -> Command, filled by @command.
+COMMANDS: dict[bytes, Command] = {}
+
+
+def command(name: str, arity: int, *flags: str) -> Callable:
+    """Register a RequestHandler method as the handler of a command."""
+
+    def register(handler: Callable) -> Callable:
+        COMMANDS[name.encode()] = Command(
+            name=name.lower(),
+            handler=handler,
+            arity=arity,
+            flags=frozenset(flags),
+            is_async=inspect.iscoroutinefunction(handler),
+            write="write" in flags,
+            readonly="readonly" in flags,
+        )
+        return handler
+
+    return register
 
 
 @dataclass
@@ -26,36 +148,161 @@ class Xread:
     block: bool
     block_duration: int | None  # sec
     stream_keys: list
-    starts: list[StreamEntry]
+    starts: list[StreamID | None]  # None for "$"
 
     @staticmethod
     def parse(input: list) -> Xread:
         block = False
         block_duration = None
         offset = 0
-        if input[1] == "block":
+        if input[1].lower() == b"block":
             offset = 2
             block = True
-            block_duration = int(input[2]) / 1000
-
-        if input[offset + 1] == "streams":
-            stream_keys = []
-            starts = []
-            idx = 2 + offset
-            while idx < len(input) and not StreamEntry.validate_input_id_format(
-                input[idx]
-            ):
-                stream_keys.append(input[idx])
-                idx += 1
-            while idx < len(input):
-                starts.append(StreamEntry(id=input[idx], data={}))
-                idx += 1
-
-            if len(stream_keys) != len(starts):
-                ValueError("Key and start id are not matching")
+            block_duration = parse_timeout(input[2])
+
+        if input[offset + 1].lower() == b"streams":
+            # STREAMS key1 key2 ... id1 id2 ...
+            args = input[2 + offset :]
+            if len(args) % 2 != 0:
+                raise ValueError("Key and start id are not matching")
+            stream_keys = args[: len(args) // 2]
+            starts = [
+                None if id == b"$" else parse_stream_id(decode_id(id))
+                for id in args[len(args) // 2 :]
+            ]
             return Xread(block, block_duration, stream_keys, starts)
         else:
-            ValueError(f"Unknown input {input}")
+            raise ValueError("ERR syntax error")
+
+
+@dataclass
+class SetOptions:
+    condition: bytes | None = None  # b"NX" or b"XX"
+    get: bool = False
+    expire_at: int | None = None  # deadline, see app.clock
+    keep_ttl: bool = False
+
+    @staticmethod
+    def parse(args: list) -> SetOptions:
+        """Options of SET, the arguments after the value."""
+        options = SetOptions()
+        expiry = False  # EX, PX, EXAT, PXAT or KEEPTTL seen
+        i = 0
+        while i < len(args):
+            arg = args[i].upper()
+            if arg in (b"NX", b"XX") and options.condition is None:
+                options.condition = arg
+            elif arg == b"GET" and not options.get:
+                options.get = True
+            elif arg == b"KEEPTTL" and not expiry:
+                options.keep_ttl = expiry = True
+            elif arg in (b"EX", b"PX", b"EXAT", b"PXAT") and not expiry:
+                if i + 1 == len(args):
+                    raise ValueError("ERR syntax error")
+                i += 1
+                ms = parse_int(args[i]) * (1000 if arg in (b"EX", b"EXAT") else 1)
+                relative = arg in (b"EX", b"PX")
+                unix_ms = ms + time.time_ns() // 1_000_000 if relative else ms
+                # Like Redis, the deadline must be an int64 of unix time in ms.
+                if ms <= 0 or unix_ms > INT64_MAX:
+                    raise ValueError("ERR invalid expire time in 'set' command")
+                if relative:
+                    options.expire_at = now_ms() + ms
+                else:
+                    options.expire_at = deadline_from_unix_ms(ms)
+                expiry = True
+            else:
+                raise ValueError("ERR syntax error")
+            i += 1
+        return options
+
+
+@dataclass
+class ZaddOptions:
+    condition: bytes | None = None  # b"NX" or b"XX"
+    comparison: bytes | None = None  # b"GT" or b"LT"
+    changed: bool = False  # CH: count updated members too
+    incr: bool = False
+    items: list[Tuple[float, bytes]] = field(default_factory=list)  # (score, member)
+
+    @staticmethod
+    def parse(args: list) -> ZaddOptions:
+        """Options and score member pairs of ZADD, the arguments after the key."""
+        options = ZaddOptions()
+        flags = set()
+        i = 0
+        while i < len(args):
+            arg = args[i].upper()
+            if arg not in (b"NX", b"XX", b"GT", b"LT", b"CH", b"INCR"):
+                break
+            flags.add(arg)
+            i += 1
+        pairs = args[i:]
+        if not pairs or len(pairs) % 2:
+            raise ValueError("ERR syntax error")
+        if {b"NX", b"XX"} <= flags:
+            raise ValueError(
+                "ERR XX and NX options at the same time are not compatible"
+            )
+        if {b"GT", b"LT"} <= flags or (b"NX" in flags and flags & {b"GT", b"LT"}):
+            raise ValueError(
+                "ERR GT, LT, and/or NX options at the same time are not compatible"
+            )
+        options.incr = b"INCR" in flags
+        if options.incr and len(pairs) > 2:
+            raise ValueError("ERR INCR option supports a single increment-element pair")
+        options.condition = next((f for f in (b"NX", b"XX") if f in flags), None)
+        options.comparison = next((f for f in (b"GT", b"LT") if f in flags), None)
+        options.changed = b"CH" in flags
+        options.items = [
+            (string_to_float(pairs[j]), pairs[j + 1]) for j in range(0, len(pairs), 2)
+        ]
+        return options
+
+
+@dataclass
+class ZrangeOptions:
+    by_score: bool = False
+    reverse: bool = False
+    with_scores: bool = False
+    offset: int = 0
+    count: int = -1  # all of them
+
+    @staticmethod
+    def parse(args: list, by_score: bool = False) -> ZrangeOptions:
+        """Options of ZRANGE, the arguments after start and stop."""
+        options = ZrangeOptions(by_score=by_score)
+        limit = False
+        i = 0
+        while i < len(args):
+            arg = args[i].upper()
+            if arg == b"BYSCORE":
+                options.by_score = True
+            elif arg == b"REV":
+                options.reverse = True
+            elif arg == b"WITHSCORES":
+                options.with_scores = True
+            elif arg == b"LIMIT" and i + 2 < len(args):
+                options.offset = parse_int(args[i + 1])
+                options.count = parse_int(args[i + 2])
+                limit = True
+                i += 2
+            else:
+                raise ValueError("ERR syntax error")
+            i += 1
+        if limit and not options.by_score:
+            raise ValueError(
+                "ERR syntax error, LIMIT is only supported in combination with "
+                "either BYSCORE or BYLEX"
+            )
+        return options
+
+
+@dataclass
+class WaitRequest:
+    offset: int  # replication offset replicas must acknowledge
+    numreplicas: int
+    done: asyncio.Future
 
 
 class RequestHandler:
@@ -64,44 +311,159 @@ class RequestHandler:
         role: str = "master",
         master_host: str | None = None,
         master_port: int | None = None,
-        master_replid: int | None = None,
-        master_repl_offset: str | None = None,
+        master_replid: str | None = None,
+        master_repl_offset: int | None = None,
         dir: Path | None = None,
         rdbfilename: str | None = None,
+        output_high_water: int = DEFAULT_HIGH_WATER,
+        repl_backlog_size: int = DEFAULT_BACKLOG_SIZE,
+        maxmemory: int = 0,
+        maxmemory_policy: str = "noeviction",
+        appendonly: bool = False,
+        appendfsync: str = "everysec",
+        appendfilename: str = DEFAULT_APPENDFILENAME,
+        repl_ping_replica_period: int = DEFAULT_REPL_PING_REPLICA_PERIOD,
+        replica_max_lag_ms: int = 0,
+        replica_output_limit: OutputBufferLimit = DEFAULT_REPLICA_OUTPUT_LIMIT,
     ) -> None:
-        self.container = Container()
+        self.container = Container(
+            maxmemory=maxmemory, maxmemory_policy=maxmemory_policy
+        )
+        self.container.on_evict = self.propagate_deletion
+        self.output_high_water = output_high_water
         self.role = role
         if role == "slave":
             if master_host is None or master_port is None:
                 raise ValueError("If it is a slave, should specify the master")
             self.master_host = master_host
             self.master_port = master_port
+            # Replication offset of the master, in the master's offset space.
             self.processed_commands_from_master = 0  # in bytes
+            self.master_replid: str | None = None  # learnt from FULLRESYNC
+            # Maintained by the server while it streams from the master, in
+            # now_ms() time. synced_at is the last time the replica had
+            # applied everything the master had sent.
+            self.master_link_up = False
+            self.master_last_io: int | None = None
+            self.master_synced_at: int | None = None
+            # Commands applied from the replication stream, and in how many
+            # batches, i.e. reads.
+            self.repl_applied_commands = 0
+            self.repl_apply_batches = 0
         else:
             self.master_replid = master_replid
             self.master_repl_offset = master_repl_offset
+            # Created when the first replica attaches, like Redis.
+            self.backlog: ReplicationBacklog | None = None
+            self.repl_backlog_size = repl_backlog_size
             self.replicas: dict[asyncio.StreamWriter, asyncio.StreamReader] = {}
             self.replica_addr_to_writer: dict[Tuple[str, int], asyncio.StreamWriter] = (
                 {}
             )
-            self.sent_commands: defaultdict[asyncio.StreamWriter, int] = defaultdict(
-                int
-            )
+            # Replication offset each replica has acknowledged, and when it
+            # last did in now_ms() time. Replicas ACK every second by themselves.
+            self.replica_acked: dict[asyncio.StreamWriter, int] = {}
+            self.replica_ack_time: dict[asyncio.StreamWriter, int] = {}
+            # REPLCONF listening-port of each replica connection.
+            self.replica_ports: dict[Tuple[str, int], int] = {}
+            self.repl_ping_replica_period = repl_ping_replica_period
+            self.wait_requests: list[WaitRequest] = []
+            self.replica_buffers: dict[asyncio.StreamWriter, ReplicaOutput] = {}
+            self.replica_output_limit = replica_output_limit
+        # 0 serves reads however far behind the master a replica is.
+        self.replica_max_lag_ms = replica_max_lag_ms
+        self.output_limit_disconnections = 0
         self.dir = dir
         self.rdb_filename = rdbfilename
-        if self.dir is not None and self.rdb_filename is not None:
-            dbfile = self.dir / self.rdb_filename
-            rdb_parser = RdbParser(dbfile)
-            rdb_parser.parse()
-            for k, v in rdb_parser.kv.items():
-                if "expiry" in v.keys() and v["expiry"] is not None:
-                    self.container.set(
-                        k,
-                        v["value"],
-                        expire_at=datetime.fromtimestamp(v["expiry"] / 1000.0),
-                    )
-                else:
-                    self.container.set(k, v["value"])
+        self.bgsave_task: asyncio.Future | None = None
+        self.last_save_time = int(time.time())
+        self.last_bgsave_ok = True
+        self.appendonly = appendonly
+        self.appendfsync = appendfsync
+        self.appendfilename = appendfilename
+        self.aof: AppendOnlyFile | None = None  # opened by open_aof()
+        self.aof_rewrite_task: asyncio.Future | None = None
+        self.aof_rewrite_scheduled = False
+        self.last_aof_rewrite_ok = True
+        # With appendonly the AOF is the source of truth, like in Redis.
+        if (
+            self.dir is not None
+            and self.rdb_filename is not None
+            and not (appendonly and self.aof_path().is_file())
+        ):
+            path = self.dir / self.rdb_filename
+            try:
+                self.load_rdb(path)
+            except RdbParseError as err:
+                # Like Redis, refuse to start on a dump it cannot read.
+                raise SystemExit(f"Bad RDB file {path}: {err}") from None
+
+    def rdb_path(self) -> Path:
+        return (self.dir or Path(".")) / (self.rdb_filename or "dump.rdb")
+
+    def aof_path(self) -> Path:
+        return (self.dir or Path(".")) / self.appendfilename
+
+    def load_rdb(self, dbfile: Path) -> None:
+        """Load dbfile into the keyspace. Raises RdbParseError if it is bad."""
+        with RdbParser(dbfile) as rdb_parser:
+            # Expiries in the file are unix times.
+            loaded = self.container.bulk_load(
+                rdb_parser.records(), expire_offset=deadline_from_unix_ms(0)
+            )
+        logger.info("Loaded %d keys from %s", loaded, dbfile)
+
+    async def open_aof(self) -> None:
+        """
+        With appendonly, replay the AOF and start appending to it. A new AOF
+        is started with a rewrite so that it holds the keys loaded from the
+        RDB file.
+        """
+        if not self.appendonly:
+            return
+        path = self.aof_path()
+        existed = path.is_file()
+        if existed:
+            await self.load_aof(path)
+        self.aof = AppendOnlyFile(path, self.appendfsync)
+        if not existed and self.container.kv:
+            self.rewrite_aof()
+
+    async def load_aof(self, path: Path, chunk_size: int = 64 * 1024) -> None:
+        """
+        Replay an AOF: its RDB preamble if it has one, then the commands. A
+        command cut short at the end, e.g. by a crash during a write, is
+        dropped and the file truncated, like Redis's aof-load-truncated.
+        """
+        loaded = commands = 0
+        decoder = RespDecoder(binary=True)
+        with RdbParser(path) as rdb_parser:
+            data = rdb_parser.data
+            start = 0
+            if data[:5] == b"REDIS":
+                loaded = self.container.bulk_load(
+                    rdb_parser.records(), expire_offset=deadline_from_unix_ms(0)
+                )
+                start = rdb_parser.index + 8  # after the EOF opcode and checksum
+            for offset in range(start, len(data), chunk_size):
+                # Released even if it raises, the mapping cannot be closed
+                # while a view of it is alive.
+                with data[offset : offset + chunk_size] as chunk:
+                    try:
+                        frames = decoder.feed(chunk)
+                    except RespParserError as err:
+                        raise ValueError(f"Bad AOF {path}: {err}")
+                for parsed, _ in frames:
+                    ret = await self.handle(parsed)
+                    if isinstance(ret.data, bytes) and ret.data.startswith(b"-"):
+                        logger.warning("AOF command %s failed: %s", parsed, ret.data)
+                    commands += 1
+            size = len(data)
+        truncated = len(decoder.remaining)
+        if truncated:
+            logger.warning("Truncating %d bytes at the end of the AOF", truncated)
+            os.truncate(path, size - truncated)
+        logger.info("Loaded %d keys and %d commands from %s", loaded, commands, path)
 
     def from_master(self, peer_info: Tuple[str, int] | None = None):
         def is_local_host(address):
@@ -109,7 +471,6 @@ class RequestHandler:
             if address == "127.0.0.1" or address == "::1" or address == "localhost":
                 return True
 
-        print("FROM MASTER", peer_info)
         return (
             peer_info is not None
             and self.role == "slave"
@@ -122,251 +483,941 @@ class RequestHandler:
 
     async def handle(
         self,
-        input: list | int | str,
+        input: list | int | bytes,
         peer_info: Tuple[str, int] | None = None,
     ) -> Response:
-        if isinstance(input, list) and isinstance(input[0], str):
-            match input[0].upper():
-                case "ECHO":
-                    return Response(200, RespParser.encode(input[1]))
-                case "PING":
-                    return Response(200, RespParser.encode("PONG"))
-                case "SET":
-                    if len(input) < 3:
-                        raise ValueError("Invalid usage of SET")
-                    if len(input) == 5 and input[3] == "px":
-                        self.container.set(
-                            input[1],
-                            input[2],
-                            expire_at=datetime.now()
-                            + timedelta(milliseconds=int(input[4])),
-                        )
-                    else:
-                        self.container.set(input[1], input[2])
-                    await self.propagte_commands(input)
-                    return Response(200, RespParser.encode("OK"))
-                case "GET":
-                    if len(input) != 2:
-                        raise ValueError("Invalid usage of GET")
+        """
+        Run one command. peer_info is None for commands that do not come from
+        a connection, e.g. when the AOF is replayed.
+        """
+        if not (isinstance(input, list) and input and isinstance(input[0], bytes)):
+            logger.debug("Not a command: %s", input)
+            return Response(400, b"")
+        # Clients usually send the name in upper case, so .upper() is rare.
+        command = COMMANDS.get(input[0]) or COMMANDS.get(input[0].upper())
+        if command is None:
+            args = " ".join(f"'{decode_id(arg)}'" for arg in input[1:])
+            return Response(
+                200,
+                RespParser.encode(
+                    f"ERR unknown command '{decode_id(input[0])}', "
+                    f"with args beginning with: {args}",
+                    type="err",
+                ),
+            )
+        arity = command.arity  # inlined Command.accepts()
+        if len(input) != arity if arity > 0 else len(input) < -arity:
+            command.rejected_calls += 1
+            return Response(
+                200,
+                RespParser.encode(
+                    f"ERR wrong number of arguments for '{command.name}' command",
+                    type="err",
+                ),
+            )
+        if (
+            command.write
+            and self.role == "slave"
+            and peer_info is not None
+            and not self.from_master(peer_info)
+        ):
+            command.rejected_calls += 1
+            return Response(
+                200,
+                RespParser.encode(
+                    "READONLY You can't write against a read only replica.",
+                    type="err",
+                ),
+            )
+        if (
+            self.replica_max_lag_ms
+            and command.readonly
+            and self.role == "slave"
+            and peer_info is not None
+            and self.is_stale()
+        ):
+            command.rejected_calls += 1
+            return Response(
+                200,
+                RespParser.encode(
+                    "MASTERDOWN Replica lag exceeds replica-max-lag-ms "
+                    f"({self.replica_max_lag_ms} ms)",
+                    type="err",
+                ),
+            )
+        start = time.perf_counter_ns()
+        try:
+            ret = command.handler(self, input, peer_info)
+            if command.is_async:
+                ret = await ret
+        except ValueError as err:
+            ret = Response(200, error_reply(err))
+        command.calls += 1
+        command.duration_ns += time.perf_counter_ns() - start
+        if isinstance(ret.data, bytes) and ret.data.startswith(b"-"):
+            command.failed_calls += 1
+        return ret
+
+    def apply_from_master(
+        self, frames: list[Tuple[Any, int]], peer_info: Tuple[str, int]
+    ) -> list[bytes]:
+        """
+        Apply a batch of commands from the replication stream, as decoded
+        from one read, and return the replies owed to the master, i.e. the
+        ACKs to GETACK. The master is trusted, so the commands skip the
+        checks and accounting of handle() and run straight on the keyspace,
+        without yielding to the event loop between them.
+        """
+        replies = []
+        for input, length in frames:
+            command = None
+            if isinstance(input, list) and input and isinstance(input[0], bytes):
+                command = COMMANDS.get(input[0]) or COMMANDS.get(input[0].upper())
+            if command is None or command.is_async or not command.accepts(len(input)):
+                logger.warning("Cannot apply %s from the master", input)
+            else:
+                try:
+                    ret = command.handler(self, input, peer_info)
+                    if ret.code == 201:
+                        replies.append(ret.data)
+                except ValueError as err:
+                    logger.warning("Error applying %s from the master: %s", input, err)
+                command.calls += 1
+            # The offset of a GETACK's reply does not count the GETACK itself.
+            self.processed_commands_from_master += length
+        self.repl_applied_commands += len(frames)
+        self.repl_apply_batches += 1
+        return replies
+
+    @command("PING", -1, "fast")
+    def cmd_ping(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.PONG)
+
+    @command("ECHO", 2, "fast")
+    def cmd_echo(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(input[1]))
+
+    @command("SET", -3, "write")
+    def cmd_set(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        if len(input) == 3:
+            self.container.set(input[1], input[2])
+            self.propagte_commands(input)
+            return Response(200, RespParser.OK)
+        options = SetOptions.parse(input[3:])
+        key = input[1]
+        old = self.container.get_string(key) if options.get else None
+        if options.condition is not None:
+            exists = old is not None if options.get else self.container.exists(key)
+            if exists != (options.condition == b"XX"):
+                return Response(200, RespParser.encode(old))
+        self.container.set(
+            key, input[2], expire_at=options.expire_at, keep_ttl=options.keep_ttl
+        )
+        # Relative expiries are propagated as absolute times, so replicas
+        # and the AOF replay agree on the deadline.
+        propagated = [b"SET", key, input[2]]
+        if options.expire_at is not None:
+            propagated += [b"PXAT", b"%d" % unix_ms_from_deadline(options.expire_at)]
+        elif options.keep_ttl:
+            propagated.append(b"KEEPTTL")
+        self.propagte_commands(propagated)
+        return Response(200, RespParser.encode(old) if options.get else RespParser.OK)
+
+    @command("SETNX", 3, "write", "fast")
+    def cmd_setnx(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        if self.container.exists(input[1]):
+            return Response(200, RespParser.encode(0))
+        self.container.set(input[1], input[2])
+        self.propagte_commands(input)
+        return Response(200, RespParser.encode(1))
+
+    @command("MSET", -3, "write")
+    def cmd_mset(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        if len(input) % 2 == 0:
+            raise ValueError("ERR wrong number of arguments for 'mset' command")
+        for i in range(1, len(input), 2):
+            self.container.set(input[i], input[i + 1])
+        self.propagte_commands(input)
+        return Response(200, RespParser.OK)
+
+    @command("GET", 2, "readonly", "fast")
+    def cmd_get(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.get_string(input[1])))
+
+    @command("MGET", -2, "readonly", "fast")
+    def cmd_mget(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.mget(input[1:])))
+
+    @command("STRLEN", 2, "readonly", "fast")
+    def cmd_strlen(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.strlen(input[1])))
+
+    @command("INCR", 2, "write", "fast")
+    def cmd_incr(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return self.incr_by(input, 1)
+
+    @command("DECR", 2, "write", "fast")
+    def cmd_decr(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return self.incr_by(input, -1)
+
+    @command("INCRBY", 3, "write", "fast")
+    def cmd_incrby(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return self.incr_by(input, parse_int(input[2]))
+
+    @command("DECRBY", 3, "write", "fast")
+    def cmd_decrby(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        delta = parse_int(input[2])
+        if delta == INT64_MIN:
+            raise ValueError("ERR decrement would overflow")
+        return self.incr_by(input, -delta)
+
+    def incr_by(self, input: list, delta: int) -> Response:
+        value = self.container.incr_by(input[1], delta)
+        self.propagte_commands(input)
+        return Response(200, RespParser.encode(value))
+
+    @command("INCRBYFLOAT", 3, "write", "fast")
+    def cmd_incrbyfloat(
+        self, input: list, peer_info: Tuple[str, int] | None
+    ) -> Response:
+        value = self.container.incr_by_float(input[1], string_to_decimal(input[2]))
+        # Propagated as the result, so float rounding cannot make replicas
+        # diverge.
+        self.propagte_commands([b"SET", input[1], value, b"KEEPTTL"])
+        return Response(200, RespParser.encode(value))
+
+    @command("APPEND", 3, "write", "fast")
+    def cmd_append(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        length = self.container.append(input[1], input[2])
+        self.propagte_commands(input)
+        return Response(200, RespParser.encode(length))
+
+    @command("GETRANGE", 4, "readonly")
+    def cmd_getrange(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        value = self.container.get_range(
+            input[1], parse_int(input[2]), parse_int(input[3])
+        )
+        return Response(200, RespParser.encode(value))
+
+    @command("SETRANGE", 4, "write")
+    def cmd_setrange(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        offset = parse_int(input[2])
+        if offset < 0:
+            raise ValueError("ERR offset is out of range")
+        length = self.container.set_range(input[1], offset, input[3])
+        self.propagte_commands(input)
+        return Response(200, RespParser.encode(length))
+
+    @command("LPUSH", -3, "write", "fast")
+    def cmd_lpush(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return self.list_push(input, left=True)
+
+    @command("RPUSH", -3, "write", "fast")
+    def cmd_rpush(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return self.list_push(input, left=False)
+
+    def list_push(self, input: list, left: bool) -> Response:
+        length = self.container.list_push(input[1], input[2:], left)
+        self.propagte_commands(input)
+        return Response(200, RespParser.encode(length))
+
+    @command("LPOP", -2, "write", "fast")
+    def cmd_lpop(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return self.list_pop(input, left=True)
+
+    @command("RPOP", -2, "write", "fast")
+    def cmd_rpop(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return self.list_pop(input, left=False)
+
+    def list_pop(self, input: list, left: bool) -> Response:
+        if len(input) > 3:
+            raise ValueError("ERR syntax error")
+        count = parse_int(input[2]) if len(input) == 3 else 1
+        if count < 0:
+            raise ValueError("ERR value is out of range, must be positive")
+        items = self.container.list_pop(input[1], count, left)
+        if items:
+            self.propagte_commands(input)
+        if len(input) == 3:  # with a count, the reply is an array
+            return Response(
+                200,
+                RespParser.NULL_ARRAY if items is None else RespParser.encode(items),
+            )
+        return Response(200, RespParser.encode(items[0] if items else None))
+
+    @command("LLEN", 2, "readonly", "fast")
+    def cmd_llen(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.llen(input[1])))
+
+    @command("LRANGE", 4, "readonly")
+    def cmd_lrange(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        items = self.container.lrange(
+            input[1], parse_int(input[2]), parse_int(input[3])
+        )
+        return Response(200, RespParser.encode(items))
+
+    @command("LINDEX", 3, "readonly")
+    def cmd_lindex(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        item = self.container.lindex(input[1], parse_int(input[2]))
+        return Response(200, RespParser.encode(item))
+
+    @command("SADD", -3, "write", "fast")
+    def cmd_sadd(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        added = self.container.sadd(input[1], input[2:])
+        if added:
+            self.propagte_commands(input)
+        return Response(200, RespParser.encode(added))
+
+    @command("SREM", -3, "write", "fast")
+    def cmd_srem(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        removed = self.container.srem(input[1], input[2:])
+        if removed:
+            self.propagte_commands(input)
+        return Response(200, RespParser.encode(removed))
+
+    @command("SISMEMBER", 3, "readonly", "fast")
+    def cmd_sismember(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        is_member = self.container.sismember(input[1], input[2])
+        return Response(200, RespParser.encode(int(is_member)))
+
+    @command("SMEMBERS", 2, "readonly")
+    def cmd_smembers(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.smembers(input[1])))
+
+    @command("SCARD", 2, "readonly", "fast")
+    def cmd_scard(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.scard(input[1])))
+
+    @command("HSET", -4, "write", "fast")
+    def cmd_hset(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        if len(input) % 2:
+            raise ValueError("ERR wrong number of arguments for 'hset' command")
+        added = self.container.hset(input[1], input[2:])
+        self.propagte_commands(input)
+        return Response(200, RespParser.encode(added))
+
+    @command("HSETNX", 4, "write", "fast")
+    def cmd_hsetnx(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        added = self.container.hset(input[1], input[2:], nx=True)
+        if added:
+            self.propagte_commands(input)
+        return Response(200, RespParser.encode(added))
+
+    @command("HGET", 3, "readonly", "fast")
+    def cmd_hget(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.hget(input[1], input[2])))
+
+    @command("HMGET", -3, "readonly", "fast")
+    def cmd_hmget(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        values = self.container.hmget(input[1], input[2:])
+        return Response(200, RespParser.encode(values))
+
+    @command("HDEL", -3, "write", "fast")
+    def cmd_hdel(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        removed = self.container.hdel(input[1], input[2:])
+        if removed:
+            self.propagte_commands(input)
+        return Response(200, RespParser.encode(removed))
+
+    @command("HLEN", 2, "readonly", "fast")
+    def cmd_hlen(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.hlen(input[1])))
+
+    @command("HEXISTS", 3, "readonly", "fast")
+    def cmd_hexists(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        exists = self.container.hget(input[1], input[2]) is not None
+        return Response(200, RespParser.encode(int(exists)))
+
+    @command("HGETALL", 2, "readonly")
+    def cmd_hgetall(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.hgetall(input[1])))
+
+    @command("HKEYS", 2, "readonly")
+    def cmd_hkeys(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.hkeys(input[1])))
+
+    @command("HVALS", 2, "readonly")
+    def cmd_hvals(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.hvals(input[1])))
+
+    @command("HINCRBY", 4, "write", "fast")
+    def cmd_hincrby(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        value = self.container.hincr_by(input[1], input[2], parse_int(input[3]))
+        self.propagte_commands(input)
+        return Response(200, RespParser.encode(value))
+
+    @command("ZADD", -4, "write", "fast")
+    def cmd_zadd(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        options = ZaddOptions.parse(input[2:])
+        if options.incr:
+            [(delta, member)] = options.items
+            score = self.container.zincr_by(
+                input[1], delta, member, options.condition, options.comparison
+            )
+            if score is None:
+                return Response(200, RespParser.NULL)
+            self.propagte_commands(input)
+            return Response(200, RespParser.encode(format_float(score)))
+        added, changed = self.container.zadd(
+            input[1], options.items, options.condition, options.comparison
+        )
+        if added or changed:
+            self.propagte_commands(input)
+        return Response(
+            200, RespParser.encode(added + changed if options.changed else added)
+        )
+
+    @command("ZINCRBY", 4, "write", "fast")
+    def cmd_zincrby(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        score = self.container.zincr_by(input[1], string_to_float(input[2]), input[3])
+        self.propagte_commands(input)
+        return Response(200, RespParser.encode(format_float(score)))
+
+    @command("ZREM", -3, "write", "fast")
+    def cmd_zrem(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        removed = self.container.zrem(input[1], input[2:])
+        if removed:
+            self.propagte_commands(input)
+        return Response(200, RespParser.encode(removed))
+
+    @command("ZSCORE", 3, "readonly", "fast")
+    def cmd_zscore(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        score = self.container.zscore(input[1], input[2])
+        return Response(
+            200, RespParser.encode(None if score is None else format_float(score))
+        )
+
+    @command("ZRANK", 3, "readonly", "fast")
+    def cmd_zrank(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(
+            200, RespParser.encode(self.container.zrank(input[1], input[2]))
+        )
+
+    @command("ZCARD", 2, "readonly", "fast")
+    def cmd_zcard(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.zcard(input[1])))
+
+    @command("ZCOUNT", 4, "readonly", "fast")
+    def cmd_zcount(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        count = self.container.zcount(
+            input[1], parse_score_bound(input[2]), parse_score_bound(input[3])
+        )
+        return Response(200, RespParser.encode(count))
+
+    @command("ZRANGE", -4, "readonly")
+    def cmd_zrange(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return self.zrange(input, ZrangeOptions.parse(input[4:]))
+
+    @command("ZRANGEBYSCORE", -4, "readonly")
+    def cmd_zrangebyscore(
+        self, input: list, peer_info: Tuple[str, int] | None
+    ) -> Response:
+        return self.zrange(input, ZrangeOptions.parse(input[4:], by_score=True))
+
+    def zrange(self, input: list, options: ZrangeOptions) -> Response:
+        if options.by_score:
+            low, high = parse_score_bound(input[2]), parse_score_bound(input[3])
+            if options.reverse:  # ZRANGE key max min BYSCORE REV
+                low, high = high, low
+            pairs = self.container.zrange_by_score(
+                input[1], low, high, options.reverse, options.offset, options.count
+            )
+        else:
+            pairs = self.container.zrange(
+                input[1], parse_int(input[2]), parse_int(input[3]), options.reverse
+            )
+        return Response(200, zset_reply(pairs, options.with_scores))
+
+    @command("INFO", -1)
+    def cmd_info(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        if len(input) > 2:
+            raise ValueError("ERR syntax error")
+        section = decode_id(input[1]).lower() if len(input) == 2 else "default"
+        return Response(200, RespParser.encode(self.get_info(section), type="bulk"))
+
+    @command("REPLCONF", -1, "admin")
+    def cmd_replconf(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        if len(input) == 3 and input[1].upper() == b"GETACK" and input[2] == b"*":
+            # Master asks for Ack
+            if self.role == "slave":
+                if self.from_master(peer_info):
                     return Response(
-                        200,
+                        201,
                         RespParser.encode(
-                            self.container.get(input[1]),
-                            type=(
-                                "bulk"
-                                if isinstance(self.container.get(input[1]), str)
-                                else ""
-                            ),
+                            [
+                                "REPLCONF",
+                                "ACK",
+                                f"{self.processed_commands_from_master}",
+                            ],
+                            type="bulk",
                         ),
-                    )
-                case "INFO":
-                    if len(input) != 2:
-                        raise ValueError("Invalid usage of GET")
-                    if input[1] == "replication":
-                        return Response(
-                            200,
-                            RespParser.encode(
-                                self.get_info(),
-                                type="bulk",
-                            ),
-                        )
-                case "REPLCONF":
-                    print("REPLCONF INPUT", input)
-                    if len(input) == 3 and input[1] == "GETACK" and input[2] == "*":
-                        # Master asks for Ack
-                        if input[2] == "*" and self.role == "slave":
-                            if self.from_master(peer_info):
-                                return Response(
-                                    201,
-                                    RespParser.encode(
-                                        [
-                                            "REPLCONF",
-                                            "ACK",
-                                            f"{self.processed_commands_from_master}",
-                                        ],
-                                        type="bulk",
-                                    ),
-                                )  # last arg should be #bytes that replica processed
-                            else:
-                                print("Not the master but sent an ACK request")
-                    elif len(input) == 3 and input[1] == "ACK":
-                        print("ACK FROM REPLICA", input)
-                        if self.wait and self.sent_commands[
-                            self.replica_addr_to_writer[peer_info]
-                        ] == int(input[2]):
-                            self.responded_replica += 1
-                        return Response(202, b"")
-                    return Response(200, RespParser.encode("OK"))
-                case "PSYNC":
-                    if self.role != "master":
-                        raise ValueError("Role is not a master but got PSYNC ")
-                    return Response(
-                        203,
-                        [
-                            RespParser.encode(
-                                f"FULLRESYNC {self.master_replid} {self.master_repl_offset}"
-                            ),
-                            RespParser.encode(RespParser.empty_rdb_hex, type="rdb"),
-                        ],
-                    )
-                case "WAIT":
-                    self.wait = True
-                    self.responded_replica = 0
-                    send_data = RespParser.encode(
-                        ["REPLCONF", "GETACK", "*"], type="bulk"
-                    )
-
-                    for wr in self.replicas.keys():
-                        if self.sent_commands[wr] == 0:
-                            print(
-                                "Haven't sent anything..."
-                            )  # No previous write operations. So don't have to ask.
-                            self.responded_replica += 1
-                        else:
-                            wr.write(send_data)
-                            await wr.drain()
-                    # For simplicity, we only send GET ACK ONCE. Rely on TCP's in-order ACK. If we sent A,B,C and got reply for C,
-                    # means A and B were transferred successfully.
-                    try:
-                        async with asyncio.timeout(int(input[2]) / 1000):
-                            while self.responded_replica < int(input[1]):
-                                await asyncio.sleep(0)
-                                continue
-                    except asyncio.TimeoutError:
-                        pass
-
-                    for wr in self.replicas.keys():
-                        if self.sent_commands[wr] > 0:
-                            self.sent_commands[wr] += len(send_data)
-                    return Response(200, RespParser.encode(self.responded_replica))
-                case "CONFIG":
-                    if len(input) >= 3 and input[1] == "GET":
-                        if input[2] == "dir":
-                            return Response(
-                                200,
-                                RespParser.encode(["dir", str(self.dir)], type="bulk"),
-                            )
-                        elif input[2] == "dbfilename":
-                            return Response(
-                                200,
-                                RespParser.encode(
-                                    ["dir", self.rdb_filename], type="bulk"
-                                ),
+                    )  # last arg should be #bytes that replica processed
+                else:
+                    logger.warning("GETACK from %s, which is not the master", peer_info)
+        elif len(input) == 3 and input[1].upper() == b"ACK":
+            if self.role != "master":
+                logger.warning("ACK from %s, but this is not a master", peer_info)
+                return Response(202, b"")
+            logger.debug("ACK %s from replica %s", input[2], peer_info)
+            wr = self.replica_addr_to_writer.get(peer_info)
+            if wr is not None:
+                self.replica_acked[wr] = max(
+                    self.replica_acked.get(wr, 0), parse_int(input[2])
+                )
+                self.replica_ack_time[wr] = now_ms()
+                self.resolve_wait_requests()
+            return Response(202, b"")
+        elif (
+            len(input) == 3
+            and input[1].lower() == b"listening-port"
+            and self.role == "master"
+        ):
+            self.replica_ports[peer_info] = parse_int(input[2])
+        return Response(200, RespParser.OK)
+
+    @command("PSYNC", -3, "admin")
+    def cmd_psync(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        if self.role != "master":
+            raise ValueError("Role is not a master but got PSYNC ")
+        if self.backlog is None:
+            self.backlog = ReplicationBacklog(self.repl_backlog_size)
+            self.backlog.offset = self.master_repl_offset
+        # PSYNC <replid> <offset + 1>, as sent by Redis replicas.
+        if len(input) == 3 and input[2].lstrip(b"-").isdigit():
+            offset = int(input[2]) - 1
+            if decode_id(input[1]) == self.master_replid and self.backlog.contains(
+                offset
+            ):
+                logger.info("Partial resync from offset %d", offset)
+                return Response(
+                    203,
+                    [RespParser.encode(f"CONTINUE {self.master_replid}")],
+                    repl_offset=offset,
+                )
+        # The snapshot is forked now, so it holds exactly the writes up to
+        # master_repl_offset. Later ones reach the replica from the backlog
+        # once the RDB is sent.
+        return Response(
+            203,
+            [
+                RespParser.encode(
+                    f"FULLRESYNC {self.master_replid} {self.master_repl_offset}"
+                ),
+                RdbSnapshot(self.container),
+            ],
+            repl_offset=self.master_repl_offset,
+        )
+
+    @command("SAVE", 1, "admin")
+    def cmd_save(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        if self.bgsave_in_progress():
+            raise ValueError("ERR Background save already in progress")
+        try:
+            RdbWriter.save(self.container, self.rdb_path())
+        except OSError as err:
+            raise ValueError(f"ERR {err}")
+        self.last_save_time = int(time.time())
+        return Response(200, RespParser.OK)
+
+    @command("BGSAVE", -1, "admin")
+    def cmd_bgsave(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        if self.bgsave_in_progress():
+            raise ValueError("ERR Background save already in progress")
+        self.bgsave_task = RdbWriter.bgsave(self.container, self.rdb_path())
+        self.bgsave_task.add_done_callback(self.bgsave_done)
+        return Response(200, RespParser.encode("Background saving started"))
+
+    @command("BGREWRITEAOF", 1, "admin")
+    def cmd_bgrewriteaof(
+        self, input: list, peer_info: Tuple[str, int] | None
+    ) -> Response:
+        if self.aof is None:
+            raise ValueError("ERR Append only file is not enabled")
+        if self.aof_rewrite_in_progress():
+            raise ValueError(
+                "ERR Background append only file rewriting already in progress"
+            )
+        self.rewrite_aof()
+        return Response(
+            200, RespParser.encode("Background append only file rewriting started")
+        )
+
+    @command("WAIT", 3, "blocking")
+    async def cmd_wait(
+        self, input: list, peer_info: Tuple[str, int] | None
+    ) -> Response:
+        # Replicas have no replicas of their own to wait for.
+        if self.role != "master":
+            raise ValueError("ERR WAIT cannot be used with replica instances")
+        numreplicas = parse_int(input[1])
+        timeout = parse_timeout(input[2])
+        # Every write sent so far must be acknowledged.
+        request = WaitRequest(
+            offset=self.master_repl_offset,
+            numreplicas=numreplicas,
+            done=asyncio.get_running_loop().create_future(),
+        )
+        if self.count_acked(request.offset) < request.numreplicas:
+            # Queued behind the propagated writes of this batch.
+            # Rely on TCP's in-order delivery: an ACK for this
+            # GETACK covers every write sent before it.
+            self.propagte_commands([b"REPLCONF", b"GETACK", b"*"], aof=False)
+            # Parked until enough ACKs arrive. Timeout 0 blocks forever.
+            self.wait_requests.append(request)
+            try:
+                async with asyncio.timeout(timeout or None):
+                    await request.done
+            except TimeoutError:
+                pass
+            finally:
+                self.wait_requests.remove(request)
+        return Response(200, RespParser.encode(self.count_acked(request.offset)))
+
+    @command("CONFIG", -2, "admin")
+    def cmd_config(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        if input[1].upper() != b"GET":
+            raise ValueError(
+                f"ERR unknown subcommand '{decode_id(input[1])}'. Try CONFIG HELP."
+            )
+        if len(input) != 3:
+            raise ValueError("ERR wrong number of arguments for 'config|get' command")
+        if input[2] == b"dir":
+            return Response(200, RespParser.encode(["dir", str(self.dir)], type="bulk"))
+        elif input[2] == b"dbfilename":
+            return Response(
+                200,
+                RespParser.encode(["dbfilename", self.rdb_filename], type="bulk"),
+            )
+        return Response(200, RespParser.EMPTY_ARRAY)
+
+    @command("KEYS", 2, "readonly")
+    def cmd_keys(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        keys = self.container.keys()
+        if input[1] != b"*":
+            keys = [key for key in keys if fnmatch.fnmatchcase(key, input[1])]
+        return Response(200, RespParser.encode(keys, type="bulk"))
+
+    @command("DEL", -2, "write")
+    def cmd_del(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        deleted = self.container.delete(input[1:])
+        if deleted:
+            self.propagte_commands(input)
+        return Response(200, RespParser.encode(deleted))
+
+    @command("TYPE", 2, "readonly", "fast")
+    def cmd_type(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        return Response(200, RespParser.encode(self.container.type_of(input[1])))
+
+    @command("OBJECT", -2, "readonly")
+    def cmd_object(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        if input[1].upper() == b"ENCODING" and len(input) == 3:
+            encoding = self.container.encoding_of(input[2])
+            return Response(200, RespParser.encode(encoding, type="bulk"))
+        raise ValueError(
+            f"ERR unknown subcommand or wrong number of arguments for "
+            f"'{decode_id(input[1])}'. Try OBJECT HELP."
+        )
+
+    @command("XADD", -5, "write")
+    def cmd_xadd(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        stream_key = input[1]
+        data = input[3:]
+        if len(data) % 2 != 0:
+            raise ValueError("ERR wrong number of arguments for 'xadd' command")
+        new_id = self.container.xadd(stream_key, decode_id(input[2]), data)
+        # With the ID resolved, so replicas and the AOF get the same.
+        new_id = format_stream_id(new_id)
+        self.propagte_commands([b"XADD", stream_key, new_id, *data])
+        return Response(200, b"+%s\r\n" % new_id)
+
+    @command("XRANGE", -4, "readonly")
+    def cmd_xrange(self, input: list, peer_info: Tuple[str, int] | None) -> Response:
+        start = parse_stream_id(decode_id(input[2]))
+        end = parse_stream_id(decode_id(input[3]), MAX_STREAM_ID[1])
+        count = None
+        if len(input) == 6 and input[4].lower() == b"count":
+            count = parse_int(input[5])
+        stream = self.container.get(input[1])
+        if isinstance(stream, StreamEntries):
+            l = stream.range(start, end, count)
+            return Response(200, RespParser.encode(l, type="bulk"))
+        return Response(200, RespParser.EMPTY_ARRAY)
+
+    @command("XREAD", -4, "readonly", "blocking")
+    async def cmd_xread(
+        self, input: list, peer_info: Tuple[str, int] | None
+    ) -> Response:
+        xread = Xread.parse(input)
+        res, entry_length = self.container.get_after_excl(
+            xread.stream_keys, xread.starts
+        )
+        if entry_length == 0 and xread.block:
+            # Park until an XADD to one of the keys, or the timeout.
+            # BLOCK 0 waits forever.
+            try:
+                async with asyncio.timeout(xread.block_duration or None):
+                    while entry_length == 0:
+                        waiter = self.container.add_stream_waiter(xread.stream_keys)
+                        try:
+                            await waiter
+                        finally:
+                            self.container.remove_stream_waiter(
+                                xread.stream_keys, waiter
                             )
-                case "KEYS":
-                    if len(input) == 2 and input[1] == "*":
-                        return Response(
-                            200,
-                            RespParser.encode(self.container.keys(), type="bulk"),
-                        )
-                case "TYPE":
-                    if len(input) == 2 and input[1] in self.container.kv:
-                        return Response(
-                            200,
-                            RespParser.encode(self.container.kv[input[1]].type),
-                        )
-                    else:
-                        return Response(
-                            200,
-                            RespParser.encode("none"),
-                        )
-                case "XADD":
-                    if len(input) < 3:
-                        raise ValueError("Invalid input")
-                    stream_key = input[1]
-                    stream_id = input[2]
-                    data = {}
-                    for i in range(3, len(input), 2):
-                        if i + 1 >= len(input):
-                            raise ValueError("Missing value")
-                        data[input[i]] = input[i + 1]
-                    try:
-                        self.container.set(
-                            key=stream_key, value=StreamEntry(id=stream_id, data=data)
-                        )
-                        entries = self.container.get(stream_key).entries
-                        return Response(
-                            200,
-                            RespParser.encode(entries[len(entries) - 1].id),
+                        res, entry_length = self.container.get_after_excl(
+                            xread.stream_keys, xread.starts
                         )
-                    except ValueError as err:
-                        return Response(
-                            200,
-                            RespParser.encode(
-                                str(err),
-                                type="err",
-                            ),
-                        )
-                case "XRANGE":
-                    stream_key = input[1]
-                    start = StreamEntry(id=input[2], data={})
-                    end = StreamEntry(id=input[3], data={})
-                    if stream_key in self.container.keys():
-                        entries = self.container.get(stream_key).entries
-
-                        # keys = [key_func(elem) for elem in entries]
-                        start_id = bisect.bisect_left(
-                            entries,
-                            StreamEntries.key_func(start),
-                            key=StreamEntries.key_func,
-                        )
-                        end_id_excl = bisect.bisect_right(
-                            entries,
-                            StreamEntries.key_func(end),
-                            key=StreamEntries.key_func,
-                        )
-                        l = entries[start_id:end_id_excl]
-                        return Response(200, RespParser.encode(l, type="bulk"))
-                    else:
-                        pass  # unknown key
-                case "XREAD":
-                    xread = Xread.parse(input)
-                    print("XREAD", xread)
-                    if xread.block:
-                        if xread.block_duration > 0:
-                            # Block this task for this period of time!
-                            await asyncio.sleep(xread.block_duration)
-                        else:  # block until there is an item added (busy wait)
-                            while result := self.container.get_after_excl(
-                                xread.stream_keys, xread.starts
-                            ):
-                                if result[1] > 0:
-                                    return Response(
-                                        200,
-                                        RespParser.encode(result[0], type="bulk"),
-                                    )
-                                await asyncio.sleep(0.1)
-
-                    res, entry_length = self.container.get_after_excl(
-                        xread.stream_keys, xread.starts
-                    )
-                    print("Result", res)
-                    if entry_length == 0:
-                        return Response(200, RespParser.encode(None))
-                    return Response(
-                        200,
-                        RespParser.encode(res, type="bulk"),
-                    )
-        print(f"Unknown command {input}")
-        return Response(400, b"")
+            except TimeoutError:
+                pass
+        if entry_length == 0:
+            return Response(200, RespParser.NULL)
+        return Response(200, RespParser.encode(res, type="bulk"))
+
+    def bgsave_in_progress(self) -> bool:
+        return self.bgsave_task is not None and not self.bgsave_task.done()
+
+    def bgsave_done(self, task: asyncio.Future) -> None:
+        self.last_bgsave_ok = task.exception() is None
+        if self.last_bgsave_ok:
+            self.last_save_time = int(time.time())
+            logger.info("Background saving terminated with success")
+        else:
+            logger.warning("Background saving error: %s", task.exception())
+
+    def aof_rewrite_in_progress(self) -> bool:
+        return self.aof_rewrite_task is not None and not self.aof_rewrite_task.done()
+
+    def rewrite_aof(self) -> None:
+        """
+        Start a BGREWRITEAOF, or schedule one after the current rewrite, whose
+        snapshot may predate e.g. a full resync.
+        """
+        if self.aof_rewrite_in_progress():
+            self.aof_rewrite_scheduled = True
+            return
+        self.aof_rewrite_scheduled = False
+        self.aof_rewrite_task = self.aof.rewrite(self.container)
+        self.aof_rewrite_task.add_done_callback(self.aof_rewrite_done)
+
+    def aof_rewrite_done(self, task: asyncio.Future) -> None:
+        self.last_aof_rewrite_ok = task.exception() is None
+        if self.last_aof_rewrite_ok:
+            logger.info("Background AOF rewrite finished successfully")
+        else:
+            logger.warning("Background AOF rewrite error: %s", task.exception())
+        if self.aof_rewrite_scheduled:
+            self.rewrite_aof()
+
+    def replica_lag_ms(self) -> int:
+        """
+        Milliseconds since the replica last had everything the master sent,
+        -1 before the first sync. An idle master still pings every
+        repl-ping-replica-period, so this stays low on a healthy link and
+        keeps growing once the link is lost.
+        """
+        if self.master_synced_at is None:
+            return -1
+        return now_ms() - self.master_synced_at
+
+    def is_stale(self) -> bool:
+        lag = self.replica_lag_ms()
+        return lag < 0 or lag > self.replica_max_lag_ms
 
-    def get_info(self) -> str:
+    async def ping_replicas(self) -> None:
+        """
+        PING the replicas every repl-ping-replica-period through the
+        replication stream, so they can tell an idle master from a lost one.
+        """
+        while True:
+            await asyncio.sleep(self.repl_ping_replica_period)
+            if self.replicas:
+                self.propagte_commands([b"PING"], aof=False)
+
+    def count_acked(self, offset: int) -> int:
+        return sum(1 for acked in self.replica_acked.values() if acked >= offset)
+
+    def resolve_wait_requests(self) -> None:
+        for request in self.wait_requests:
+            if (
+                not request.done.done()
+                and self.count_acked(request.offset) >= request.numreplicas
+            ):
+                request.done.set_result(None)
+
+    def get_info(self, section: str = "replication") -> str:
+        sections = {
+            "memory": self.get_memory_info,
+            "persistence": self.get_persistence_info,
+            "replication": self.get_replication_info,
+            "stats": self.get_stats_info,
+            "commandstats": self.get_commandstats_info,
+        }
+        if section in sections:
+            return sections[section]()
+        if section in ("all", "everything", "default"):
+            return "\n\n".join(
+                f"# {name.capitalize()}\n{info()}"
+                for name, info in sections.items()
+                if section != "default" or name != "commandstats"
+            )
+        return ""
+
+    def get_replication_info(self) -> str:
         if self.role == "slave":
-            return f"role:{self.role}"
+            last_io = lag = -1
+            if self.master_last_io is not None:
+                last_io = (now_ms() - self.master_last_io) // 1000
+                lag = self.replica_lag_ms()
+            return (
+                f"role:{self.role}\n"
+                f"master_host:{self.master_host}\n"
+                f"master_port:{self.master_port}\n"
+                f"master_link_status:{'up' if self.master_link_up else 'down'}\n"
+                f"master_last_io_seconds_ago:{last_io}\n"
+                f"slave_repl_offset:{self.processed_commands_from_master}\n"
+                f"slave_applied_commands:{self.repl_applied_commands}\n"
+                f"slave_apply_batches:{self.repl_apply_batches}\n"
+                f"slave_lag_ms:{lag}\n"
+                f"replica_max_lag_ms:{self.replica_max_lag_ms}\n"
+                f"master_replid:{self.master_replid}\n"
+                f"master_repl_offset:{self.processed_commands_from_master}"
+            )
         else:
-            return f"role:{self.role}\nmaster_replid:{self.master_replid}\nmaster_repl_offset:{self.master_repl_offset}"
+            # Like Redis: lag is the seconds since the replica's last ACK.
+            replicas = "".join(
+                f"slave{i}:ip={address[0]},"
+                f"port={self.replica_ports.get(address, address[1])},"
+                f"state=online,offset={self.replica_acked[wr]},"
+                f"lag={(now_ms() - self.replica_ack_time[wr]) // 1000}\n"
+                for i, (address, wr) in enumerate(self.replica_addr_to_writer.items())
+            )
+            return (
+                f"role:{self.role}\n"
+                f"connected_slaves:{len(self.replicas)}\n"
+                f"{replicas}"
+                f"master_replid:{self.master_replid}\n"
+                f"master_repl_offset:{self.master_repl_offset}"
+            )
+
+    def get_memory_info(self) -> str:
+        return (
+            f"used_memory:{self.container.used_memory}\n"
+            f"maxmemory:{self.container.maxmemory}\n"
+            f"maxmemory_policy:{self.container.maxmemory_policy}"
+        )
+
+    def get_persistence_info(self) -> str:
+        return (
+            f"rdb_bgsave_in_progress:{int(self.bgsave_in_progress())}\n"
+            f"rdb_last_save_time:{self.last_save_time}\n"
+            f"rdb_last_bgsave_status:{'ok' if self.last_bgsave_ok else 'err'}\n"
+            f"aof_enabled:{int(self.aof is not None)}\n"
+            f"aof_rewrite_in_progress:{int(self.aof_rewrite_in_progress())}\n"
+            f"aof_rewrite_scheduled:{int(self.aof_rewrite_scheduled)}\n"
+            f"aof_last_bgrewrite_status:{'ok' if self.last_aof_rewrite_ok else 'err'}\n"
+            f"aof_last_write_status:"
+            f"{'ok' if self.aof is None or self.aof.last_write_ok else 'err'}"
+        )
+
+    def get_stats_info(self) -> str:
+        return (
+            f"expired_keys:{self.container.expired_keys}\n"
+            f"evicted_keys:{self.container.evicted_keys}\n"
+            f"expire_cycle_cpu_milliseconds:{int(self.container.expire_cycle_cpu_ms)}\n"
+            f"expire_cycle_last_duration_us:{self.container.expire_cycle_last_us}\n"
+            "client_output_buffer_limit_disconnections:"
+            f"{self.output_limit_disconnections}"
+        )
+
+    def get_commandstats_info(self) -> str:
+        return "\n".join(
+            f"cmdstat_{command.name}:calls={command.calls},"
+            f"usec={command.duration_ns // 1000},"
+            f"usec_per_call={command.duration_ns / 1000 / max(command.calls, 1):.2f},"
+            f"rejected_calls={command.rejected_calls},"
+            f"failed_calls={command.failed_calls}"
+            for command in COMMANDS.values()
+            if command.calls or command.rejected_calls
+        )
 
-    async def propagte_commands(self, input: list | int | str) -> None:
-        if self.role == "master":
-            for wr in self.replicas.keys():
+    def propagate_deletion(self, key) -> None:
+        """Propagate a key evicted by the container as a DEL, like Redis."""
+        self.propagte_commands([b"DEL", key])
+
+    def propagte_commands(self, input: list | int | str, aof: bool = True) -> None:
+        """
+        Queue a write command for every replica and, unless aof is False, for
+        the AOF. The AOF is written by flush_aof() together with the rest of
+        the batch, each replica by the task draining its ReplicaOutput.
+        """
+        d = None
+        if aof and self.aof is not None:
+            d = RespParser.encode(input, type="bulk")
+            self.aof.feed(d)
+        if self.role == "master" and self.backlog is not None:
+            if d is None:
                 d = RespParser.encode(input, type="bulk")
-                wr.write(d)
-                self.sent_commands[wr] += len(d)
-                await wr.drain()
-                print("Propagete Done!")
+            self.backlog.feed(d)
+            self.master_repl_offset += len(d)
+            over_limit = [
+                wr for wr, output in self.replica_buffers.items() if not output.write(d)
+            ]
+            for wr in over_limit:
+                self.drop_replica(wr)
+
+    async def flush_aof(self) -> None:
+        """Write the batch to the AOF, before its replies are sent."""
+        if self.aof is not None:
+            await self.aof.flush()
+
+    def drop_replica(self, wr: asyncio.StreamWriter) -> None:
+        """Disconnect a replica over its client-output-buffer-limit."""
+        address = wr.get_extra_info("peername")
+        logger.warning(
+            "Replica %s closed for overcoming of output buffer limits: %d bytes",
+            address,
+            self.replica_buffers[wr].usage(),
+        )
+        self.output_limit_disconnections += 1
+        self.discard_wr(wr, address)
+        wr.transport.abort()
+
+    def add_replica(
+        self,
+        reader: asyncio.StreamReader,
+        wr: asyncio.StreamWriter,
+        address: Tuple[str, int],
+        offset: int,
+    ) -> bool:
+        """
+        Start streaming to a replica that has everything up to offset: send
+        the backlog from there, then every propagated command. Returns False
+        if the backlog no longer reaches back to offset, or if that is more
+        than the replica's output buffer limit.
+        """
+        if not self.backlog.contains(offset):
+            logger.warning("Replica %s fell out of the backlog", address)
+            return False
+        self.replicas[wr] = reader
+        self.replica_addr_to_writer[address] = wr
+        output = ReplicaOutput(wr, self.replica_output_limit, self.output_high_water)
+        self.replica_buffers[wr] = output
+        self.replica_acked[wr] = offset
+        self.replica_ack_time[wr] = now_ms()
+        if offset < self.master_repl_offset:
+            if not output.write(self.backlog.get_from(offset)):
+                self.drop_replica(wr)
+                return False
+        return True
 
     def discard_wr(self, wr: asyncio.StreamWriter, address: Tuple[str, int]) -> None:
-        if self.role == "master" and wr in self.replicas.keys():
+        if self.role != "master":
+            return
+        self.replica_ports.pop(address, None)
+        if wr in self.replicas.keys():
             self.replicas.pop(wr)
             self.replica_addr_to_writer.pop(address)
-            print(f"Replica disconncted: {address}")
+            self.replica_buffers.pop(wr).close()
+            self.replica_acked.pop(wr, None)
+            self.replica_ack_time.pop(wr, None)
+            logger.info("Replica disconnected: %s", address)
@@ -1,6 +1,6 @@
-from typing import Final, Literal
+from typing import Any, Final, Literal, Tuple
 
-from app.container import StreamEntry
+from app.container import StreamEntry, format_stream_id
 
 
 class RespParser:
@@ -9,39 +9,85 @@ class RespParser:
         "524544495330303131fa0972656469732d76657205372e322e30fa0a72656469732d62697473c040fa056374696d65c26d08bc65fa08757365642d6d656dc2b0c41000fa08616f662d62617365c000fff06e3bfec0ff5aa2"
     )
 
+    # Hot replies, encoded once.
+    OK: Final[bytes] = b"+OK\r\n"
+    PONG: Final[bytes] = b"+PONG\r\n"
+    NULL: Final[bytes] = b"$-1\r\n"
+    EMPTY_ARRAY: Final[bytes] = b"*0\r\n"
+    NULL_ARRAY: Final[bytes] = b"*-1\r\n"
+    SMALL_INTS: Final[tuple[bytes, ...]] = tuple(b":%d\r\n" % i for i in range(1024))
+
     @staticmethod
     def encode(
-        data: str | int | bytes | list | None,
+        data: str | int | bytes | bytearray | list | None,
         type: Literal["", "bulk", "rdb", "err"] = "",
     ) -> bytes:
+        # Most frequent replies first: nil and bulk strings for GET, simple
+        # strings such as OK, and integers. Exact class checks are cheaper
+        # than isinstance(); subclasses take the slower checks below.
+        kind = data.__class__
+        if kind is bytes and type != "err":
+            return b"$%d\r\n%s\r\n" % (len(data), data)
+        if kind is str and not type:
+            if data == "OK":
+                return RespParser.OK
+            return b"+%s\r\n" % data.encode()
+        if kind is str and type == "bulk":
+            data = data.encode()
+            return b"$%d\r\n%s\r\n" % (len(data), data)
         if data is None:
-            return f"$-1\r\n".encode()
-        elif type == "err":
-            return f"-{data}\r\n".encode()
-        elif isinstance(data, StreamEntry):
-            data_in_list = []
-            for k, v in data.data.items():
-                data_in_list.append(k)
-                data_in_list.append(v)
-            return RespParser.encode([data.id, data_in_list], type)
-        elif isinstance(data, int):
-            return f":{data}\r\n".encode()
+            return RespParser.NULL
+        if kind is int and type != "err":
+            if 0 <= data < 1024:
+                return RespParser.SMALL_INTS[data]
+            return b":%d\r\n" % data
+        if type == "err":
+            return b"-%s\r\n" % str(data).encode()
+        if isinstance(data, (bytes, bytearray)):
+            return b"$%d\r\n%s\r\n" % (len(data), data)
+        if isinstance(data, str):
+            if type == "rdb":
+                content = bytes.fromhex(data)
+                return b"$%d\r\n%s" % (len(content), content)
+            data = data.encode()
+            if type == "bulk":
+                return b"$%d\r\n%s\r\n" % (len(data), data)
+            return b"+%s\r\n" % data
+        if isinstance(data, int):
+            if 0 <= data < 1024:
+                return RespParser.SMALL_INTS[data]
+            return b":%d\r\n" % data
+        if isinstance(data, (list, StreamEntry)):
+            buf = bytearray()
+            RespParser._encode_into(buf, data, type)
+            return bytes(buf)
+        raise ValueError("Unsupported data type for encoding")
+
+    @staticmethod
+    def _encode_into(
+        buf: bytearray,
+        data: str | int | bytes | list | None,
+        type: Literal["", "bulk", "rdb", "err"],
+    ) -> None:
+        """Append the encoding of data to buf without building intermediate strings."""
+        if isinstance(data, StreamEntry):
+            buf += b"*2\r\n"
+            RespParser._encode_into(buf, format_stream_id(data.id), type)
+            RespParser._encode_into(buf, data.data, type)
         elif isinstance(data, list):
-            encoded_elements = b"".join(
-                [RespParser.encode(element, type) for element in data]
-            )
-            return f"*{len(data)}\r\n".encode() + encoded_elements
-        elif isinstance(data, bytes):
-            return f"${len(data)}\r\n{data.decode('utf-8')}\r\n".encode()
-        elif isinstance(data, str) and type == "bulk":
-            return f"${len(data)}\r\n{data}\r\n".encode()
-        elif isinstance(data, str) and type == "rdb":
-            content = bytes.fromhex(data)
-            return f"${len(content)}\r\n".encode() + content
-        elif isinstance(data, str):
-            return f"+{data}\r\n".encode()
+            buf += b"*%d\r\n" % len(data)
+            for element in data:
+                RespParser._encode_into(buf, element, type)
+        elif isinstance(data, (bytes, bytearray)) or (
+            isinstance(data, str) and type == "bulk"
+        ):
+            if isinstance(data, str):
+                data = data.encode()
+            buf += b"$%d\r\n" % len(data)
+            buf += data
+            buf += b"\r\n"
         else:
-            raise ValueError("Unsupported data type for encoding")
+            buf += RespParser.encode(data, type)
 
     @staticmethod
     def decode(data: bytes, type: Literal["", "bulk", "rdb"] = ""):
@@ -81,6 +127,164 @@ class RespParser:
             raise ValueError("Unsupported RESP data type")
 
 
+class RespDecoder:
+    """
+    Incremental RESP decoder for a single connection.
+
+    Received chunks are appended to one bytearray and decoded in place with a
+    cursor, so every complete frame in a chunk is returned and a partial frame
+    is resumed on the next chunk without re-scanning the elements already
+    decoded.
+
+    In binary mode bulk strings are returned as bytes, copied once out of the
+    receive buffer, instead of being decoded to str. This keeps keys and values
+    binary-safe from the socket to the reply.
+    """
+
+    _INCOMPLETE: Final = object()
+
+    def __init__(self, binary: bool = False) -> None:
+        self.binary = binary
+        self.buffer = bytearray()
+        self.pos = 0  # cursor of the next byte to decode
+        self.frame_start = 0  # start of the frame currently being decoded
+        self.stack: list[list] = []  # [remaining elements, elements] per array
+        self.need = 0  # buffer length required before a bulk string can complete
+
+    def feed(self, data: bytes) -> list[Tuple[Any, int]]:
+        """
+        Append data and return every complete frame as (frame, length in bytes)
+        """
+        self.buffer += data
+        frames = []
+        if len(self.buffer) >= self.need:
+            with memoryview(self.buffer) as view:
+                while True:
+                    frame = self._INCOMPLETE
+                    if not self.stack:
+                        frame = self._decode_command(view)
+                    if frame is self._INCOMPLETE:
+                        frame = self._decode_frame(view)
+                        if frame is self._INCOMPLETE:
+                            break
+                    frames.append((frame, self.pos - self.frame_start))
+                    self.frame_start = self.pos
+        self._compact()
+        return frames
+
+    @property
+    def remaining(self) -> bytes:
+        """Bytes received but not yet returned as part of a complete frame."""
+        return bytes(self.buffer[self.frame_start :])
+
+    def _compact(self) -> None:
+        if self.frame_start == 0:
+            return
+        del self.buffer[: self.frame_start]
+        self.pos -= self.frame_start
+        self.need = max(self.need - self.frame_start, 0)
+        self.frame_start = 0
+
+    def _decode_command(self, view: memoryview) -> Any:
+        """
+        Fast path for the frames nearly all traffic consists of, a complete
+        array of bulk strings such as a command, decoded in one pass without
+        the element stack. Anything else, including a frame that is not
+        complete yet, is left to _decode_frame(), which also reports the
+        protocol errors.
+        """
+        buffer = self.buffer
+        pos = self.pos
+        size = len(buffer)
+        if pos >= size or buffer[pos] != 0x2A:  # * array
+            return self._INCOMPLETE
+        end = buffer.find(b"\r\n", pos)
+        if end == -1:
+            return self._INCOMPLETE
+        try:
+            count = int(buffer[pos + 1 : end])
+            pos = end + 2
+            elements = []
+            for _ in range(count):
+                if pos >= size or buffer[pos] != 0x24:  # $ bulk string
+                    return self._INCOMPLETE
+                end = buffer.find(b"\r\n", pos)
+                if end == -1:
+                    return self._INCOMPLETE
+                pos = end + 2 + int(buffer[pos + 1 : end])
+                if pos <= end + 1 or buffer[pos : pos + 2] != b"\r\n":
+                    return self._INCOMPLETE
+                if self.binary:
+                    elements.append(view[end + 2 : pos].tobytes())
+                else:
+                    elements.append(str(view[end + 2 : pos], "utf-8"))
+                pos += 2
+        except ValueError:
+            return self._INCOMPLETE
+        if not elements:  # empty or null array
+            return self._INCOMPLETE
+        self.pos = pos
+        return elements
+
+    def _decode_frame(self, view: memoryview) -> Any:
+        while True:
+            value = self._decode_value(view)
+            if value is self._INCOMPLETE:
+                return value
+            while self.stack:
+                top = self.stack[-1]
+                top[1].append(value)
+                top[0] -= 1
+                if top[0] > 0:
+                    break
+                value = self.stack.pop()[1]
+            if not self.stack:
+                return value
+
+    def _decode_value(self, view: memoryview) -> Any:
+        buffer = self.buffer
+        while True:
+            start = self.pos
+            end = buffer.find(b"\r\n", start)
+            if end == -1:
+                return self._INCOMPLETE
+            prefix = buffer[start]
+            try:
+                if prefix == 0x24:  # $ bulk string
+                    length = int(view[start + 1 : end])
+                    if length == -1:
+                        self.pos = end + 2
+                        return None
+                    body_end = end + 2 + length
+                    if len(buffer) < body_end + 2:
+                        self.need = body_end + 2
+                        return self._INCOMPLETE
+                    if view[body_end : body_end + 2] != b"\r\n":
+                        raise RespParserError("Invalid Input")
+                    self.pos = body_end + 2
+                    if self.binary:
+                        return view[end + 2 : body_end].tobytes()
+                    return str(view[end + 2 : body_end], "utf-8")
+                elif prefix == 0x2A:  # * array
+                    length = int(view[start + 1 : end])
+                    self.pos = end + 2
+                    if length == -1:
+                        return None
+                    if length == 0:
+                        return []
+                    self.stack.append([length, []])
+                    continue
+                elif prefix == 0x2B or prefix == 0x2D:  # + simple string, - error
+                    self.pos = end + 2
+                    return str(view[start + 1 : end], "utf-8")
+                elif prefix == 0x3A:  # : integer
+                    self.pos = end + 2
+                    return int(view[start + 1 : end])
+            except ValueError:
+                raise RespParserError("Invalid Input")
+            raise RespParserError("Unsupported RESP data type")
+
+
 class RespParserError(Exception):
 
     def __init__(self, message: str) -> None:
@@ -1,53 +1,127 @@
 import asyncio
+import contextlib
 from datetime import datetime
 from pathlib import Path
+import logging
+import os
 import socket
 import sys
+import tempfile
 from typing import Any, Callable
 
-from app.resp_parser import RespParser, RespParserError
-from app.request_handler import RequestHandler
+from app.resp_parser import RespDecoder, RespParser, RespParserError
+from app.aof import DEFAULT_APPENDFILENAME
+from app.clock import now_ms
+from app.log import VERBOSE
+from app.output_buffer import DEFAULT_HIGH_WATER, OutputBuffer
+from app.rdb_parser import RdbParseError
+from app.rdb_writer import RdbSnapshot
+from app.replication import (
+    DEFAULT_BACKLOG_SIZE,
+    DEFAULT_REPL_PING_REPLICA_PERIOD,
+    DEFAULT_REPLICA_OUTPUT_LIMIT,
+    REPLICA_ACK_PERIOD,
+    OutputBufferLimit,
+)
+from app.request_handler import RequestHandler, Response
+
+READ_CHUNK_SIZE = 64 * 1024
+# The replication stream is read in larger chunks and applied a chunk at a time.
+REPL_READ_CHUNK_SIZE = 1024 * 1024
+# Seconds to wait for each reply of the handshake, and between attempts to
+# (re)connect to the master.
+MASTER_TIMEOUT = 10
+MASTER_RETRY_DELAY = 1
+
+logger = logging.getLogger(__name__)
 
 
 async def handle_client(
     reader: asyncio.StreamReader,
     writer: asyncio.StreamWriter,
     request_handler: RequestHandler,
+    output_high_water: int = DEFAULT_HIGH_WATER,
 ):
     address = writer.get_extra_info("peername")
-    print(f"Connected to {address}")
-    data = b""
+    logger.log(VERBOSE, "Accepted %s", address)
+    decoder = RespDecoder(binary=True)
+    output = OutputBuffer(writer, output_high_water)
     while True:
-        data += await reader.read(1024)  # Read up to 1024 bytes
+        data = await reader.read(READ_CHUNK_SIZE)
         if not data:
             break
         try:
-            parsed, _ = RespParser.decode(data)
-            print(f"Received {parsed} from {address}")
+            frames = decoder.feed(data)
+        except RespParserError as err:
+            logger.warning("%s from %s: %r", err, address, decoder.remaining)
+            # Like Redis, tell the client why before closing the connection.
+            output.write(RespParser.encode(f"ERR Protocol error: {err}", type="err"))
+            with contextlib.suppress(ConnectionError):
+                await output.flush()
+            break
+        # Answer every pipelined command of this chunk in order.
+        closing = False
+        for parsed, _ in frames:
+            logger.debug("Received %s from %s", parsed, address)
 
             ret = await request_handler.handle(parsed, address)
-            if ret.code == 203:
-                request_handler.replicas[writer] = reader
-                request_handler.replica_addr_to_writer[address] = writer
             if ret.code == 400:
                 continue
+            if ret.code == 203:
+                closing = not await attach_replica(
+                    reader, writer, output, request_handler, ret
+                )
+                if closing:
+                    break
+                continue
             if isinstance(ret.data, list):
                 for item in ret.data:
-                    writer.write(item)
+                    output.write(item)
             else:
-                writer.write(ret.data)
-            await writer.drain()
-            print(f"Sent")
-            data = b""
-        except RespParserError as err:
-            print(f"[WARNING] {err}: {data}")
-            if len(data) == 0:
-                break
+                output.write(ret.data)
+            if output.over_high_water():
+                await request_handler.flush_aof()
+                await output.flush()
+        if closing:
+            break
+        # One write and one drain per chunk for the replies. The AOF goes
+        # first: with appendfsync always nothing is acknowledged before it is
+        # on disk. Replicas are written by tasks of their own.
+        await request_handler.flush_aof()
+        await output.flush()
     # comes here only when the connection is closed.
-    print(f"Closed connection to {address}")
+    logger.log(VERBOSE, "Closed connection to %s", address)
     writer.close()
     request_handler.discard_wr(writer, address)
-    await writer.wait_closed()
+    with contextlib.suppress(ConnectionError):
+        await writer.wait_closed()
+
+
+async def attach_replica(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    output: OutputBuffer,
+    request_handler: RequestHandler,
+    ret: Response,
+) -> bool:
+    """
+    Send the PSYNC reply, streaming the RDB for a full resync, then hand the
+    connection to the replica buffers. Returns False if it must be closed.
+    """
+    address = writer.get_extra_info("peername")
+    for item in ret.data:
+        if isinstance(item, RdbSnapshot):
+            await output.flush()
+            try:
+                await item.stream_to(writer)
+            except OSError as err:
+                logger.warning("Cannot send RDB to %s: %s", address, err)
+                return False
+        else:
+            output.write(item)
+    # Everything after the handshake goes through the replica buffer.
+    await output.flush()
+    return request_handler.add_replica(reader, writer, address, ret.repl_offset)
 
 
 class Server:
@@ -59,8 +133,19 @@ class Server:
         master_port: int | None = None,
         dir: Path | None = None,
         rdbfilename: str | None = None,
+        output_high_water: int = DEFAULT_HIGH_WATER,
+        repl_backlog_size: int = DEFAULT_BACKLOG_SIZE,
+        maxmemory: int = 0,
+        maxmemory_policy: str = "noeviction",
+        appendonly: bool = False,
+        appendfsync: str = "everysec",
+        appendfilename: str = DEFAULT_APPENDFILENAME,
+        repl_ping_replica_period: int = DEFAULT_REPL_PING_REPLICA_PERIOD,
+        replica_max_lag_ms: int = 0,
+        replica_output_limit: OutputBufferLimit = DEFAULT_REPLICA_OUTPUT_LIMIT,
     ) -> None:
         self.port = port
+        self.output_high_water = output_high_water
         self.master_replid = None
         self.master_repl_offset = None
         self.role = role
@@ -87,52 +172,101 @@ class Server:
             master_repl_offset=self.master_repl_offset,
             dir=dir,
             rdbfilename=rdbfilename,
+            output_high_water=output_high_water,
+            repl_backlog_size=repl_backlog_size,
+            maxmemory=maxmemory,
+            maxmemory_policy=maxmemory_policy,
+            appendonly=appendonly,
+            appendfsync=appendfsync,
+            appendfilename=appendfilename,
+            repl_ping_replica_period=repl_ping_replica_period,
+            replica_max_lag_ms=replica_max_lag_ms,
+            replica_output_limit=replica_output_limit,
         )
 
     async def talk_to_master(self, master_host: str, master_port: int) -> None:
-        reader, writer = await asyncio.open_connection(master_host, master_port)
-        print(f"Connected to master at {master_host}:{master_port}")
+        # Reconnect whenever the link drops. Once a FULLRESYNC told us the
+        # master's replid, reconnects ask for a partial resync from our offset.
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(
+                    master_host, master_port, limit=REPL_READ_CHUNK_SIZE
+                )
+            except OSError as err:
+                logger.warning("Cannot connect to master: %s", err)
+                await asyncio.sleep(MASTER_RETRY_DELAY)
+                continue
+            logger.info("Connected to master at %s:%s", master_host, master_port)
+            try:
+                await self.sync_with_master(reader, writer)
+            except (
+                OSError,
+                ValueError,
+                RespParserError,
+                asyncio.IncompleteReadError,
+            ) as err:
+                # OSError covers ConnectionError and a handshake TimeoutError,
+                # the others are replies that make no sense. All are retried.
+                logger.warning("Lost connection to master: %r", err)
+            finally:
+                writer.close()
+            await asyncio.sleep(MASTER_RETRY_DELAY)
 
-        data = await self.handshake_with_master(reader, writer)
-        print(f"[After handshake]: {data}")
+    async def sync_with_master(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        await self.handshake_with_master(reader, writer)
+        handler = self.request_handler
+        handler.master_link_up = True
+        ack_task = asyncio.create_task(self.ack_master(writer))
+        decoder = RespDecoder(binary=True)
+        peer_info = writer.get_extra_info("peername")
         try:
             while True:
+                data = await reader.read(REPL_READ_CHUNK_SIZE)
+                handler.master_last_io = now_ms()
+                if not data:
+                    logger.info("Master closed the connection")
+                    break
                 try:
-                    while (
-                        len(data) > 0
-                    ):  # Process multiple commands came as a chunk in data!
-                        before_process_length = len(data)
-                        parsed, data = RespParser.decode(data)
-                        ret = await self.request_handler.handle(
-                            parsed, peer_info=writer.get_extra_info("peername")
-                        )
-                        if ret.code == 201:
-                            print(f"Returning: {ret.data}")
-                            writer.write(ret.data)
-                            await writer.drain()
-                        self.request_handler.processed_commands_from_master += (
-                            before_process_length - len(data)
-                        )
-                    data += await reader.read(1024)
-                    print("From master", data)
-                    if not data:
-                        print("Master closed the connection.")
-                        break
+                    frames = decoder.feed(data)
                 except RespParserError as err:
-                    print(f"[WARNING] {err}: {data}")
-                    pass
-        except asyncio.CancelledError:
-            pass
+                    logger.warning("%s from master: %r", err, decoder.remaining)
+                    break
+                replies = handler.apply_from_master(frames, peer_info)
+                await handler.flush_aof()
+                if replies:
+                    writer.writelines(replies)
+                    await writer.drain()
+                if len(data) < REPL_READ_CHUNK_SIZE:
+                    # A short read means nothing more was waiting, so as of
+                    # the read the replica had all the master had sent.
+                    handler.master_synced_at = handler.master_last_io
         finally:
-            writer.close()
-            await writer.wait_closed()
+            ack_task.cancel()
+            handler.master_link_up = False
+
+    async def ack_master(self, writer: asyncio.StreamWriter) -> None:
+        """
+        REPLCONF ACK the processed offset every second, without waiting for
+        a GETACK, like Redis replicas, so the master always knows the lag.
+        """
+        while True:
+            await asyncio.sleep(REPLICA_ACK_PERIOD)
+            offset = self.request_handler.processed_commands_from_master
+            writer.write(
+                RespParser.encode(["REPLCONF", "ACK", str(offset)], type="bulk")
+            )
 
     async def handshake_with_master(
         self,
         reader: asyncio.StreamReader,
         writer: asyncio.StreamWriter,
-        timeout: int = 10,
-    ) -> bytes:
+        timeout: float | None = None,
+    ) -> None:
+        if timeout is None:
+            timeout = MASTER_TIMEOUT
+
         async def send_and_wait(
             send_data: bytes, stop: Callable[[bytes], int]
         ) -> bytes:
@@ -142,9 +276,13 @@ class Server:
                 recvd_bytes: bytes = b""
                 start = datetime.now()
                 while True:
-                    recvd_bytes += await reader.read(1024)
+                    async with asyncio.timeout(timeout):
+                        chunk = await reader.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        raise ConnectionError("Master closed the connection")
+                    recvd_bytes += chunk
                     processed = stop(recvd_bytes)
-                    if stop(recvd_bytes) > 0:
+                    if processed > 0:
                         return recvd_bytes[processed:]
                     if (datetime.now() - start).total_seconds() > timeout:
                         break
@@ -154,7 +292,7 @@ class Server:
             RespParser.encode(["PING"], type="bulk"),
             lambda x: len(x) if RespParser.decode(x)[0] == "PONG" else 0,
         )
-        print("[Handshake] Ping completed")
+        logger.log(VERBOSE, "Handshake: PING completed")
 
         # Second, REPLCONF messages
         await send_and_wait(
@@ -163,41 +301,95 @@ class Server:
             ),
             lambda x: len(x) if RespParser.decode(x)[0] == "OK" else 0,
         )
-        print("[Handshake] Replconf completed [1]")
+        logger.log(VERBOSE, "Handshake: REPLCONF listening-port completed")
         await send_and_wait(
             RespParser.encode(["REPLCONF", "capa", "psync2"], type="bulk"),
             lambda x: len(x) if RespParser.decode(x)[0] == "OK" else 0,
         )
-        print("[Handshake] Replconf completed [2]")
-
-        def get_psync_resp(x: bytes) -> int:
-            print("[PSYNC]", x)
-            length_idx = x.find(b"$")
-            length_end_idx = x.find(b"\r\n", length_idx)
-            if length_idx != -1 and length_end_idx != -1:
-                length = int(x[length_idx + 1 : length_end_idx])
-                if RespParser.decode(x[:length_idx])[0].startswith(
-                    "FULLRESYNC"
-                ) and length <= len(x) - (length_end_idx + 2):
-                    return (length_end_idx + 2) + length
-            return 0
-
-        resp = await send_and_wait(
-            RespParser.encode(["PSYNC", "?", "-1"], type="bulk"),
-            get_psync_resp,
+        logger.log(VERBOSE, "Handshake: REPLCONF capa completed")
+
+        # Finally PSYNC. The replies are read line by line so the RDB can be
+        # received into a file, and the command stream that follows it stays
+        # in the reader.
+        replid = self.request_handler.master_replid
+        offset = self.request_handler.processed_commands_from_master
+        writer.write(
+            RespParser.encode(
+                ["PSYNC", replid or "?", str(offset + 1) if replid else "-1"],
+                type="bulk",
+            )
         )
-        print(f"[Handshake] PSYNC completed")
-        return resp
+        await writer.drain()
+        async with asyncio.timeout(timeout):
+            line = (await reader.readline()).decode().split()
+        if not line:
+            raise ConnectionError("Master closed the connection")
+        if line[0] == "+CONTINUE":
+            # Partial resync: the backlog follows, no RDB.
+            if len(line) > 1:
+                self.request_handler.master_replid = line[1]
+        elif line[0] == "+FULLRESYNC" and len(line) == 3:
+            master_offset = int(line[2])
+            await self.receive_rdb(reader)
+            self.request_handler.master_replid = line[1]
+            self.request_handler.processed_commands_from_master = master_offset
+        else:
+            raise ConnectionError(f"Unexpected PSYNC reply {line}")
+        logger.info("Handshake: PSYNC completed with %s", line[0][1:])
+
+    async def receive_rdb(self, reader: asyncio.StreamReader) -> None:
+        """Receive the "$<size>\r\n<payload>" RDB into a file and load it."""
+        header = b""
+        while not header.strip():  # newlines are keepalives while it is saved
+            header = await reader.readline()
+            if not header:
+                raise ConnectionError("Master closed the connection")
+        size = header.strip()[1:]
+        if not header.startswith(b"$") or not size.isdigit():
+            raise ConnectionError(f"Unexpected RDB header {header!r}")
+        remaining = int(size)
+        fd, name = tempfile.mkstemp(prefix="temp-repl-", suffix=".rdb")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                while remaining:
+                    chunk = await reader.read(min(remaining, READ_CHUNK_SIZE))
+                    if not chunk:
+                        raise ConnectionError("Master closed the connection")
+                    file.write(chunk)
+                    remaining -= len(chunk)
+            self.request_handler.container.flushall()
+            try:
+                self.request_handler.load_rdb(Path(name))
+            except RdbParseError as err:
+                # Dropped like a broken link, so the sync is retried.
+                raise ConnectionError(f"Bad RDB from master: {err}") from None
+        finally:
+            os.unlink(name)
+        if self.request_handler.aof is not None:
+            # The AOF still describes the dataset that was just replaced.
+            self.request_handler.rewrite_aof()
+        logger.info("RDB from master loaded")
 
     async def start(self) -> None:
+        await self.request_handler.open_aof()
         server = await asyncio.start_server(
-            lambda r, w: handle_client(r, w, self.request_handler),
+            lambda r, w: handle_client(
+                r, w, self.request_handler, self.output_high_water
+            ),
             "localhost",
             self.port,
             reuse_port=True,
             family=socket.AF_INET,
         )
-        tasks = [server.serve_forever()]
+        tasks = [
+            server.serve_forever(),
+            asyncio.create_task(self.request_handler.container.active_expire()),
+        ]
+        aof = self.request_handler.aof
+        if aof is not None and aof.appendfsync == "everysec":
+            tasks.append(asyncio.create_task(aof.fsync_loop()))
+        if self.role == "master":
+            tasks.append(asyncio.create_task(self.request_handler.ping_replicas()))
         if self.role == "slave":
             tasks.append(
                 asyncio.create_task(
@@ -206,7 +398,7 @@ class Server:
             )
 
         address = server.sockets[0].getsockname()
-        print(f"Serving on {address}")
+        logger.info("Serving on %s", address)
 
         async with server:
             await asyncio.gather(*tasks)
@@ -0,0 +1,55 @@
+"""
+GET/SET throughput of Container, with and without TTLs.
+
+Runs inside an event loop so the cached clock behaves as in the server.
+
+Usage: python -m benchmarks.container [--keys N]
+"""
+
+import argparse
+import asyncio
+import time
+
+from app.clock import now_ms
+from app.container import Container
+
+
+def report(name: str, ops: int, elapsed: float) -> None:
+    print(f"{name:<20}{ops / elapsed:>16,.0f} ops/s")
+
+
+async def run(keys: int) -> None:
+    container = Container()
+    names = [b"key:%d" % i for i in range(keys)]
+    value = b"v" * 64
+
+    start = time.perf_counter()
+    for key in names:
+        container.set(key, value)
+    report("SET", keys, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for key in names:
+        container.set(key, value, expire_at=now_ms() + 60_000)
+    report("SET px", keys, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for key in names:
+        container.get(key)
+    report("GET (with TTL)", keys, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for key in names:
+        container.get(b"missing")
+    report("GET (miss)", keys, time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--keys", type=int, default=1_000_000)
+    args = parser.parse_args()
+    asyncio.run(run(args.keys))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Encode throughput of RespParser.encode for GET/SET/XRANGE-sized replies,
+compared with the previous f-string based encoder.
+
+Usage: python -m benchmarks.encode [--number N]
+"""
+
+import argparse
+import timeit
+
+from app.resp_parser import RespParser
+
+
+def legacy_encode(data, type=""):
+    # RespParser.encode before the bytearray/preencoded rewrite.
+    if data is None:
+        return f"$-1\r\n".encode()
+    elif type == "err":
+        return f"-{data}\r\n".encode()
+    elif isinstance(data, int):
+        return f":{data}\r\n".encode()
+    elif isinstance(data, list):
+        encoded_elements = b"".join([legacy_encode(element, type) for element in data])
+        return f"*{len(data)}\r\n".encode() + encoded_elements
+    elif isinstance(data, bytes):
+        return f"${len(data)}\r\n{data.decode('utf-8')}\r\n".encode()
+    elif isinstance(data, str) and type == "bulk":
+        return f"${len(data)}\r\n{data}\r\n".encode()
+    elif isinstance(data, str):
+        return f"+{data}\r\n".encode()
+    else:
+        raise ValueError("Unsupported data type for encoding")
+
+
+CASES = {
+    "SET (+OK)": ("OK", ""),
+    "GET (100 B bulk)": ("v" * 100, "bulk"),
+    "GET (100 B bytes)": (b"v" * 100, ""),
+    "INCR (:42)": (42, ""),
+    "XRANGE (100 entries)": (
+        [
+            [b"1526919030474-%d" % i, [b"temperature", b"36", b"humidity", b"95"]]
+            for i in range(100)
+        ],
+        "bulk",
+    ),
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=100_000)
+    args = parser.parse_args()
+
+    print(f"{'reply':<24}{'before ops/s':>16}{'after ops/s':>16}{'speedup':>10}")
+    for name, (data, type) in CASES.items():
+        assert legacy_encode(data, type) == RespParser.encode(data, type)
+        number = args.number if not isinstance(data, list) else args.number // 100
+        before = timeit.timeit(lambda: legacy_encode(data, type), number=number)
+        after = timeit.timeit(lambda: RespParser.encode(data, type), number=number)
+        print(
+            f"{name:<24}{number / before:>16,.0f}{number / after:>16,.0f}"
+            f"{before / after:>9.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+GET/SET throughput of a server over TCP: concurrent clients each send a
+command and wait for its reply, half of them SETs and half GETs. The server
+is started with --loglevel unless --port points to one already running, and
+its log goes to a file like a production deployment's would.
+
+Usage: python -m benchmarks.get_set [--clients N] [--seconds S]
+       [--value-size N] [--loglevel LEVEL] [--port PORT]
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+
+from app.log import DEFAULT_LOG_LEVEL, LOG_LEVELS
+from app.resp_parser import RespParser
+from benchmarks.load import start_server
+
+
+async def read_reply(reader: asyncio.StreamReader) -> None:
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Server closed the connection")
+    if line[:1] == b"$" and line[1:3] != b"-1":
+        await reader.readexactly(int(line[1:-2]) + 2)
+
+
+async def client(
+    port: int, index: int, value_size: int, deadline: float, counts: list[int]
+) -> None:
+    reader, writer = await asyncio.open_connection("localhost", port)
+    key = b"key:%d" % index
+    set_command = RespParser.encode([b"SET", key, b"x" * value_size])
+    get_command = RespParser.encode([b"GET", key])
+    while time.perf_counter() < deadline:
+        writer.write(set_command)
+        await read_reply(reader)
+        writer.write(get_command)
+        await read_reply(reader)
+        counts[index] += 2
+    writer.close()
+
+
+async def run(port: int, clients: int, seconds: float, value_size: int) -> float:
+    counts = [0] * clients
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(client(port, i, value_size, start + seconds, counts) for i in range(clients))
+    )
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument(
+        "--loglevel", choices=tuple(LOG_LEVELS), default=DEFAULT_LOG_LEVEL
+    )
+    parser.add_argument("--port", type=int, help="use a running server")
+    args = parser.parse_args()
+
+    server = None
+    port = args.port
+    with tempfile.TemporaryFile() as log:
+        if port is None:
+            port = 6390
+            server = start_server(port, log, "--loglevel", args.loglevel)
+        try:
+            ops = asyncio.run(run(port, args.clients, args.seconds, args.value_size))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+        log_size = log.seek(0, 2)
+    print(
+        f"{ops:>10,.0f} ops/s  {args.clients} clients  "
+        f"loglevel {args.loglevel if server else '(external)'}  "
+        f"log {log_size / 1024 / 1024:,.1f} MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
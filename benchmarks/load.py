@@ -0,0 +1,238 @@
+"""
+Load generator in the spirit of redis-benchmark. Spawns app.main locally
+(plus replicas for WAIT) unless --port points to a running server, runs each
+test with many connections and a configurable pipeline depth, and reports
+throughput and latency percentiles per test.
+
+Tests:
+  set          SET key value
+  setpx        SET key value PX --ttl-ms
+  get          GET key
+  incr         INCR counter, among --keyspace counters
+  append       APPEND key --value-size bytes, growing the values in place
+  mget         MGET of 10 keys
+  xadd         XADD stream * field value
+  xrange       XRANGE stream - + COUNT 10
+  xread        XREAD BLOCK 1000 STREAMS stream $, woken by a background XADD
+               producer, so the latency is the wake-up latency
+  wait         SET key value, then WAIT --replicas 1000
+
+Keys are picked at random among --keyspace keys, streams among --streams.
+
+Usage: python -m benchmarks.load [--tests set,get] [--clients N]
+       [--requests N] [--pipeline N] [--keyspace N] [--value-size N]
+       [--streams N] [--replicas N] [--ttl-ms N] [--loglevel LEVEL]
+       [--port PORT]
+"""
+
+import argparse
+import asyncio
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import IO, Callable
+
+from app.resp_parser import RespDecoder, RespParser
+
+TESTS = (
+    "set",
+    "setpx",
+    "get",
+    "incr",
+    "append",
+    "mget",
+    "xadd",
+    "xrange",
+    "xread",
+    "wait",
+)
+VARIANTS = 1024  # distinct pre-encoded commands per test and client
+
+
+def command_factory(test: str, args: argparse.Namespace) -> Callable[[], bytes]:
+    """Return a function building one request of the test, as RESP."""
+    value = b"x" * args.value_size
+
+    def key() -> bytes:
+        return b"key:%012d" % random.randrange(args.keyspace)
+
+    def stream() -> bytes:
+        return b"stream:%d" % random.randrange(args.streams)
+
+    commands = {
+        "set": lambda: [b"SET", key(), value],
+        "setpx": lambda: [b"SET", key(), value, b"PX", b"%d" % args.ttl_ms],
+        "get": lambda: [b"GET", key()],
+        "incr": lambda: [b"INCR", b"counter:%d" % random.randrange(args.keyspace)],
+        "append": lambda: [b"APPEND", key(), value],
+        "mget": lambda: [b"MGET", *(key() for _ in range(10))],
+        "xadd": lambda: [b"XADD", stream(), b"*", b"field", value],
+        "xrange": lambda: [b"XRANGE", stream(), b"-", b"+", b"COUNT", b"10"],
+        "xread": lambda: [b"XREAD", b"BLOCK", b"1000", b"STREAMS", stream(), b"$"],
+    }
+    if test == "wait":
+        # One request is a SET and the WAIT for it.
+        wait = RespParser.encode([b"WAIT", b"%d" % args.replicas, b"1000"])
+        return lambda: RespParser.encode(commands["set"]()) + wait
+    return lambda: RespParser.encode(commands[test]())
+
+
+async def client(
+    port: int,
+    requests: int,
+    pipeline: int,
+    make: Callable[[], bytes],
+    replies_per_request: int,
+    latencies: list[float],
+) -> None:
+    reader, writer = await asyncio.open_connection("localhost", port)
+    variants = [make() for _ in range(VARIANTS)]
+    decoder = RespDecoder(binary=True)
+    sent = 0
+    while sent < requests:
+        batch = min(pipeline, requests - sent)
+        writer.writelines(random.choices(variants, k=batch))
+        start = time.perf_counter()
+        expected = batch * replies_per_request
+        while expected:
+            data = await reader.read(64 * 1024)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            for reply, _ in decoder.feed(data):
+                if isinstance(reply, str) and reply.startswith(("ERR", "WRONGTYPE")):
+                    raise RuntimeError(f"Error reply: {reply}")
+                expected -= 1
+                if expected % replies_per_request == 0:
+                    latencies.append(time.perf_counter() - start)
+        sent += batch
+    writer.close()
+
+
+async def xadd_producer(port: int, streams: int, stop: asyncio.Event) -> None:
+    """Feed the streams XREAD BLOCK waits on."""
+    reader, writer = await asyncio.open_connection("localhost", port)
+    decoder = RespDecoder(binary=True)
+    while not stop.is_set():
+        key = b"stream:%d" % random.randrange(streams)
+        writer.write(RespParser.encode([b"XADD", key, b"*", b"f", b"v"]))
+        while not decoder.feed(await reader.read(1024)):
+            pass
+    writer.close()
+
+
+async def run_test(
+    test: str, port: int, args: argparse.Namespace
+) -> tuple[float, list[float]]:
+    make = command_factory(test, args)
+    latencies: list[float] = []
+    per_client, extra = divmod(args.requests, args.clients)
+    stop = asyncio.Event()
+    producer = None
+    if test == "xread":
+        producer = asyncio.create_task(xadd_producer(port, args.streams, stop))
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            client(
+                port,
+                per_client + (i < extra),
+                args.pipeline,
+                make,
+                2 if test == "wait" else 1,
+                latencies,
+            )
+            for i in range(args.clients)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    if producer is not None:
+        stop.set()
+        await producer
+    return len(latencies) / elapsed, latencies
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    return sorted_values[min(int(len(sorted_values) * p), len(sorted_values) - 1)]
+
+
+def report(test: str, ops: float, latencies: list[float]) -> None:
+    ms = sorted(latency * 1000 for latency in latencies)
+    print(
+        f"{test:<8}{ops:>12,.0f} req/s  "
+        f"avg {sum(ms) / len(ms):>7.3f}  p50 {percentile(ms, 0.5):>7.3f}  "
+        f"p99 {percentile(ms, 0.99):>7.3f}  p999 {percentile(ms, 0.999):>7.3f}  "
+        f"max {ms[-1]:>7.3f} ms"
+    )
+
+
+def start_server(port: int, log: IO, *options: str) -> subprocess.Popen:
+    """Start app.main on port and wait until it accepts connections."""
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.main", "--port", str(port), *options],
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--tests", default="set,get")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=100_000)
+    parser.add_argument("--pipeline", type=int, default=1)
+    parser.add_argument("--keyspace", type=int, default=100_000)
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument("--streams", type=int, default=16)
+    parser.add_argument("--replicas", type=int, default=1)
+    parser.add_argument("--ttl-ms", type=int, default=60_000)
+    parser.add_argument("--loglevel", default="warning")
+    parser.add_argument("--port", type=int, help="use a running server")
+    args = parser.parse_args()
+    tests = args.tests.split(",")
+    for test in tests:
+        if test not in TESTS:
+            parser.error(f"unknown test {test}, choose from {', '.join(TESTS)}")
+
+    servers = []
+    port = args.port
+    with tempfile.TemporaryFile() as log:
+        try:
+            if port is None:
+                port = 6390
+                options = ("--loglevel", args.loglevel)
+                servers.append(start_server(port, log, *options))
+                if "wait" in tests:
+                    for i in range(args.replicas):
+                        servers.append(
+                            start_server(
+                                port + 1 + i,
+                                log,
+                                "--replicaof",
+                                f"localhost {port}",
+                                *options,
+                            )
+                        )
+                    time.sleep(1)  # let the replicas sync
+            for test in tests:
+                report(test, *asyncio.run(run_test(test, port, args)))
+        finally:
+            for server in servers:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == "__main__":
+    main()
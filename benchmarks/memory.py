@@ -0,0 +1,63 @@
+"""
+Memory used per key by Container for small keys, measured with tracemalloc:
+strings, or hashes, sets, sorted sets or lists of --fields entries each.
+Key and value bytes themselves are allocated before measuring, so the result
+is the per-key overhead of the keyspace and of the collection encodings.
+
+Usage: python -m benchmarks.memory [--keys N] [--ttl-ratio R]
+       [--type string|hash|set|zset|list] [--fields N]
+"""
+
+import argparse
+import tracemalloc
+
+from app.container import Container
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--keys", type=int, default=1_000_000)
+    parser.add_argument(
+        "--ttl-ratio", type=float, default=0.0, help="Fraction of keys with a TTL"
+    )
+    parser.add_argument(
+        "--type", choices=("string", "hash", "set", "zset", "list"), default="string"
+    )
+    parser.add_argument("--fields", type=int, default=4, help="Entries per collection")
+    args = parser.parse_args()
+    if args.ttl_ratio and args.type != "string":
+        parser.error("--ttl-ratio only applies to string keys")
+
+    keys = [b"key:%d" % i for i in range(args.keys)]
+    values = [b"value:%d" % i for i in range(args.keys)]
+    with_ttl = int(args.keys * args.ttl_ratio)
+    fields = [b"field:%d" % i for i in range(args.fields)]
+    hash_items = [item for field in fields for item in (field, b"value")]
+    zset_items = [(float(i), field) for i, field in enumerate(fields)]
+
+    container = Container()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for i, (key, value) in enumerate(zip(keys, values)):
+        if args.type == "hash":
+            container.hset(key, hash_items)
+        elif args.type == "set":
+            container.sadd(key, fields)
+        elif args.type == "zset":
+            container.zadd(key, zset_items)
+        elif args.type == "list":
+            container.list_push(key, fields, left=False)
+        else:
+            container.set(key, value, expire_at=1 << 62 if i < with_ttl else None)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    encoding = container.encoding_of(keys[0])
+    print(f"keys:           {args.keys:,}")
+    print(f"keys with TTL:  {with_ttl:,}")
+    print(f"encoding:       {args.type}, {encoding}")
+    print(f"bytes per key:  {(after - before) / args.keys:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Startup time for loading a large RDB file: parsing alone and the full bulk
+load into the keyspace. The file is generated with RdbWriter if it does not
+exist yet (string keys, a fraction of them with a TTL).
+
+Usage: python -m benchmarks.rdb_load [--size-mb N] [--value-size N]
+       [--ttl-ratio R] [--file PATH]
+"""
+
+import argparse
+import resource
+import time
+from pathlib import Path
+
+from app.rdb_parser import RdbParser
+from app.rdb_writer import RdbWriter
+from app.request_handler import RequestHandler
+
+
+def generate(path: Path, keys: int, value_size: int, ttl_ratio: float) -> None:
+    value = b"x" * value_size
+    expiry = int(time.time() * 1000) + 3_600_000
+    with_ttl = int(keys * ttl_ratio)
+    records = (
+        (b"key:%d" % i, value, expiry if i < with_ttl else None) for i in range(keys)
+    )
+    RdbWriter.save_chunks(RdbWriter.dump_records(records, keys, with_ttl), path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument("--ttl-ratio", type=float, default=0.1)
+    parser.add_argument("--file", type=Path, default=Path("bench-load.rdb"))
+    args = parser.parse_args()
+
+    if not args.file.is_file():
+        # Roughly key, value and their headers per record.
+        keys = args.size_mb * 1024 * 1024 // (args.value_size + 15)
+        start = time.perf_counter()
+        generate(args.file, keys, args.value_size, args.ttl_ratio)
+        print(f"generated {args.file} in {time.perf_counter() - start:.1f} s")
+    size_mb = args.file.stat().st_size / 1024 / 1024
+
+    start = time.perf_counter()
+    with RdbParser(args.file) as rdb_parser:
+        keys = sum(1 for _ in rdb_parser.records())
+    elapsed = time.perf_counter() - start
+    print(
+        f"parse       {elapsed:>8.2f} s  {size_mb / elapsed:>8.1f} MB/s  "
+        f"{keys / elapsed:>12,.0f} keys/s"
+    )
+
+    handler = RequestHandler()
+    start = time.perf_counter()
+    handler.load_rdb(args.file)
+    elapsed = time.perf_counter() - start
+    maxrss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"bulk load   {elapsed:>8.2f} s  {size_mb / elapsed:>8.1f} MB/s  "
+        f"{len(handler.container.kv) / elapsed:>12,.0f} keys/s  "
+        f"(max RSS {maxrss_mb:,.0f} MB)"
+    )
+
+
+if __name__ == "__main__":
+    main()
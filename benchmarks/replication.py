@@ -0,0 +1,105 @@
+"""
+Replication apply throughput of a replica. The benchmark plays the master: it
+completes the PSYNC handshake of an app.main --replicaof process with an
+empty RDB, sends it a replication stream of SETs as fast as the socket takes
+it, then a REPLCONF GETACK, and times until the replica acknowledges the
+whole stream.
+
+Usage: python -m benchmarks.replication [--commands N] [--keyspace N]
+       [--value-size N] [--loglevel LEVEL]
+"""
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+
+from app.resp_parser import RespDecoder, RespParser
+from benchmarks.load import start_server
+
+MASTER_PORT = 6390
+REPLICA_PORT = 6391
+
+
+def replication_stream(commands: int, keyspace: int, value_size: int) -> bytes:
+    value = b"x" * value_size
+    return b"".join(
+        RespParser.encode([b"SET", b"key:%d" % random.randrange(keyspace), value])
+        for _ in range(commands)
+    )
+
+
+async def serve_replica(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    stream: bytes,
+    done: asyncio.Future,
+) -> None:
+    decoder = RespDecoder(binary=True)
+    # PING, REPLCONF listening-port, REPLCONF capa, PSYNC.
+    while True:
+        for command, _ in decoder.feed(await reader.read(64 * 1024)):
+            name = command[0].upper()
+            if name != b"PSYNC":
+                writer.write(b"+PONG\r\n" if name == b"PING" else b"+OK\r\n")
+                continue
+            rdb = bytes.fromhex(RespParser.empty_rdb_hex)
+            writer.write(b"+FULLRESYNC %s 0\r\n$%d\r\n%s" % (b"0" * 40, len(rdb), rdb))
+            start = time.perf_counter()
+            writer.write(stream)
+            writer.write(RespParser.encode([b"REPLCONF", b"GETACK", b"*"]))
+            await writer.drain()
+            # Replicas also ACK every second by themselves, with what they
+            # have applied so far.
+            while True:
+                for ack, _ in decoder.feed(await reader.read(64 * 1024)):
+                    if int(ack[2]) >= len(stream):
+                        done.set_result(time.perf_counter() - start)
+                        writer.close()
+                        return
+        await writer.drain()
+
+
+async def run(args: argparse.Namespace, log) -> tuple[float, int]:
+    stream = replication_stream(args.commands, args.keyspace, args.value_size)
+    done = asyncio.get_running_loop().create_future()
+    master = await asyncio.start_server(
+        lambda r, w: serve_replica(r, w, stream, done), "localhost", MASTER_PORT
+    )
+    replica = await asyncio.to_thread(
+        start_server,
+        REPLICA_PORT,
+        log,
+        "--replicaof",
+        f"localhost {MASTER_PORT}",
+        "--loglevel",
+        args.loglevel,
+    )
+    try:
+        return await done, len(stream)
+    finally:
+        replica.terminate()
+        await asyncio.to_thread(replica.wait)
+        master.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--commands", type=int, default=500_000)
+    parser.add_argument("--keyspace", type=int, default=100_000)
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument("--loglevel", default="warning")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryFile() as log:
+        elapsed, size = asyncio.run(run(args, log))
+    print(
+        f"{args.commands / elapsed:>10,.0f} commands/s  "
+        f"{size / elapsed / 1024 / 1024:>6.1f} MB/s  "
+        f"{args.commands:,} SETs in {elapsed:.2f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+XADD append throughput and XRANGE/XREAD seek latency on a large stream.
+
+Usage: python -m benchmarks.stream [--entries N] [--seeks N]
+"""
+
+import argparse
+import random
+import time
+
+from app.container import Container, StreamEntries
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=10_000_000)
+    parser.add_argument("--seeks", type=int, default=100_000)
+    args = parser.parse_args()
+
+    container = Container()
+    fields = [b"temperature", b"36", b"humidity", b"95"]
+    start = time.perf_counter()
+    for i in range(args.entries):
+        container.xadd(b"stream", f"{1_000_000 + i // 4}-*", fields)
+    elapsed = time.perf_counter() - start
+    print(f"XADD        {args.entries / elapsed:>14,.0f} entries/s")
+
+    stream: StreamEntries = container.get(b"stream")
+    starts = [
+        (1_000_000 + random.randrange(args.entries // 4), random.randrange(4))
+        for _ in range(args.seeks)
+    ]
+
+    start = time.perf_counter()
+    for id in starts:
+        stream.range(id, (id[0] + 10, 0), count=10)
+    elapsed = time.perf_counter() - start
+    print(f"XRANGE      {elapsed / args.seeks * 1e6:>14.2f} us/seek (COUNT 10)")
+
+    start = time.perf_counter()
+    for id in starts:
+        stream.after(id, count=10)
+    elapsed = time.perf_counter() - start
+    print(f"XREAD       {elapsed / args.seeks * 1e6:>14.2f} us/seek (COUNT 10)")
+
+
+if __name__ == "__main__":
+    main()
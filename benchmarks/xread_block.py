@@ -0,0 +1,59 @@
+"""
+Many concurrent XREAD BLOCK 0 readers: CPU used while they are idle and the
+latency from an XADD until every reader blocked on that stream is answered.
+
+Usage: python -m benchmarks.xread_block [--readers N] [--streams N]
+"""
+
+import argparse
+import asyncio
+import time
+
+from app.request_handler import RequestHandler
+
+
+async def run(readers: int, streams: int) -> tuple[float, float]:
+    handler = RequestHandler()
+    keys = [b"stream:%d" % i for i in range(streams)]
+    for key in keys:
+        await handler.handle([b"XADD", key, b"0-1", b"f", b"v"])
+
+    tasks = [
+        asyncio.create_task(
+            handler.handle(
+                [b"XREAD", b"BLOCK", b"0", b"STREAMS", keys[i % streams], b"$"]
+            )
+        )
+        for i in range(readers)
+    ]
+    await asyncio.sleep(0.1)  # let every reader block
+
+    cpu = time.process_time()
+    await asyncio.sleep(1)
+    idle_cpu = time.process_time() - cpu
+
+    latencies = []
+    per_stream = [tasks[i::streams] for i in range(streams)]
+    for key, waiting in zip(keys, per_stream):
+        start = time.perf_counter()
+        await handler.handle([b"XADD", key, b"*", b"f", b"v"])
+        await asyncio.gather(*waiting)
+        latencies.append((time.perf_counter() - start) / len(waiting))
+    return idle_cpu, sum(latencies) / len(latencies)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--readers", type=int, default=10_000)
+    parser.add_argument("--streams", type=int, default=100)
+    args = parser.parse_args()
+    idle_cpu, latency = asyncio.run(run(args.readers, args.streams))
+    print(f"idle CPU with {args.readers:,} blocked readers: {idle_cpu:.3f} s/s")
+    print(
+        f"wake latency per reader: {latency * 1e6:.1f} us "
+        f"({args.readers // args.streams:,} readers per stream)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import asyncio
+from typing import Callable, Iterator
+
+import pytest
+
+from app.request_handler import RequestHandler
+
+
+@pytest.fixture
+def runner() -> Iterator[asyncio.Runner]:
+    with asyncio.Runner() as runner:
+        yield runner
+
+
+@pytest.fixture
+def handler() -> RequestHandler:
+    """A master without replicas, persistence or memory limit."""
+    return RequestHandler()
+
+
+@pytest.fixture
+def call(runner: asyncio.Runner, handler: RequestHandler) -> Callable[..., bytes]:
+    """Run a command on handler and return its RESP reply."""
+
+    def call(*args: str | bytes) -> bytes:
+        input = [arg.encode() if isinstance(arg, str) else arg for arg in args]
+        return runner.run(handler.handle(input)).data
+
+    return call
@@ -0,0 +1,206 @@
+"""
+The append only file: the RDB preamble a rewrite starts it with, the
+commands appended after it, replaying both on a restart, and when each
+appendfsync policy syncs.
+"""
+
+import asyncio
+from pathlib import Path
+
+import pytest
+
+import app.aof
+from app.aof import AppendOnlyFile
+from app.request_handler import RequestHandler
+from app.resp_parser import RespParser
+
+SET_A = b"*3\r\n$3\r\nSET\r\n$1\r\na\r\n$1\r\n1\r\n"
+
+
+@pytest.fixture
+def handler(tmp_path: Path) -> RequestHandler:
+    """A master with an always synced AOF in tmp_path, not opened yet."""
+    return restart(tmp_path)
+
+
+def restart(tmp_path: Path) -> RequestHandler:
+    return RequestHandler(
+        dir=tmp_path, rdbfilename="dump.rdb", appendonly=True, appendfsync="always"
+    )
+
+
+def keys(handler: RequestHandler) -> dict:
+    return {key: handler.container.get(key) for key in handler.container.keys()}
+
+
+def test_commands_are_appended_and_replayed(call, runner, handler, tmp_path):
+    runner.run(handler.open_aof())
+    call("SET", "a", "1")
+    call("RPUSH", "l", "x", "y")
+    call("GET", "a")  # not a write
+    runner.run(handler.flush_aof())
+
+    aof = (tmp_path / "appendonly.aof").read_bytes()
+    assert aof == SET_A + RespParser.encode(["RPUSH", "l", "x", "y"], type="bulk")
+
+    restarted = restart(tmp_path)
+    runner.run(restarted.open_aof())
+    assert keys(restarted) == keys(handler)
+
+
+def test_new_aof_starts_with_the_loaded_keys(call, runner, handler, tmp_path):
+    call("SET", "a", "1")
+    call("SAVE")
+    handler = restart(tmp_path)
+    assert handler.container.get(b"a") == b"1"
+
+    async def open_and_write() -> None:
+        await handler.open_aof()
+        # Written while the preamble is, so it goes after it.
+        await handler.handle([b"SET", b"b", b"2"])
+        await handler.flush_aof()
+        await handler.aof_rewrite_task
+
+    runner.run(open_and_write())
+    aof = (tmp_path / "appendonly.aof").read_bytes()
+    assert aof.startswith(b"REDIS")
+    assert aof.endswith(RespParser.encode(["SET", "b", "2"], type="bulk"))
+
+    (tmp_path / "dump.rdb").unlink()
+    restarted = restart(tmp_path)
+    runner.run(restarted.open_aof())
+    assert keys(restarted) == {b"a": b"1", b"b": b"2"}
+
+
+def test_bgrewriteaof(call, runner, handler, tmp_path) -> None:
+    runner.run(handler.open_aof())
+    for i in range(100):
+        call("SET", "k", str(i))
+    call("SET", "gone", "x")
+    call("DEL", "gone")
+    runner.run(handler.flush_aof())
+    path = tmp_path / "appendonly.aof"
+    size = path.stat().st_size
+
+    async def rewrite() -> list:
+        replies = [
+            (await handler.handle([b"BGREWRITEAOF"])).data,
+            (await handler.handle([b"BGREWRITEAOF"])).data,
+        ]
+        await handler.handle([b"SET", b"during", b"1"])
+        await handler.flush_aof()
+        await handler.aof_rewrite_task
+        await handler.handle([b"SET", b"after", b"1"])
+        await handler.flush_aof()
+        return replies
+
+    assert runner.run(rewrite()) == [
+        b"+Background append only file rewriting started\r\n",
+        b"-ERR Background append only file rewriting already in progress\r\n",
+    ]
+    assert "aof_last_bgrewrite_status:ok" in handler.get_info("persistence")
+    aof = path.read_bytes()
+    assert aof.startswith(b"REDIS")
+    assert len(aof) < size
+    assert aof.endswith(
+        RespParser.encode(["SET", "during", "1"], type="bulk")
+        + RespParser.encode(["SET", "after", "1"], type="bulk")
+    )
+
+    restarted = restart(tmp_path)
+    runner.run(restarted.open_aof())
+    assert keys(restarted) == {b"k": b"99", b"during": b"1", b"after": b"1"}
+
+
+def test_bgrewriteaof_without_aof(call) -> None:
+    assert call("BGREWRITEAOF") == b"-ERR Append only file is not enabled\r\n"
+
+
+@pytest.mark.parametrize("preamble", (False, True))
+def test_truncated_command_is_dropped(runner, tmp_path, preamble: bool) -> None:
+    path = tmp_path / "appendonly.aof"
+    if preamble:
+        handler = restart(tmp_path)
+        runner.run(handler.handle([b"SET", b"p", b"1"]))
+        runner.run(handler.handle([b"SAVE"]))
+        path.write_bytes((tmp_path / "dump.rdb").read_bytes())
+        (tmp_path / "dump.rdb").unlink()
+    complete = path.read_bytes() if preamble else b""
+    complete += SET_A
+    # A crash in the middle of writing the next command.
+    path.write_bytes(complete + b"*3\r\n$3\r\nSET\r\n$1\r\nb\r\n$")
+
+    handler = restart(tmp_path)
+    runner.run(handler.open_aof())
+    expected = {b"a": b"1", b"p": b"1"} if preamble else {b"a": b"1"}
+    assert keys(handler) == expected
+    assert path.read_bytes() == complete
+
+    # Appending goes on from the end of the last complete command.
+    runner.run(handler.handle([b"SET", b"c", b"3"]))
+    runner.run(handler.flush_aof())
+    restarted = restart(tmp_path)
+    runner.run(restarted.open_aof())
+    assert keys(restarted) == {**expected, b"c": b"3"}
+
+
+def test_bad_aof_is_refused(runner, tmp_path) -> None:
+    (tmp_path / "appendonly.aof").write_bytes(SET_A + b"garbage\r\n")
+    with pytest.raises(ValueError, match="Bad AOF"):
+        runner.run(restart(tmp_path).open_aof())
+
+
+@pytest.fixture
+def fsyncs(monkeypatch: pytest.MonkeyPatch) -> list:
+    """The file descriptors app.aof synced, in order."""
+    fsyncs = []
+    monkeypatch.setattr(app.aof.os, "fsync", fsyncs.append)
+    return fsyncs
+
+
+def test_appendfsync_always(runner, tmp_path, fsyncs) -> None:
+    aof = AppendOnlyFile(tmp_path / "appendonly.aof", "always")
+
+    async def write() -> None:
+        for _ in range(3):
+            aof.feed(SET_A)
+            await aof.flush()  # returns once synced
+            assert len(fsyncs) == 1
+            fsyncs.clear()
+        await aof.flush()  # nothing to write
+
+    runner.run(write())
+    assert fsyncs == []
+    assert (tmp_path / "appendonly.aof").read_bytes() == SET_A * 3
+
+
+def test_appendfsync_everysec(runner, tmp_path, fsyncs) -> None:
+    aof = AppendOnlyFile(tmp_path / "appendonly.aof", "everysec")
+
+    async def write() -> None:
+        loop = asyncio.create_task(aof.fsync_loop(interval=0.05))
+        for _ in range(3):
+            aof.feed(SET_A)
+            await aof.flush()
+        await asyncio.sleep(0.2)
+        assert len(fsyncs) == 1  # one sync for all three writes
+        assert not aof.unsynced
+        await asyncio.sleep(0.1)
+        assert len(fsyncs) == 1  # nothing new to sync
+        loop.cancel()
+
+    runner.run(write())
+    assert (tmp_path / "appendonly.aof").read_bytes() == SET_A * 3
+
+
+def test_appendfsync_no(runner, tmp_path, fsyncs) -> None:
+    aof = AppendOnlyFile(tmp_path / "appendonly.aof", "no")
+
+    async def write() -> None:
+        aof.feed(SET_A)
+        await aof.flush()
+        await asyncio.get_running_loop().run_in_executor(aof.executor, lambda: None)
+
+    runner.run(write())
+    assert fsyncs == []
+    assert (tmp_path / "appendonly.aof").read_bytes() == SET_A
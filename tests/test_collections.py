@@ -0,0 +1,211 @@
+"""
+Lists, sets, hashes and sorted sets: the switch from the compact listpack
+encodings to the full ones, RDB round trips of both, and sorted set order
+across the chunks of ScoreIndex.
+"""
+
+import asyncio
+import random
+from pathlib import Path
+
+import pytest
+
+from app.datatypes import (
+    HASH_MAX_LISTPACK_ENTRIES,
+    HASH_MAX_LISTPACK_VALUE,
+    LIST_MAX_LISTPACK_ENTRIES,
+    LIST_MAX_LISTPACK_VALUE,
+    SET_MAX_LISTPACK_ENTRIES,
+    SET_MAX_LISTPACK_VALUE,
+    ZSET_MAX_LISTPACK_ENTRIES,
+    ZSET_MAX_LISTPACK_VALUE,
+    ScoreIndex,
+)
+from app.request_handler import RequestHandler
+from app.resp_parser import RespDecoder
+
+
+@pytest.fixture
+def handler(tmp_path: Path) -> RequestHandler:
+    """A master that saves to dump.rdb in tmp_path."""
+    return RequestHandler(dir=tmp_path, rdbfilename="dump.rdb")
+
+
+def value(reply: bytes):
+    """reply decoded, with bulk strings as bytes."""
+    [(frame, _)] = RespDecoder(binary=True).feed(reply)
+    return frame
+
+
+def add(call, type: str, key: str, items: list[bytes]) -> None:
+    """Add items to the collection of type at key, in one command."""
+    if type == "list":
+        call("RPUSH", key, *items)
+    elif type == "set":
+        call("SADD", key, *items)
+    elif type == "hash":
+        call("HSET", key, *(arg for item in items for arg in (item, b"v")))
+    else:
+        call("ZADD", key, *(arg for item in items for arg in (b"1", item)))
+
+
+# type, compact and full encoding, entries and value size limits
+ENCODINGS = (
+    (
+        "list",
+        "listpack",
+        "quicklist",
+        LIST_MAX_LISTPACK_ENTRIES,
+        LIST_MAX_LISTPACK_VALUE,
+    ),
+    ("set", "listpack", "hashtable", SET_MAX_LISTPACK_ENTRIES, SET_MAX_LISTPACK_VALUE),
+    (
+        "hash",
+        "listpack",
+        "hashtable",
+        HASH_MAX_LISTPACK_ENTRIES,
+        HASH_MAX_LISTPACK_VALUE,
+    ),
+    (
+        "zset",
+        "listpack",
+        "skiplist",
+        ZSET_MAX_LISTPACK_ENTRIES,
+        ZSET_MAX_LISTPACK_VALUE,
+    ),
+)
+
+
+@pytest.mark.parametrize("type, compact, full, max_entries, max_value", ENCODINGS)
+def test_entry_count_threshold(call, type, compact, full, max_entries, max_value):
+    add(call, type, "k", [b"m%d" % i for i in range(max_entries)])
+    assert value(call("OBJECT", "ENCODING", "k")) == compact.encode()
+    add(call, type, "k", [b"one more"])
+    assert value(call("OBJECT", "ENCODING", "k")) == full.encode()
+
+    # Created past the limit in one command.
+    add(call, type, "big", [b"m%d" % i for i in range(max_entries + 1)])
+    assert value(call("OBJECT", "ENCODING", "big")) == full.encode()
+
+
+@pytest.mark.parametrize("type, compact, full, max_entries, max_value", ENCODINGS)
+def test_value_size_threshold(call, type, compact, full, max_entries, max_value):
+    add(call, type, "k", [b"x" * max_value])
+    assert value(call("OBJECT", "ENCODING", "k")) == compact.encode()
+    add(call, type, "k", [b"y" * (max_value + 1)])
+    assert value(call("OBJECT", "ENCODING", "k")) == full.encode()
+
+
+def test_hash_value_size_threshold(call) -> None:
+    # Hash values count as well as fields.
+    call("HSET", "k", "f", b"x" * HASH_MAX_LISTPACK_VALUE)
+    assert value(call("OBJECT", "ENCODING", "k")) == b"listpack"
+    call("HSET", "k", "f", b"x" * (HASH_MAX_LISTPACK_VALUE + 1))
+    assert value(call("OBJECT", "ENCODING", "k")) == b"hashtable"
+
+
+def test_full_encodings_do_not_shrink(call) -> None:
+    # Like Redis, a converted collection stays converted once it is small.
+    add(call, "set", "k", [b"m%d" % i for i in range(SET_MAX_LISTPACK_ENTRIES + 1)])
+    call("SREM", "k", *(b"m%d" % i for i in range(SET_MAX_LISTPACK_ENTRIES)))
+    assert value(call("SCARD", "k")) == 1
+    assert value(call("OBJECT", "ENCODING", "k")) == b"hashtable"
+
+
+def contents(call) -> dict:
+    """Every collection of test_rdb_round_trip, in comparable form."""
+    res = {}
+    for size in ("small", "large"):
+        res[f"list:{size}"] = value(call("LRANGE", f"list:{size}", "0", "-1"))
+        res[f"set:{size}"] = sorted(value(call("SMEMBERS", f"set:{size}")))
+        pairs = value(call("HGETALL", f"hash:{size}"))
+        res[f"hash:{size}"] = dict(zip(pairs[0::2], pairs[1::2]))
+        res[f"zset:{size}"] = value(
+            call("ZRANGE", f"zset:{size}", "0", "-1", "WITHSCORES")
+        )
+        for type in ("list", "set", "hash", "zset"):
+            key = f"{type}:{size}"
+            res[f"encoding:{key}"] = value(call("OBJECT", "ENCODING", key))
+    return res
+
+
+def test_rdb_round_trip(call, runner: asyncio.Runner, tmp_path: Path) -> None:
+    rng = random.Random(0)
+    for size, count in (("small", 10), ("large", 1000)):
+        members = [b"m%d" % i for i in range(count)]
+        call("RPUSH", f"list:{size}", *members, b"", b"\x00\r\n")
+        call("SADD", f"set:{size}", *members, b"-1", b"12345678901")
+        call(
+            "HSET",
+            f"hash:{size}",
+            *(
+                arg
+                for member in members
+                for arg in (member, b"%d" % rng.randrange(-1000, 10**6))
+            ),
+        )
+        scores = (b"0", b"-2.5", b"1e100", b"3", b"-inf", b"inf", b"0.1")
+        call(
+            "ZADD",
+            f"zset:{size}",
+            *(arg for member in members for arg in (rng.choice(scores), member)),
+        )
+    call("HSET", "hash:small", "n", "-7")
+    call("ZADD", "zset:small", "123456789012", "int")
+    assert call("SAVE") == b"+OK\r\n"
+    saved = contents(call)
+    assert saved["encoding:list:small"] == b"listpack"
+    assert saved["encoding:zset:large"] == b"skiplist"
+
+    loaded = RequestHandler(dir=tmp_path, rdbfilename="dump.rdb")
+
+    def call_loaded(*args: str | bytes) -> bytes:
+        input = [arg.encode() if isinstance(arg, str) else arg for arg in args]
+        return runner.run(loaded.handle(input)).data
+
+    assert contents(call_loaded) == saved
+
+
+def test_zrange_orders_equal_scores_by_member_across_chunks(call) -> None:
+    # Enough members for several ScoreIndex chunks, all scored the same, so
+    # their order is up to the member comparison at every chunk boundary.
+    count = ScoreIndex.CHUNK_SIZE * 4 + 7
+    members = [b"m%05d" % i for i in range(count)]
+    shuffled = random.Random(0).sample(members, count)
+    call("ZADD", "k", *(arg for member in shuffled[:1000] for arg in (b"1", member)))
+    for member in shuffled[1000:]:  # one at a time, so chunks split
+        call("ZADD", "k", "1", member)
+    assert value(call("OBJECT", "ENCODING", "k")) == b"skiplist"
+
+    assert value(call("ZRANGE", "k", "0", "-1")) == members
+    assert value(call("ZRANGE", "k", "0", "-1", "REV")) == members[::-1]
+    for boundary in range(0, count, ScoreIndex.CHUNK_SIZE // 2):
+        start, stop = max(boundary - 3, 0), boundary + 3
+        reply = call("ZRANGE", "k", str(start), str(stop))
+        assert value(reply) == members[start : stop + 1]
+        reply = call("ZRANGEBYSCORE", "k", "1", "1", "LIMIT", str(start), "7")
+        assert value(reply) == members[start : start + 7]
+        assert value(call("ZRANK", "k", members[boundary])) == boundary
+
+
+def test_zrange_after_removals_and_score_changes(call) -> None:
+    rng = random.Random(1)
+    count = ScoreIndex.CHUNK_SIZE * 3
+    scores = {b"m%05d" % i: rng.choice((1.0, 2.0)) for i in range(count)}
+    for member, score in scores.items():
+        call("ZADD", "k", repr(score), member)
+    for member in rng.sample(sorted(scores), count // 2):
+        if rng.random() < 0.5:
+            call("ZREM", "k", member)
+            del scores[member]
+        else:
+            call("ZINCRBY", "k", "1", member)
+            scores[member] += 1
+
+    expected = sorted(scores, key=lambda member: (scores[member], member))
+    assert value(call("ZRANGE", "k", "0", "-1")) == expected
+    for rank in (0, len(expected) // 3, len(expected) - 1):
+        assert value(call("ZRANK", "k", expected[rank])) == rank
+    twos = [member for member in expected if scores[member] == 2.0]
+    assert value(call("ZRANGEBYSCORE", "k", "2", "2")) == twos
+    assert value(call("ZCOUNT", "k", "(1", "(3")) == len(twos)
@@ -0,0 +1,81 @@
+"""
+Eviction under maxmemory, and the DELs it propagates so that replicas and
+the AOF drop the same keys as the master.
+"""
+
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from app.request_handler import RequestHandler
+from app.resp_parser import RespDecoder
+
+VALUE = b"v" * 100
+
+
+@pytest.fixture
+def handler(tmp_path: Path) -> RequestHandler:
+    """A master with room for a few dozen keys and an always synced AOF."""
+    return RequestHandler(
+        master_replid="8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb",
+        master_repl_offset=0,
+        dir=tmp_path,
+        maxmemory=4000,
+        maxmemory_policy="allkeys-lru",
+        appendonly=True,
+        appendfsync="always",
+    )
+
+
+def replay(runner: asyncio.Runner, stream: bytes) -> RequestHandler:
+    """A handler without memory limit that ran the commands of stream."""
+    replica = RequestHandler()
+    for frame, _ in RespDecoder(binary=True).feed(stream):
+        runner.run(replica.handle(frame))
+    return replica
+
+
+def test_evictions_are_propagated_as_del(call, runner, handler, tmp_path) -> None:
+    runner.run(handler.open_aof())
+    call("PSYNC", "?", "-1")  # a replica from offset 0 on
+    start = handler.backlog.offset
+    for i in range(200):
+        call("SET", f"k{i}", VALUE)
+        call("GET", "k0")  # recently used, so never evicted
+    runner.run(handler.flush_aof())
+
+    evicted = handler.container.evicted_keys
+    assert evicted > 100
+    keys = sorted(handler.container.keys())
+    assert b"k0" in keys and b"k199" in keys
+
+    stream = handler.backlog.get_from(start)
+    assert stream.count(b"*2\r\n$3\r\nDEL\r\n") == evicted
+    # The DEL goes out before the write that needed the room.
+    assert stream.index(b"DEL\r\n$2\r\nk1\r\n") < stream.index(b"$3\r\nk99\r\n")
+    assert sorted(replay(runner, stream).container.keys()) == keys
+
+    aof = (tmp_path / "appendonly.aof").read_bytes()
+    assert aof == stream
+    restarted = RequestHandler(dir=tmp_path, appendonly=True)
+    runner.run(restarted.open_aof())
+    assert sorted(restarted.container.keys()) == keys
+
+
+def test_del(call, runner, handler) -> None:
+    runner.run(handler.open_aof())
+    call("SET", "a", "1")
+    call("SET", "b", "2", "PX", "1")
+    call("RPUSH", "c", "x")
+    call("PSYNC", "?", "-1")
+    start = handler.backlog.offset
+
+    assert call("DEL", "a", "c", "none") == b":2\r\n"
+    assert call("DEL", "a") == b":0\r\n"
+    assert call("GET", "a") == b"$-1\r\n"
+    assert call("LLEN", "c") == b":0\r\n"
+    # Only deletions that happened are propagated.
+    assert handler.backlog.get_from(start) == (
+        b"*4\r\n$3\r\nDEL\r\n$1\r\na\r\n$1\r\nc\r\n$4\r\nnone\r\n"
+    )
@@ -0,0 +1,104 @@
+"""
+Active expiry: keys whose TTL passed are removed by active_expire_cycle()
+without being accessed, earliest deadline first and within the cycle's time
+limit.
+"""
+
+import asyncio
+
+import pytest
+
+import app.container
+import app.request_handler
+from app.request_handler import RequestHandler
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.ms = 1_000_000
+
+    def __call__(self) -> int:
+        return self.ms
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    """Stands in for app.clock.now_ms(), advanced by setting clock.ms."""
+    clock = Clock()
+    monkeypatch.setattr(app.container, "now_ms", clock)
+    monkeypatch.setattr(app.request_handler, "now_ms", clock)
+    return clock
+
+
+def test_cycle_removes_keys_past_their_deadline(call, handler, clock) -> None:
+    call("SET", "a", "1", "PX", "100")
+    call("SET", "b", "1", "PX", "200")
+    call("SET", "c", "1")
+    assert handler.container.active_expire_cycle(25) == 0
+
+    clock.ms += 150
+    assert handler.container.active_expire_cycle(25) == 1
+    # Removed without being read.
+    assert set(handler.container.kv) == {b"b", b"c"}
+
+    clock.ms += 100
+    assert handler.container.active_expire_cycle(25) == 1
+    assert set(handler.container.kv) == {b"c"}
+    assert "expired_keys:2\n" in handler.get_info("stats")
+
+
+def test_cycle_skips_deadlines_that_changed(call, handler, clock) -> None:
+    call("SET", "persisted", "1", "PX", "100")
+    call("SET", "persisted", "2")
+    call("SET", "extended", "1", "PX", "100")
+    call("SET", "extended", "2", "PX", "1000")
+    call("SET", "kept", "1", "PX", "100")
+    call("SET", "kept", "2", "KEEPTTL")
+
+    clock.ms += 200
+    assert handler.container.active_expire_cycle(25) == 1
+    assert set(handler.container.kv) == {b"persisted", b"extended"}
+
+    clock.ms += 1000
+    assert handler.container.active_expire_cycle(25) == 1
+    assert set(handler.container.kv) == {b"persisted"}
+    assert handler.container.ttl_index == []
+
+
+def test_cycle_rebuilds_an_index_of_stale_entries(call, handler, clock) -> None:
+    for _ in range(3000):
+        call("SET", "k", "v", "PX", "100000")
+    assert len(handler.container.ttl_index) == 3000
+
+    handler.container.active_expire_cycle(25)
+    assert handler.container.ttl_index == [(clock.ms + 100000, b"k")]
+
+
+def test_cycle_stops_at_its_time_limit(call, handler, clock) -> None:
+    for i in range(1000):
+        call("SET", f"k{i}", "v", "PX", str(i + 1))
+    clock.ms += 2000
+
+    # Without time left, a cycle still checks one batch of 64 keys.
+    assert handler.container.active_expire_cycle(0) == 64
+    # The earliest deadlines go first.
+    assert b"k63" not in handler.container.kv
+    assert b"k64" in handler.container.kv
+    assert handler.container.active_expire_cycle(1000) == 1000 - 64
+    assert handler.container.kv == {}
+
+
+def test_active_expire_runs_in_the_background(
+    call, runner: asyncio.Runner, handler: RequestHandler
+) -> None:
+    call("SET", "k", "v", "PX", "1")
+    call("SET", "other", "v")
+
+    async def run() -> None:
+        with pytest.raises(TimeoutError):
+            async with asyncio.timeout(0.1):
+                await handler.container.active_expire(hz=100)
+
+    runner.run(run())
+    assert set(handler.container.kv) == {b"other"}
+    assert handler.container.expire_cycle_cpu_ms > 0
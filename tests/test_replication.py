@@ -0,0 +1,184 @@
+"""
+The replication backlog, and the choice PSYNC makes between continuing
+from it and a full resync.
+"""
+
+import asyncio
+from pathlib import Path
+import random
+
+import pytest
+
+import app.server
+from app.container import Container
+from app.rdb_writer import RdbWriter
+from app.replication import ReplicationBacklog
+from app.request_handler import RequestHandler, Response
+from app.resp_parser import RespDecoder, RespParser
+from app.server import Server
+
+REPLID = "8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb"
+
+
+def test_backlog_wraps_around() -> None:
+    backlog = ReplicationBacklog(10)
+    backlog.feed(b"abcdef")
+    assert (backlog.start_offset, backlog.offset) == (0, 6)
+    assert backlog.get_from(2) == b"cdef"
+
+    backlog.feed(b"ghijkl")  # past the end of the buffer
+    assert (backlog.start_offset, backlog.offset) == (2, 12)
+    assert backlog.get_from(2) == b"cdefghijkl"
+    assert backlog.get_from(9) == b"jkl"
+    assert backlog.get_from(12) == b""
+    assert not backlog.contains(1)
+    assert not backlog.contains(13)
+    with pytest.raises(ValueError):
+        backlog.get_from(1)
+
+    backlog.feed(b"0123456789ABC")  # more than the whole buffer
+    assert backlog.start_offset == 15
+    assert backlog.get_from(15) == b"3456789ABC"
+
+
+def test_backlog_matches_the_stream_tail() -> None:
+    rng = random.Random(0)
+    backlog = ReplicationBacklog(64)
+    backlog.offset = 1000  # like a master that had written before
+    stream = b""
+    for _ in range(500):
+        data = bytes(
+            rng.randrange(256) for _ in range(rng.choice((0, 1, 7, 63, 64, 65)))
+        )
+        backlog.feed(data)
+        stream += data
+        tail = stream[-64:]
+        assert backlog.offset == 1000 + len(stream)
+        assert backlog.start_offset == backlog.offset - len(tail)
+        start = rng.randint(backlog.start_offset, backlog.offset)
+        assert backlog.get_from(start) == tail[start - backlog.start_offset :]
+
+
+@pytest.fixture
+def handler() -> RequestHandler:
+    """A master with a 100 byte backlog."""
+    return RequestHandler(
+        master_replid=REPLID, master_repl_offset=0, repl_backlog_size=100
+    )
+
+
+def psync(runner: asyncio.Runner, handler: RequestHandler, *args: bytes) -> Response:
+    return runner.run(handler.handle([b"PSYNC", *args]))
+
+
+def test_psync_continues_from_the_backlog(call, runner, handler) -> None:
+    response = psync(runner, handler, b"?", b"-1")
+    assert response.data[0] == b"+FULLRESYNC %s 0\r\n" % REPLID.encode()
+    assert response.repl_offset == 0
+
+    call("SET", "k", "v")  # 27 bytes in the stream
+    assert handler.master_repl_offset == 27
+    # PSYNC takes the offset of the next byte the replica needs.
+    for offset in (0, 10, 27):
+        response = psync(runner, handler, REPLID.encode(), b"%d" % (offset + 1))
+        assert response.data == [b"+CONTINUE %s\r\n" % REPLID.encode()]
+        assert response.repl_offset == offset
+
+
+@pytest.mark.parametrize(
+    "replid, offset",
+    (
+        (b"0" * 40, 27),  # another master's history
+        (REPLID.encode(), 28),  # ahead of the master
+        (REPLID.encode(), -1),
+        (REPLID.encode(), 0),  # before the start of the backlog, see below
+    ),
+)
+def test_psync_falls_back_to_full_resync(call, runner, handler, replid, offset):
+    psync(runner, handler, b"?", b"-1")
+    call("SET", "k", "v")
+    if offset == 0:
+        for _ in range(3):
+            call("SET", "k", "v")  # wraps the backlog over offset 0
+    response = psync(runner, handler, replid, b"%d" % (offset + 1))
+    master_offset = handler.master_repl_offset
+    assert response.data[0] == b"+FULLRESYNC %s %d\r\n" % (
+        REPLID.encode(),
+        master_offset,
+    )
+    assert response.repl_offset == master_offset
+
+
+BAD_PSYNC_REPLIES = (
+    b"",  # no reply at all
+    b"+FULLRESYNC %s 0\r\n$abc\r\n" % REPLID.encode(),
+    b"+FULLRESYNC\r\n",
+    b"+FULLRESYNC %s zero\r\n" % REPLID.encode(),
+)
+
+
+def test_replica_retries_after_bad_handshakes(
+    runner: asyncio.Runner, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    """
+    A master that does not answer PSYNC in time, or answers nonsense, makes
+    the replica reconnect rather than give up on replication.
+    """
+    monkeypatch.setattr(app.server, "MASTER_TIMEOUT", 0.1)
+    monkeypatch.setattr(app.server, "MASTER_RETRY_DELAY", 0.01)
+    rdb = b"".join(RdbWriter.dump(Container()))
+    psync_replies = [
+        *BAD_PSYNC_REPLIES,
+        b"+FULLRESYNC %s 0\r\n$%d\r\n%s" % (REPLID.encode(), len(rdb), rdb)
+        + RespParser.encode(["SET", "k", "v"], type="bulk"),
+    ]
+    pings = 0
+
+    async def master(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        nonlocal pings
+        decoder = RespDecoder(binary=True)
+        while data := await reader.read(1024):
+            for frame, _ in decoder.feed(data):
+                if frame[0] == b"PING":
+                    pings += 1
+                    # The first time, a reply to PING that is not RESP.
+                    writer.write(b"?garbage\r\n" if pings == 1 else b"+PONG\r\n")
+                elif frame[0] == b"REPLCONF":
+                    writer.write(b"+OK\r\n")
+                elif frame[0] == b"PSYNC":
+                    writer.write(psync_replies.pop(0))
+        writer.close()
+
+    async def run() -> Server:
+        listener = await asyncio.start_server(master, "localhost", 0)
+        port = listener.sockets[0].getsockname()[1]
+        replica = Server(
+            role="slave", master_host="localhost", master_port=port, dir=tmp_path
+        )
+        task = asyncio.create_task(replica.talk_to_master("localhost", port))
+        try:
+            async with asyncio.timeout(10):
+                while replica.request_handler.container.get(b"k") is None:
+                    await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+            listener.close()
+        return replica
+
+    replica = runner.run(run())
+    assert psync_replies == []
+    assert pings == len(BAD_PSYNC_REPLIES) + 2
+    assert replica.request_handler.master_replid == REPLID
+
+
+@pytest.mark.parametrize(
+    "timeout, error",
+    (
+        (b"abc", b"-ERR value is not an integer or out of range\r\n"),
+        (b"-1", b"-ERR timeout is negative\r\n"),
+    ),
+)
+def test_wait_timeout(call, timeout: bytes, error: bytes) -> None:
+    # Rejected even though no replica needs to be waited for.
+    assert call("WAIT", "0", timeout) == error
+    assert call("WAIT", "0", "0") == b":0\r\n"
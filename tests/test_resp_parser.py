@@ -0,0 +1,195 @@
+"""
+RespDecoder decodes command frames on a fast path and hands everything
+else to the general frame decoder. Both must give the same frames, lengths
+and errors whatever way the input is split into chunks.
+"""
+
+import random
+
+import pytest
+
+from app.resp_parser import RespDecoder, RespParser, RespParserError
+
+
+class FrameDecoder(RespDecoder):
+    """RespDecoder without the fast path: every frame goes to _decode_frame()."""
+
+    def _decode_command(self, view: memoryview):
+        return self._INCOMPLETE
+
+
+def random_bulk(rng: random.Random, binary: bool) -> bytes:
+    size = rng.choice((0, 1, 2, 5, 30, 300))
+    if binary:
+        # Any byte, including the CR LF the decoder must not stop at.
+        return bytes(rng.randrange(256) for _ in range(size))
+    return bytes(rng.choice(b"ab\r\n ") for _ in range(size))
+
+
+def random_frame(rng: random.Random, binary: bool, depth: int = 0):
+    """A random frame as (encoding, value decoded in binary mode)."""
+    roll = rng.random()
+    if roll < 0.6 or depth:
+        # A command, the fast path's case, or now and then an array it
+        # rejects: nested, empty, null or holding other types.
+        count = rng.choice((1, 1, 2, 3, 5, 20)) if roll < 0.5 else rng.choice((0, -1))
+        if count == -1:
+            return b"*-1\r\n", None
+        encoded = b"*%d\r\n" % count
+        value = []
+        for _ in range(count):
+            if depth < 2 and rng.random() < 0.1:
+                item_encoded, item = random_frame(rng, binary, depth + 1)
+            else:
+                item = random_bulk(rng, binary)
+                item_encoded = b"$%d\r\n%s\r\n" % (len(item), item)
+            encoded += item_encoded
+            value.append(item)
+        return encoded, value
+    item = random_bulk(rng, binary)
+    return rng.choice(
+        (
+            (b"$%d\r\n%s\r\n" % (len(item), item), item),
+            (b"$-1\r\n", None),
+            (b"+OK\r\n", "OK"),
+            (b"-ERR no\r\n", "ERR no"),
+            (b":-42\r\n", -42),
+        )
+    )
+
+
+def as_text(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, list):
+        return [as_text(item) for item in value]
+    return value
+
+
+def decode_in_chunks(decoder: RespDecoder, data: bytes, seed: int) -> list:
+    """Frames, lengths and leftover bytes, or the error, for data fed in chunks."""
+    rng = random.Random(seed)
+    out: list = []
+    pos = 0
+    try:
+        while pos < len(data):
+            size = rng.choice((1, 2, 7, 64, 4096))
+            out += decoder.feed(data[pos : pos + size])
+            pos += size
+    except RespParserError as err:
+        out.append(("error", str(err)))
+    else:
+        out.append(("remaining", decoder.remaining))
+    return out
+
+
+@pytest.mark.parametrize("binary", (True, False))
+def test_fast_path_matches_frame_decoder(binary: bool) -> None:
+    rng = random.Random(binary)
+    for trial in range(300):
+        frames = [random_frame(rng, binary) for _ in range(rng.randint(1, 20))]
+        data = b"".join(encoded for encoded, _ in frames)
+        expected = [
+            (value if binary else as_text(value), len(encoded))
+            for encoded, value in frames
+        ]
+        expected.append(("remaining", b""))
+
+        got = decode_in_chunks(RespDecoder(binary=binary), data, trial)
+        assert got == expected
+        assert decode_in_chunks(FrameDecoder(binary=binary), data, trial) == got
+
+
+def test_corrupt_input_matches_frame_decoder() -> None:
+    rng = random.Random(0)
+    for trial in range(1000):
+        frames = [random_frame(rng, True) for _ in range(rng.randint(1, 10))]
+        data = bytearray(b"".join(encoded for encoded, _ in frames))
+        for _ in range(rng.randint(1, 3)):
+            data[rng.randrange(len(data))] = rng.choice(b"*$:+-\r\n0123456789x")
+        data = bytes(data)
+
+        got = decode_in_chunks(RespDecoder(binary=True), data, trial)
+        assert decode_in_chunks(FrameDecoder(binary=True), data, trial) == got
+
+
+@pytest.mark.parametrize(
+    "data, frames",
+    (
+        # Not arrays of bulk strings, so left to _decode_frame().
+        (b"+PONG\r\n", ["PONG"]),
+        (b":7\r\n", [7]),
+        (b"$-1\r\n", [None]),
+        (b"*0\r\n", [[]]),
+        (b"*-1\r\n", [None]),
+        (b"*2\r\n$3\r\nGET\r\n:1\r\n", [[b"GET", 1]]),
+        (b"*2\r\n*1\r\n$1\r\na\r\n$1\r\nb\r\n", [[[b"a"], b"b"]]),
+        (b"*1\r\n$-1\r\n", [[None]]),
+        # A command right after a frame the fast path rejected.
+        (b"*0\r\n*1\r\n$4\r\nPING\r\n", [[], [b"PING"]]),
+    ),
+)
+def test_frames_left_to_frame_decoder(data: bytes, frames: list) -> None:
+    decoder = RespDecoder(binary=True)
+    assert [frame for frame, _ in decoder.feed(data)] == frames
+    assert decoder.remaining == b""
+
+
+def test_incomplete_command_resumes_on_next_chunk() -> None:
+    decoder = RespDecoder(binary=True)
+    assert decoder.feed(b"*2\r\n$3\r\nGET\r\n$5\r\nke") == []
+    assert decoder.remaining == b"*2\r\n$3\r\nGET\r\n$5\r\nke"
+    assert decoder.feed(b"y:1\r\n") == [([b"GET", b"key:1"], 24)]
+
+
+@pytest.mark.parametrize(
+    "data",
+    (
+        b"*1\r\n$x\r\n",  # bulk length is not a number
+        b"*1\r\n$3\r\nabcd\r\n",  # bulk longer than its length
+        b"*1\r\n%3\r\n",  # unknown type
+        b"*x\r\n",  # array length is not a number
+    ),
+)
+def test_protocol_errors(data: bytes) -> None:
+    with pytest.raises(RespParserError):
+        RespDecoder(binary=True).feed(data)
+
+
+class Text(str):
+    pass
+
+
+@pytest.mark.parametrize(
+    "data, type, encoded",
+    (
+        (None, "", b"$-1\r\n"),
+        (None, "bulk", b"$-1\r\n"),
+        (b"v\r\n", "", b"$3\r\nv\r\n\r\n"),
+        (bytearray(b"ab"), "bulk", b"$2\r\nab\r\n"),
+        (b"", "", b"$0\r\n\r\n"),
+        ("OK", "", b"+OK\r\n"),
+        ("PONG", "", b"+PONG\r\n"),
+        (Text("OK"), "", b"+OK\r\n"),
+        ("OK", "bulk", b"$2\r\nOK\r\n"),
+        ("é", "bulk", b"$2\r\n\xc3\xa9\r\n"),
+        (Text("ab"), "bulk", b"$2\r\nab\r\n"),
+        ("0102", "rdb", b"$2\r\n\x01\x02"),
+        ("ERR no", "err", b"-ERR no\r\n"),
+        (0, "", b":0\r\n"),
+        (1023, "", b":1023\r\n"),
+        (1024, "", b":1024\r\n"),
+        (-1, "", b":-1\r\n"),
+        (True, "", b":1\r\n"),
+        (2**63, "", b":9223372036854775808\r\n"),
+        ([], "", b"*0\r\n"),
+        (
+            [b"a", 1, None, [b"b"]],
+            "",
+            b"*4\r\n$1\r\na\r\n:1\r\n$-1\r\n*1\r\n$1\r\nb\r\n",
+        ),
+        (["x"], "bulk", b"*1\r\n$1\r\nx\r\n"),
+    ),
+)
+def test_encode(data, type: str, encoded: bytes) -> None:
+    assert RespParser.encode(data, type) == encoded
@@ -0,0 +1,92 @@
+"""
+Stream IDs are pairs of unsigned 64-bit integers, and XREAD only reads
+streams.
+"""
+
+from pathlib import Path
+
+import pytest
+
+from app.request_handler import RequestHandler
+
+MAX = 2**64 - 1
+INVALID_ID = b"-ERR Invalid stream ID specified as stream command argument\r\n"
+WRONGTYPE = b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n"
+TOP_ITEM = (
+    b"-ERR The ID specified in XADD is equal or smaller than the target stream "
+    b"top item\r\n"
+)
+
+
+@pytest.fixture
+def handler(tmp_path: Path) -> RequestHandler:
+    """A master that saves to dump.rdb in tmp_path."""
+    return RequestHandler(dir=tmp_path, rdbfilename="dump.rdb")
+
+
+@pytest.mark.parametrize(
+    "id",
+    (
+        b"%d-1" % (MAX + 1),
+        b"1-%d" % (MAX + 1),
+        b"99999999999999999999999-1",
+        b"%d-*" % (MAX + 1),
+        b"abc-1",
+        b"1-",
+    ),
+)
+def test_xadd_rejects_ids_outside_uint64(call, id: bytes) -> None:
+    assert call("XADD", "s", id, "f", "v") == INVALID_ID
+    assert call("TYPE", "s") == b"+none\r\n"
+
+
+def test_xrange_rejects_ids_outside_uint64(call) -> None:
+    call("XADD", "s", "1-1", "f", "v")
+    assert call("XRANGE", "s", "-", b"%d" % (MAX + 1)) == INVALID_ID
+    assert call("XREAD", "STREAMS", "s", b"0-%d" % (MAX + 1)) == INVALID_ID
+
+
+def test_largest_ids_are_saved(call, tmp_path: Path) -> None:
+    top = b"%d-%d" % (MAX, MAX)
+    assert call("XADD", "s", b"%d-%d" % (MAX, MAX - 1), "f", "v") == (
+        b"+%d-%d\r\n" % (MAX, MAX - 1)
+    )
+    assert call("XADD", "s", b"%d-*" % MAX, "f", "v") == b"+%s\r\n" % top
+    assert call("XADD", "s", b"%d-*" % MAX, "f", "v") == TOP_ITEM
+    assert call("XADD", "s", "*", "f", "v") == (
+        b"-ERR The stream has exhausted the last possible ID, unable to add more "
+        b"items\r\n"
+    )
+    assert call("XRANGE", "s", top, "+").startswith(b"*1\r\n")
+    assert call("SAVE") == b"+OK\r\n"
+    loaded = RequestHandler(dir=tmp_path, rdbfilename="dump.rdb")
+    assert loaded.container.get(b"s").last_id == (MAX, MAX)
+
+
+def test_xadd_star_moves_to_the_next_millisecond(call) -> None:
+    future = 2**50
+    call("XADD", "s", b"%d-%d" % (future, MAX), "f", "v")
+    assert call("XADD", "s", "*", "f", "v") == b"+%d-0\r\n" % (future + 1)
+
+
+@pytest.mark.parametrize("id", (b"$", b"0-0"))
+def test_xread_on_a_key_of_another_type(call, id: bytes) -> None:
+    call("SET", "s", "x")
+    call("XADD", "t", "1-1", "f", "v")
+    assert call("XREAD", "STREAMS", "s", id) == WRONGTYPE
+    assert call("XREAD", "STREAMS", "t", "s", "0-0", id) == WRONGTYPE
+    assert call("XREAD", "BLOCK", "10", "STREAMS", "s", id) == WRONGTYPE
+    # A missing key is an empty stream.
+    assert call("XREAD", "STREAMS", "none", id) == b"$-1\r\n"
+
+
+@pytest.mark.parametrize(
+    "timeout, error",
+    (
+        (b"abc", b"-ERR value is not an integer or out of range\r\n"),
+        (b"1.5", b"-ERR value is not an integer or out of range\r\n"),
+        (b"-1", b"-ERR timeout is negative\r\n"),
+    ),
+)
+def test_xread_block_timeout(call, timeout: bytes, error: bytes) -> None:
+    assert call("XREAD", "BLOCK", timeout, "STREAMS", "s", "$") == error
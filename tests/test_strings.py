@@ -0,0 +1,158 @@
+"""
+Edge cases of the string commands that update values in place. Expected
+replies are the ones Redis gives.
+"""
+
+import pytest
+
+INT64_MAX = b"9223372036854775807"
+INT64_MIN = b"-9223372036854775808"
+
+
+def test_incr_up_to_int64_max(call) -> None:
+    call("SET", "n", b"9223372036854775806")
+    assert call("INCR", "n") == b":%s\r\n" % INT64_MAX
+    assert call("INCR", "n") == b"-ERR increment or decrement would overflow\r\n"
+    assert call("INCRBY", "n", "-1") == b":9223372036854775806\r\n"
+    # A failed increment leaves the value as it was.
+    assert call("GET", "n") == b"$19\r\n9223372036854775806\r\n"
+
+
+def test_decr_down_to_int64_min(call) -> None:
+    call("SET", "n", INT64_MIN)
+    assert call("DECR", "n") == b"-ERR increment or decrement would overflow\r\n"
+    assert call("INCR", "n") == b":-9223372036854775807\r\n"
+    assert call("DECRBY", "m", INT64_MIN) == b"-ERR decrement would overflow\r\n"
+
+
+@pytest.mark.parametrize(
+    "value", (b"9223372036854775808", b"-9223372036854775809", b"1.0", b" 1", b"")
+)
+def test_incr_rejects_values_outside_int64(call, value: bytes) -> None:
+    call("SET", "n", value)
+    assert call("INCR", "n") == b"-ERR value is not an integer or out of range\r\n"
+
+
+@pytest.mark.parametrize(
+    "start, increments, result",
+    (
+        (b"10.50", (b"0.1",), b"10.6"),
+        (b"10.6", (b"-5",), b"5.6"),
+        (b"5.0e3", (b"2.0e2",), b"5200"),
+        (b"0", (b"0.1", b"0.1", b"0.1"), b"0.3"),
+        (b"1.1", (b"2.2",), b"3.3"),
+        (b"3", (b"-3",), b"0"),
+        (b"1", (b"1e-17",), b"1"),  # past the 17 significant digits
+    ),
+)
+def test_incrbyfloat_precision(call, start: bytes, increments, result: bytes) -> None:
+    call("SET", "f", start)
+    for increment in increments:
+        reply = call("INCRBYFLOAT", "f", increment)
+    assert reply == b"$%d\r\n%s\r\n" % (len(result), result)
+    assert call("GET", "f") == reply
+
+
+@pytest.mark.parametrize("increment", (b"inf", b"-inf", b"1.8e308"))
+def test_incrbyfloat_refuses_infinity(call, increment: bytes) -> None:
+    call("SET", "f", b"1")
+    assert (
+        call("INCRBYFLOAT", "f", increment)
+        == b"-ERR increment would produce NaN or Infinity\r\n"
+    )
+    assert call("GET", "f") == b"$1\r\n1\r\n"
+
+
+@pytest.mark.parametrize("increment", (b"nan", b"1_0", b" 1", b"abc"))
+def test_incrbyfloat_rejects_invalid_floats(call, increment: bytes) -> None:
+    assert call("INCRBYFLOAT", "f", increment) == b"-ERR value is not a valid float\r\n"
+    call("SET", "f", b"nan")
+    assert call("INCRBYFLOAT", "f", b"1") == b"-ERR value is not a valid float\r\n"
+
+
+def test_setrange_past_the_end_pads_with_zero_bytes(call) -> None:
+    call("SET", "k", "Hello")
+    assert call("SETRANGE", "k", "8", "World") == b":13\r\n"
+    assert call("GET", "k") == b"$13\r\nHello\x00\x00\x00World\r\n"
+    assert call("SETRANGE", "k", "1", "i") == b":13\r\n"
+    assert call("GET", "k") == b"$13\r\nHillo\x00\x00\x00World\r\n"
+
+
+def test_setrange_on_a_missing_key(call) -> None:
+    assert call("SETRANGE", "k", "3", "ab") == b":5\r\n"
+    assert call("GET", "k") == b"$5\r\n\x00\x00\x00ab\r\n"
+    # An empty value does not create the key.
+    assert call("SETRANGE", "none", "10", "") == b":0\r\n"
+    assert call("GET", "none") == b"$-1\r\n"
+    assert call("SETRANGE", "k", "-1", "x") == b"-ERR offset is out of range\r\n"
+
+
+def test_setrange_on_a_counter(call) -> None:
+    call("SET", "n", "10")
+    call("INCR", "n")
+    assert call("SETRANGE", "n", "0", "2") == b":2\r\n"
+    assert call("INCR", "n") == b":22\r\n"
+
+
+def test_append_after_incr(call) -> None:
+    call("INCR", "n")
+    assert call("APPEND", "n", "0") == b":2\r\n"
+    assert call("INCR", "n") == b":11\r\n"
+
+
+@pytest.mark.parametrize(
+    "start, end, result",
+    (
+        (0, 3, b"This"),
+        (-3, -1, b"ing"),
+        (0, -1, b"This is a string"),
+        (10, 100, b"string"),
+        (-100, -50, b"T"),  # both clamped to the first byte, like Redis
+        (-100, 3, b"This"),
+        (-1, -5, b""),
+        (5, 3, b""),
+        (16, 20, b""),
+    ),
+)
+def test_getrange(call, start: int, end: int, result: bytes) -> None:
+    call("SET", "k", "This is a string")
+    reply = call("GETRANGE", "k", str(start), str(end))
+    assert reply == b"$%d\r\n%s\r\n" % (len(result), result)
+
+
+def test_getrange_on_a_missing_key(call) -> None:
+    assert call("GETRANGE", "none", "0", "-1") == b"$0\r\n\r\n"
+
+
+@pytest.mark.parametrize(
+    "option, amount",
+    (
+        (b"EX", b"0"),
+        (b"PX", b"-1"),
+        (b"EXAT", b"0"),
+        (b"PXAT", b"-100"),
+        # The deadline in unix ms would not fit an int64.
+        (b"EX", b"9223372036854775"),
+        (b"PX", INT64_MAX),
+        (b"EXAT", b"9223372036854776"),
+    ),
+)
+def test_set_rejects_invalid_expire_times(call, option: bytes, amount: bytes) -> None:
+    assert call("SET", "k", "v", option, amount) == (
+        b"-ERR invalid expire time in 'set' command\r\n"
+    )
+    assert call("GET", "k") == b"$-1\r\n"
+
+
+@pytest.mark.parametrize(
+    "option, amount", ((b"EXAT", b"9223372036854775"), (b"PXAT", INT64_MAX))
+)
+def test_set_accepts_the_largest_deadlines(call, option: bytes, amount: bytes) -> None:
+    assert call("SET", "k", "v", option, amount) == b"+OK\r\n"
+    assert call("GET", "k") == b"$1\r\nv\r\n"
+
+
+def test_set_rejects_expire_times_outside_int64(call) -> None:
+    assert call("SET", "k", "v", "PX", b"9223372036854775808") == (
+        b"-ERR value is not an integer or out of range\r\n"
+    )